@@ -0,0 +1,66 @@
+"""Reports the memory a ZoteroLibrary needs per item.
+
+Builds a library of synthetic documents, each with one attachment, from JSON decoded one item at a time (as
+pyzotero responses are) and measures the allocations with tracemalloc.
+
+    python benchmarks/memory.py [number_of_documents]
+"""
+import sys
+import json
+import tracemalloc
+from zoterosync.library import ZoteroLibrary
+from zoterosync.library import ZoteroItem
+from zoterosync.library import ZoteroCollection
+
+DOCUMENT = {"itemType": "journalArticle", "title": "", "abstractNote": "", "publicationTitle": "Journal", "volume": "",
+            "issue": "", "pages": "1-10", "date": "2001", "series": "", "seriesTitle": "", "seriesText": "",
+            "journalAbbreviation": "", "language": "", "DOI": "", "ISSN": "", "shortTitle": "", "url": "",
+            "accessDate": "", "archive": "", "archiveLocation": "", "libraryCatalog": "", "callNumber": "",
+            "rights": "", "extra": "", "dateAdded": "2013-12-25T01:42:47Z", "dateModified": "2016-12-24T02:55:29Z",
+            "creators": [{"creatorType": "author", "firstName": "Dhruva R.", "lastName": "Chakrabarti"}],
+            "tags": [{"tag": "parallel"}], "relations": {}}
+ATTACHMENT = {"itemType": "attachment", "linkMode": "linked_url", "title": "Full Text", "accessDate": "", "url": "",
+              "note": "", "contentType": "text/html", "charset": "", "dateAdded": "2013-12-25T01:42:47Z",
+              "dateModified": "2016-12-24T02:55:29Z", "tags": [], "relations": {}}
+COLLECTIONS = 20
+
+
+def key(prefix, i):
+    return "{}{:07d}".format(prefix, i)
+
+
+def item_json(template, i, **data):
+    item = dict(template, key=key(template["itemType"][0].upper(), i), version=1, **data)
+    return json.dumps(dict(data=item))
+
+
+def build(num_docs):
+    lib = ZoteroLibrary(None)
+    for c in range(COLLECTIONS):
+        ZoteroCollection.factory(lib, dict(data=dict(key=key("C", c), version=1, name="Collection " + str(c),
+                                                     parentCollection=False, relations={})))
+    docs = (item_json(DOCUMENT, i, title="Document " + str(i), collections=[key("C", i % COLLECTIONS)])
+            for i in range(num_docs))
+    attachments = (item_json(ATTACHMENT, i, parentItem=key("J", i), collections=[]) for i in range(num_docs))
+    return lib, docs, attachments
+
+
+def measure(num_docs):
+    lib, docs, attachments = build(num_docs)
+    docs, attachments = list(docs), list(attachments)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for d, a in zip(docs, attachments):
+        ZoteroItem.factory(lib, json.loads(d))
+        ZoteroItem.factory(lib, json.loads(a))
+    lib.mark_saved()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return used, lib.num_items
+
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    used, num_items = measure(num_docs)
+    print("{} items: {:.1f} MiB, {:.0f} bytes per item".format(num_items, used / 2 ** 20, used / num_items))
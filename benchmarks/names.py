@@ -0,0 +1,62 @@
+"""Times the Person comparisons used when merging creators.
+
+Generates a corpus of creator names with the variations seen in real libraries (initials with and without
+periods, stray whitespace, case differences, particles) and times building Creators from their JSON dicts,
+Person.clean and Person.same over pairs of names.
+
+    python benchmarks/names.py [number_of_names]
+"""
+import sys
+import time
+import random
+from zoterosync.library import Creator
+
+LASTS = ["Smith", "Chakrabarti", "Banerjee", "Cartwright", "Cooper", "van den Berg", "O'Neil", "Nguyen", "Müller",
+         "García Márquez", "Shirriff", "Odifreddi", "Cate", "Gross", "de la Cruz", "Li", "Wang", "Kowalski",
+         "Johnson", "Papadopoulos", "Quine", "Hilbert", "Noether", "Gödel", "Turing", "Church", "Kleene", "Post"]
+FIRSTS = ["Dhruva R.", "Prithviraj", "Robert S", "Keith D", "Benno", "Vlad", "Tomas M", "Kurt", "Alan Mathison",
+          "Emmy", "Willard Van Orman", "Alonzo", "Stephen Cole", "Emil Leon", "Piergiorgio", "Ken W", "Maria",
+          "José", "Wei", "Anna", "Jan", "Sophie", "Ahmed", "Olga", "Yuki", "Chidi"]
+
+
+def variant(rand, first, last):
+    style = rand.randrange(6)
+    if (style == 1):
+        first = first[0] + "."
+    elif (style == 2):
+        first = " ".join(w[0] for w in first.split())
+    elif (style == 3):
+        first = first.upper() if rand.random() < 0.5 else first.lower()
+    elif (style == 4):
+        first, last = " " + first + " ", last + " "
+    elif (style == 5):
+        last = last.casefold()
+    return dict(creatorType="author", firstName=first, lastName=last)
+
+
+def corpus(num_names, seed=0):
+    rand = random.Random(seed)
+    return [variant(rand, rand.choice(FIRSTS), rand.choice(LASTS)) for i in range(num_names)]
+
+
+def timed(label, count, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>9} ops {:>8.3f} s {:>10.2f} us/op".format(label, count, elapsed, 1e6 * elapsed / count))
+    return result
+
+
+def run(num_names, pairs_per_name=20):
+    names = corpus(num_names)
+    rand = random.Random(1)
+    creators = timed("Creator(dict)", len(names), lambda: [Creator(d) for d in names])
+    people = [c.creator for c in creators]
+    pairs = [(p, rand.choice(people)) for p in people for i in range(pairs_per_name)]
+    timed("Person.clean", len(people), lambda: [p.clean() for p in people])
+    timed("Person.same", len(pairs), lambda: sum(p.same(o) for p, o in pairs))
+    timed("Person.same (repeat)", len(pairs), lambda: sum(p.same(o) for p, o in pairs))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -25,6 +25,9 @@ setup(name='zoterosync',
       install_requires=[
         'Click', 'pyzotero', 'python-dateutil', 'nameparser', 'bsdiff4'
       ],
+      extras_require={
+        'arrow': ['pyarrow'],
+      },
       setup_requires=['pytest-runner'],
       tests_require=['pytest'],
       zip_safe=False,
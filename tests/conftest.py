@@ -76,8 +76,7 @@ class MockPyzotero(object):
         return {coll["data"]["key"]: coll["data"]["version"] for
                 coll in self._collections if coll["data"]["version"] > since}
 
-    def items(self, limit=50, itemKey=None, start=1, **kwargs):
-        start = start - 1
+    def items(self, limit=50, itemKey=None, start=0, **kwargs):
         if ("format" in kwargs and kwargs["format"] == 'versions'):
             return self.item_versions(**kwargs)
         if (itemKey is not None):
@@ -88,7 +87,7 @@ class MockPyzotero(object):
         else:
             items = self._items[start:limit+start]
             if (len(self._items) > limit+start):
-                self._next = functools.partialmethod(self.items, limit=limit, start=limit+start, **kwargs)
+                self._next = functools.partial(self.items, limit=limit, start=limit+start, **kwargs)
             else:
                 self._next = None
         return items
@@ -106,13 +105,17 @@ class MockPyzotero(object):
                 return c
         raise zotero_errors.ResourceNotFound
 
-    def collections(self, limit=50, start=1, **kwargs):
-        start = start - 1
+    def collections(self, limit=50, start=0, collectionKey=None, **kwargs):
         if ("format" in kwargs and kwargs["format"] == 'versions'):
             return self.collection_versions(**kwargs)
+        if (collectionKey is not None):
+            keys = set(collectionKey.split(','))
+            if (not (0 < len(keys) < 51)):
+                raise Exception("Too many keys")
+            return [c for c in self._collections if c["data"]["key"] in keys]
         colls = self._collections[start:limit+start]
         if (len(self._collections) > limit+start):
-            self._next = functools.partialmethod(self.collections, limit=limit, start=limit+start, **kwargs)
+            self._next = functools.partial(self.collections, limit=limit, start=limit+start, **kwargs)
         else:
             self._next = None
         return colls
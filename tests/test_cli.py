@@ -4,10 +4,15 @@ from zoterosync.library import ZoteroLibrary
 import click
 from click.testing import CliRunner
 from pathlib import Path
+import copy
 import json
 import os
+import re
+import sys
+import subprocess
 import zoterosync
-import pickle
+from zoterosync.database import LibraryDatabase
+from tests.test_zoterolibrary import linked_file_simp
 
 
 def test_cli_init():
@@ -23,6 +28,123 @@ def test_cli_init():
         assert config["user"] == 57867
         assert config["apikey"] == 'testbalh'
         assert config["backups"] == 0
-        with Path(os.path.abspath('.zoterosync_library')).open(mode='rb') as lib_file:
-            lib = pickle.load(lib_file)
+        lib_path = Path(os.path.abspath('.zoterosync_library'))
+        assert LibraryDatabase.is_database(lib_path)
+        lib = LibraryDatabase(lib_path).read(ZoteroLibrary.factory(57867, 'testbalh'))
         assert isinstance(lib, ZoteroLibrary)
+
+
+def test_dedup_one_merger(tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(script.cli, ['--config=' + str(tmp_path), 'dedup', '--fuzzy', '--similarity=0.7'])
+    assert result.exit_code == 2
+    assert "--fuzzy and --similarity" in result.output
+
+
+def test_dedup_attachments(zoteromock, tmp_path, capsys):
+    lib = zoteromock
+    lib.pull()
+    doc = next(d for d in lib.documents if d.children)
+    attachments = []
+    for i in range(5):
+        f = tmp_path.joinpath('file{}.pdf'.format(i))
+        f.write_bytes(b"same contents")
+        data = copy.deepcopy(linked_file_simp)
+        data['data'].update(key='DUPFILE{}'.format(i), parentItem=doc.key, path=str(f))
+        attachments.append(zoterosync.library.ZoteroObject.factory(lib, data))
+    planned = [r for kept, removed in lib.duplicate_attachment_removals() for r in removed]
+    assert len(planned) >= 4  # the mock library has duplicates of its own
+    store = script.ZoteroLibraryStore()
+    store.library = lib
+    checkpoints = []
+    store.write_library = lambda: checkpoints.append(sum(a.deleted for a in planned))
+    store.dedup_attachments(dry_run=True)
+    out = capsys.readouterr().out
+    assert "Would delete {} duplicate attachments".format(len(planned)) in out
+    assert all("#" + a.key in out for a in attachments)
+    assert not any(a.deleted for a in planned) and checkpoints == []
+    store.dedup_attachments(batch_size=3)
+    assert "Deleted {} duplicate attachments".format(len(planned)) in capsys.readouterr().out
+    assert sum(a.deleted for a in attachments) == 4
+    assert checkpoints == [min(n, len(planned)) for n in range(3, len(planned) + 3, 3)]
+
+
+def test_list_objects_paging(zoteromock, capsys):
+    zoteromock.pull()
+    store = script.ZoteroLibraryStore()
+    store.library = zoteromock
+    keys = sorted(d.key for d in zoteromock.documents)
+    store.list_objects(limit=5, offset=3)
+    out = capsys.readouterr().out
+    listed = [k for k in keys if k in out]
+    assert listed == keys[3:8]
+    assert out.index(listed[0]) < out.index(listed[-1])
+    assert "Displayed 5 docs" in out
+    store.list_objects(sortby="key", reverse=True, offset=len(keys) - 2)
+    out = capsys.readouterr().out
+    assert [k for k in keys if k in out] == keys[:2]
+    assert out.index(keys[1]) < out.index(keys[0])
+    store.list_objects()
+    assert "Displayed {} docs".format(len(keys)) in capsys.readouterr().out
+
+
+# modules no listing or config command should load, see zoterosync.lazy
+HeavyModules = ("pyzotero.zotero", "requests", "dateutil.parser", "nameparser", "editdistance", "pyarrow", "filecmp")
+# seconds spent importing zoterosync.script, raise it through the environment on slow machines
+StartupBudget = float(os.environ.get("ZOTEROSYNC_STARTUP_BUDGET", 0.25))
+
+RunCommand = """
+import sys
+from zoterosync.script import cli
+try:
+    cli(sys.argv[1:])
+finally:  # a lazy module not used yet is still of the module type LazyLoader gave it
+    print("LOADED", *[m for m, mod in sys.modules.items() if type(mod).__name__ != "_LazyModule"], file=sys.stderr)
+"""
+
+
+def run_command(args, cwd):
+    """(loaded modules, seconds spent importing zoterosync.script) for a zotero command in a fresh interpreter"""
+    root = str(Path(zoterosync.__file__).parent.parent)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", RunCommand] + args, cwd=str(cwd), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    loaded = set(next(line for line in result.stderr.splitlines() if line.startswith("LOADED")).split()[1:])
+    elapsed = next(int(m.group(1)) for m in re.finditer(r"\|\s*(\d+) \| zoterosync.script$", result.stderr, re.M))
+    return loaded, elapsed / 1e6
+
+
+def test_list_objects_lazy_page(zoteromock, tmp_path, capsys):
+    zoteromock.pull()
+    db = LibraryDatabase(tmp_path.joinpath('library'))
+    db.write(zoteromock, full=True)
+    lib = ZoteroLibrary(zoteromock._server)
+    lib.enable_columns()
+    db.read(lib, lazy=True, cache_size=2)
+    hydrated = []
+    hydrate = lib._hydrate
+    lib._hydrate = lambda key, evict=True: (hydrated.append(key), hydrate(key, evict=evict))
+    store = script.ZoteroLibraryStore()
+    store.library = lib
+    store.list_objects(limit=1)
+    first = min(d.key for d in zoteromock.documents)
+    assert first in capsys.readouterr().out
+    assert hydrated == [first]  # the page is picked on the key column before anything is hydrated
+    del hydrated[:]
+    store.list_objects(sortby="title", reverse=True, offset=1, limit=2)
+    titles = sorted((d.title for d in zoteromock.documents), reverse=True)[1:3]
+    out = capsys.readouterr().out
+    assert all(t[:20] in out for t in titles)
+    assert len(hydrated) <= 2
+
+
+def test_cli_startup(tmp_path):
+    config = '--config=' + str(tmp_path.joinpath('zotero_config'))
+    run_command(['--help'], tmp_path)  # compiles the modules
+    commands = [[config, 'conf', '--key=testbalh', '--user=57867', '--library=' + str(tmp_path.joinpath('library'))],
+                [config, 'lscol'], [config, 'lsdoc', '--title=Some'], ['--help']]
+    for args in commands:
+        loaded, elapsed = run_command(args, tmp_path)
+        assert not loaded.intersection(HeavyModules), args
+        assert elapsed < StartupBudget, args
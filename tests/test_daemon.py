@@ -0,0 +1,85 @@
+import time
+import threading
+from click.testing import CliRunner
+from zoterosync import script
+from zoterosync import daemon
+from zoterosync import export
+from zoterosync.scheduler import SyncScheduler
+from zoterosync.database import LibraryDatabase
+from zoterosync.library import ZoteroLibrary
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_serve(zoteromock, tmp_path):
+    runner = CliRunner()
+    conf_path = tmp_path.joinpath('zotero_config')
+    config = '--config=' + str(conf_path)
+    result = runner.invoke(script.cli, [config, 'conf', '--key=testbalh', '--user=57867',
+                                        '--library=' + str(tmp_path.joinpath('library')), '--datadir=' + str(tmp_path)])
+    assert result.exit_code == 0
+    store = script.ZoteroLibraryStore(conf_path=conf_path)
+    zoteromock.pull()
+    store.library = zoteromock
+    store._full_write = True
+    store.write_library()
+    store.close()
+
+    path = daemon.socket_path(conf_path)
+    stores = []
+
+    def serve():  # the store has to be loaded on the thread serving it, like its sqlite connections
+        stores.append(script.ZoteroLibraryStore(conf_path=conf_path))
+        stores[0].library._server = zoteromock._server
+        sync = SyncScheduler(stores[0], interval=3600)
+        daemon.LibraryDaemon(stores[0], script.cli, path, idle_flush=0.1, scheduler=sync).serve()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        wait_for(lambda: daemon.running(path))
+        store = stores[0]
+        result = runner.invoke(script.cli, [config, 'lsdoc', '--limit=3'])
+        assert result.exit_code == 0
+        assert "Displayed 3 docs / {} total".format(zoteromock.num_docs) in result.output
+        result = runner.invoke(script.cli, [config, 'syncstat'])
+        assert result.exit_code == 0
+        assert "unchanged: 1" in result.output and "queue_depth: 0" in result.output
+        exporter = CliRunner(mix_stderr=False)
+        result = exporter.invoke(script.cli, [config, 'lsdoc', '--limit=3', '--format=jsonl'])
+        assert result.exit_code == 0
+        assert len(result.stdout.splitlines()) == 3
+        assert "Displayed 3 docs" in result.stderr
+        if (export.available("arrow")):  # binary output comes through the daemon as is
+            result = exporter.invoke(script.cli, [config, 'lsdoc', '--limit=3', '--format=arrow'])
+            assert result.exit_code == 0
+            table = export.pyarrow.ipc.open_file(export.pyarrow.BufferReader(result.stdout_bytes)).read_all()
+            assert table.num_rows == 3
+            assert table.schema.field("version").type == export.pyarrow.int64()
+        doc = sorted(zoteromock.documents, key=lambda d: d.key)[0]
+        result = runner.invoke(script.cli, [config, 'delete', doc.key])
+        assert result.exit_code == 0
+        result = runner.invoke(script.cli, [config, 'lsdoc', '--key=' + doc.key])
+        assert "Displayed 0 docs / {} total".format(zoteromock.num_docs - 1) in result.output
+        assert runner.invoke(script.cli, [config, 'dedup']).exit_code == 2
+        assert runner.invoke(script.cli, [config, 'conf']).exit_code == 2
+
+        def flushed():
+            lib = LibraryDatabase(store.library_path).read(ZoteroLibrary(None))
+            return lib.num_docs == zoteromock.num_docs - 1
+        wait_for(flushed)
+        assert runner.invoke(script.cli, [config, 'serve', '--stop']).exit_code == 0
+        thread.join(10)
+    finally:
+        if thread.is_alive():
+            daemon.request(path, dict(stop=True), None, None)
+            thread.join(10)
+    assert not path.exists()
+    assert not store.served
+    assert runner.invoke(script.cli, [config, 'syncstat']).exit_code == 2
+    result = runner.invoke(script.cli, [config, 'lsdoc', '--limit=1'])
+    assert "Displayed 1 docs / {} total".format(zoteromock.num_docs - 1) in result.output
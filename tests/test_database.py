@@ -0,0 +1,146 @@
+import pytest
+import sqlite3
+import json
+import zoterosync
+from zoterosync.database import LibraryDatabase
+
+
+def test_database_roundtrip(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    doc = next(iter(lib.documents))
+    doc.title = "Changed Locally"
+    db = LibraryDatabase(tmp_path.joinpath('library.db'))
+    assert db.write(lib, full=True) == len(lib._objects_by_key)
+    assert LibraryDatabase.is_database(db.path)
+    loaded = db.read(zoterosync.library.ZoteroLibrary(lib._server))
+    assert loaded._version == lib._version
+    assert loaded.num_items == lib.num_items
+    assert loaded.num_collections == lib.num_collections
+    assert len(loaded.unsaved_objects) == 0
+    for key, obj in lib._objects_by_key.items():
+        assert loaded.get_obj_by_key(key)._data == obj._data
+    copy = loaded.get_obj_by_key(doc.key)
+    assert copy.dirty
+    assert copy in loaded._dirty_objects
+    assert copy.title == "Changed Locally"
+    assert {c.key for c in copy.collections} == {c.key for c in doc.collections}
+    assert {c.key for c in copy.children} == {c.key for c in doc.children}
+
+
+def test_database_incremental(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    db = LibraryDatabase(tmp_path.joinpath('library.db'))
+    db.write(lib, full=True)
+    assert len(lib.unsaved_objects) == 0
+    doc = next(iter(lib.documents))
+    doc.title = "Changed Locally"
+    assert db.write(lib) == 1
+    removed = next(d for d in lib.documents if d is not doc)
+    removed.delete()
+    db.write(lib)
+    conn = sqlite3.connect(str(db.path))
+    rows = {r[0]: json.loads(r[1]) for r in conn.execute("SELECT key, state FROM objects")}
+    conn.close()
+    assert len(rows) == len(lib._objects_by_key)
+    assert rows[doc.key]["data"]["title"] == "Changed Locally"
+    loaded = db.read(zoterosync.library.ZoteroLibrary(lib._server))
+    assert loaded.get_obj_by_key(removed.key).deleted
+    assert loaded.get_obj_by_key(removed.key) not in loaded.documents
+    assert loaded.num_items == lib.num_items
+
+
+def test_database_copy_keeps_unsaved(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    db = LibraryDatabase(tmp_path.joinpath('library.db'))
+    db.write(lib, full=True)
+    doc = next(iter(lib.documents))
+    doc.title = "Changed Locally"
+    copy = LibraryDatabase(tmp_path.joinpath('copy.db'))
+    copy.write(lib, full=True, saved=False)
+    assert doc in lib.unsaved_objects
+    assert db.write(lib) == 1
+    loaded = db.read(zoterosync.library.ZoteroLibrary(lib._server))
+    assert loaded.get_obj_by_key(doc.key).title == "Changed Locally"
+    assert copy.read(zoterosync.library.ZoteroLibrary(lib._server)).get_obj_by_key(doc.key).title == "Changed Locally"
+
+
+def test_database_lazy(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    db = LibraryDatabase(tmp_path.joinpath('library.db'))
+    db.write(lib, full=True)
+    lazy = LibraryDatabase(db.path).read(zoterosync.library.ZoteroLibrary(lib._server), lazy=True, cache_size=2)
+    assert lazy.lazy
+    assert len(lazy._documents) == 0
+    assert lazy.num_collections == lib.num_collections
+    assert lazy.num_docs == lib.num_docs
+    assert lazy.num_attachments == lib.num_attachments
+    att = next(a for a in lib.attachments if a.parent)
+    copy = lazy.get_obj_by_key(att.key)
+    assert copy._data == att._data
+    assert copy.parent.key == att.parent.key
+    assert {c.key for c in copy.parent.children} == {c.key for c in att.parent.children}
+    assert {d.key for d in lazy.documents} == {d.key for d in lib.documents}
+    assert len(lazy._resident) <= 2
+    assert lazy.num_docs == lib.num_docs  # counted, not listed, with families hydrated and evicted again
+    assert lazy.num_attachments == lib.num_attachments
+    assert lazy.num_lazy(zoterosync.library.ZoteroItem) == len(lazy._lazy_index)
+    for col in lib.collections:
+        assert lazy.get_obj_by_key(col.key).size == col.size
+
+
+def test_database_lazy_keeps_unsaved(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    db = LibraryDatabase(tmp_path.joinpath('library.db'))
+    db.write(lib, full=True)
+    lazy = LibraryDatabase(db.path).read(zoterosync.library.ZoteroLibrary(lib._server), lazy=True, cache_size=1)
+    doc = next(iter(lazy.documents))
+    doc.title = "Changed Locally"
+    for d in lazy.documents:
+        pass
+    assert lazy.get_obj_by_key(doc.key) is doc
+    assert lazy._store.write(lazy) == 1
+    reread = LibraryDatabase(db.path).read(zoterosync.library.ZoteroLibrary(lib._server), lazy=True)
+    assert doc.key in reread._objects_by_key
+    assert reread.get_obj_by_key(doc.key).title == "Changed Locally"
+    reread.materialize()
+    assert not reread.lazy
+    assert reread.num_items == lib.num_items
+
+
+def test_database_lazy_columns(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    db = LibraryDatabase(tmp_path.joinpath('library.db'))
+    db.write(lib, full=True)
+    lazy = zoterosync.library.ZoteroLibrary(lib._server)
+    lazy.enable_columns()
+    LibraryDatabase(db.path).read(lazy, lazy=True)
+    doc = next(d for d in lib.documents if d.title)
+    columns = lazy.columns
+    rows = columns.rows(zoterosync.library.ZoteroDocument)
+    assert len(rows) == lib.num_docs
+    matched = columns.filter(rows, "title", lambda t: t == doc.title)
+    assert len(lazy._documents) == 0
+    assert doc.key in {d.key for d in columns.objects_at(matched, lazy)}
+    assert 0 < len(lazy._documents) < lib.num_docs
+
+
+def test_database_duplicate_index(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    lib.duplicate_index.mark_examined(lib.duplicate_index.candidates(lib)[0])
+    doc = next(d for d in lib.documents if d.title)
+    doc.title = "A Retitled Document"
+    db = LibraryDatabase(tmp_path.joinpath('library.db'))
+    db.write(lib, full=True)
+    loaded = zoterosync.library.ZoteroLibrary(lib._server)
+    loaded.enable_columns()
+    LibraryDatabase(db.path).read(loaded, lazy=True)
+    names, buckets = loaded.duplicate_index.candidates(loaded)
+    assert names == {"aretitleddocument"}
+    assert not buckets
@@ -0,0 +1,86 @@
+import io
+import csv
+import json
+import pytest
+from click.testing import CliRunner
+import zoterosync
+from zoterosync import export
+from zoterosync import script
+
+
+def test_export_jsonl(zoteromock):
+    lib = zoteromock
+    lib.pull()
+    stream = io.StringIO()
+    assert export.export_objects(lib.documents, "jsonl", stream, None) == lib.num_docs
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert {r["key"]: r for r in records} == {d.key: d.data for d in lib.documents}
+
+
+def test_export_csv(zoteromock):
+    lib = zoteromock
+    lib.pull()
+    fields = export.export_fields(lib, zoterosync.library.ZoteroItem)
+    assert fields[:3] == ["key", "version", "itemType"] and "creators" in fields and "children" not in fields
+    stream = io.StringIO()
+    items = list(lib.documents) + list(lib.attachments)
+    assert export.export_objects(items, "csv", stream, fields) == len(items)
+    rows = list(csv.DictReader(io.StringIO(stream.getvalue())))
+    assert [r["key"] for r in rows] == [i.key for i in items]
+    doc = next(d for d in lib.documents if d.creators)
+    row = next(r for r in rows if r["key"] == doc.key)
+    assert int(row["version"]) == doc.version
+    assert row["title"] == doc.title
+    assert json.loads(row["creators"]) == doc.data["creators"]
+    cols = export.export_fields(lib, zoterosync.library.ZoteroCollection)
+    stream = io.StringIO()
+    export.export_objects(lib.collections, "csv", stream, cols)
+    assert len(stream.getvalue().splitlines()) == len(lib.collections) + 1
+
+
+def test_export_parquet(zoteromock, tmp_path):
+    pytest.importorskip("pyarrow")
+    lib = zoteromock
+    lib.pull()
+    store = script.ZoteroLibraryStore()
+    store.library = lib
+    path = tmp_path.joinpath("docs.parquet")
+    store.list_objects(export_format="parquet", output=str(path))
+    table = export.pyarrow.parquet.read_table(str(path))
+    assert sorted(table.column("key").to_pylist()) == sorted(d.key for d in lib.documents)
+
+
+def test_export_arrow(zoteromock, tmp_path):
+    pytest.importorskip("pyarrow")
+    runner = CliRunner(mix_stderr=False)
+    config = '--config=' + str(tmp_path.joinpath('zotero_config'))
+    result = runner.invoke(script.cli, [config, 'conf', '--key=testbalh', '--user=57867',
+                                        '--library=' + str(tmp_path.joinpath('library'))])
+    assert result.exit_code == 0
+    store = script.ZoteroLibraryStore(conf_path=tmp_path.joinpath('zotero_config'))
+    zoteromock.pull()
+    store.library = zoteromock
+    store._full_write = True
+    store.write_library()
+    store.close()
+    result = runner.invoke(script.cli, [config, 'lsdoc', '--format=arrow'])
+    assert result.exit_code == 0
+    assert "Displayed {} docs".format(zoteromock.num_docs) in result.stderr
+    table = export.pyarrow.ipc.open_file(export.pyarrow.BufferReader(result.stdout_bytes)).read_all()
+    assert sorted(table.column("key").to_pylist()) == sorted(d.key for d in zoteromock.documents)
+    assert table.schema.field("version").type == export.pyarrow.int64()
+    versions = dict(zip(table.column("key").to_pylist(), table.column("version").to_pylist()))
+    assert versions == {d.key: d.version for d in zoteromock.documents}
+
+
+def test_list_objects_export(zoteromock, tmp_path, capsys):
+    lib = zoteromock
+    lib.pull()
+    store = script.ZoteroLibraryStore()
+    store.library = lib
+    path = tmp_path.joinpath("docs.jsonl")
+    store.list_objects(export_format="jsonl", output=str(path), limit=4)
+    captured = capsys.readouterr()
+    assert "Displayed 4 docs" in captured.err and not captured.out
+    keys = sorted(d.key for d in lib.documents)[:4]
+    assert [json.loads(line)["key"] for line in path.read_text().splitlines()] == keys
@@ -0,0 +1,72 @@
+import os
+import hashlib
+import concurrent.futures
+from zoterosync.hashcache import HashCache
+from zoterosync.hashcache import file_digests
+from zoterosync.hashcache import same_contents
+
+
+def test_hash_cache(tmp_path):
+    f = tmp_path.joinpath('paper.pdf')
+    f.write_bytes(b"first version")
+    cache = HashCache(tmp_path.joinpath('md5_cache'))
+    assert cache.md5(f) == hashlib.md5(b"first version").hexdigest()
+    assert cache.md5(f) == hashlib.md5(b"first version").hexdigest()
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+    reopened = HashCache(tmp_path.joinpath('md5_cache'))
+    assert reopened.md5(f) == hashlib.md5(b"first version").hexdigest()
+    assert (reopened.hits, reopened.misses) == (1, 0)
+    f.write_bytes(b"second version")
+    assert reopened.md5(f) == hashlib.md5(b"second version").hexdigest()
+    assert reopened.misses == 1
+    stat = f.stat()
+    replacement = tmp_path.joinpath('replacement')  # same size and mtime so only the inode differs
+    replacement.write_bytes(b"fourth version")
+    os.utime(str(replacement), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(str(replacement), str(f))
+    assert reopened.md5(f) == hashlib.md5(b"fourth version").hexdigest()
+    assert reopened.misses == 2
+
+
+def test_hash_cache_memory(tmp_path):
+    f = tmp_path.joinpath('paper.pdf')
+    f.write_bytes(b"contents")
+    cache = HashCache()
+    assert cache.md5(f) == cache.md5(f)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_hash_cache_threads(tmp_path):
+    paths = []
+    for i in range(20):
+        paths.append(tmp_path.joinpath(str(i)))
+        paths[-1].write_bytes(str(i).encode())
+    cache = HashCache(tmp_path.joinpath('md5_cache'))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        digests = list(pool.map(cache.md5, paths * 10))
+    assert digests[:20] == [hashlib.md5(str(i).encode()).hexdigest() for i in range(20)]
+    assert cache.hits + cache.misses == 200
+    assert cache.misses >= 20
+
+
+def test_file_digests(tmp_path):
+    contents = dict(a=b"x" * 100, b=b"x" * 100, c=b"y" * 100, d=b"unique size",
+                    e=b"s" * 200000, f=b"s" * 100000 + b"t" + b"s" * 99999)
+    paths = dict()
+    for name, data in contents.items():
+        paths[name] = tmp_path.joinpath(name)
+        paths[name].write_bytes(data)
+    hashed = []
+
+    def full_hash(path):
+        hashed.append(path.name)
+        return hashlib.md5(path.read_bytes()).hexdigest()
+
+    digests = file_digests(paths.values(), full_hash)
+    assert sorted(hashed) == ["a", "b", "e", "f"]
+    assert digests[paths["a"]] == digests[paths["b"]]
+    assert digests[paths["e"]] != digests[paths["f"]]
+    assert digests[paths["c"]] is None and digests[paths["d"]] is None
+    assert same_contents(paths["a"], paths["b"])
+    assert not same_contents(paths["a"], paths["c"]) and not same_contents(paths["e"], paths["f"])
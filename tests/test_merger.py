@@ -4,6 +4,11 @@ from zoterosync.library import Person
 from zoterosync.library import Creator
 from zoterosync.merge import ZoteroDocumentMerger
 from zoterosync.merge import SimpleZDocMerger
+from zoterosync.merge import FuzzyZDocMerger
+from zoterosync.merge import DuplicateFinder
+from zoterosync.merge import MinHashZDocMerger
+from zoterosync.merge import TitleMinHash
+from zoterosync.merge import MergePolicy
 
 creators_first_data = [{'creatorType': 'author', 'firstName': 'Dhruva R.', 'lastName': 'Chakrabarti'},
                        {'creatorType': 'author', 'firstName': 'Prithviraj', 'lastName': 'Banerjee'}]
@@ -90,6 +95,18 @@ def test_creator_person(creator_first, creator_second):
     assert clean_gross.lastname == 'Gross'
 
 
+def test_person_interned_keys():
+    dhruva = Creator(creators_first_data[0]).creator
+    assert dhruva is Creator(creators_first_data[0]).creator
+    assert dhruva.clean() is dhruva.clean()
+    cate = Person(last=" Cate", first="V . ")
+    assert cate.last_key == "cate"
+    assert cate.same(Person(last="cate", first="vlad"))
+    assert cate.first_initials_only()
+    assert Person(last="Cate", first="vlad").first_token == "vlad"
+    assert Person(last="Cate", first="vlad").distance(Person(last="Cat", first="Vlad")) > 0
+
+
 def test_pair_persons(persons_second_with_alt):
     persons = persons_second_with_alt
     cate = persons[0]
@@ -239,3 +256,106 @@ def test_real_merge(double_doc_simple_merger):
     for buck in zmerge._buckets:
         assert len(zmerge._buckets[buck]) == 2
 
+
+def test_duplicate_finder_blocks():
+    words = ["alpha", "alpah", "beta", "betta", "gamma", "alphb"]
+    finder = DuplicateFinder(words, lambda x, y: sum(a != b for a, b in zip(x, y)), 3, keys=lambda w: {w[0]})
+    clusters = sorted(sorted(c) for c in finder.duplicates())
+    assert clusters == [["alpah", "alpha", "alphb"], ["beta", "betta"]]
+    assert finder.comparisons < len(words) * (len(words) - 1) / 2
+    finder.process(["gamme"])
+    assert {"gamma", "gamme"} in list(finder.duplicates())
+
+
+def test_fuzzy_merge(zotero_double_doc):
+    doc = next(d for d in zotero_double_doc.documents if d.title)
+    doc.title = doc.title + "x"
+    zmerge = FuzzyZDocMerger(zotero_double_doc)
+    dups = list(zmerge.duplicates())
+    assert len(dups) == 5
+    assert all(len(d) == 2 for d in dups)
+
+
+def test_title_minhash():
+    minhash = TitleMinHash(threshold=0.7)
+    assert minhash.bands * minhash.rows <= minhash.num_perm
+    one = minhash.shingles("The Theory of Parsing, Translation and Compiling")
+    two = minhash.shingles("Theory of Parsing Translation and Compilng")
+    assert minhash.similarity(one, two) > 0.7
+    assert set(minhash.band_keys(minhash.signature(one))) & set(minhash.band_keys(minhash.signature(two)))
+    other = minhash.shingles("Global optimization techniques for automatic parallelization")
+    assert not set(minhash.band_keys(minhash.signature(one))) & set(minhash.band_keys(minhash.signature(other)))
+
+
+def test_minhash_merge(zotero_double_doc):
+    doc = next(d for d in zotero_double_doc.documents if len(d.title) > 20)
+    doc.title = "The " + doc.title[:-1]
+    zmerge = MinHashZDocMerger(zotero_double_doc)
+    dups = list(zmerge.duplicates())
+    assert len(dups) == 5
+    assert any(doc in d for d in dups)
+    merges = zmerge.interactive_merge()
+    tup, proposed = next(merges)
+    assert len(tup) == 2
+
+
+def test_incremental_duplicate_index(zotero_double_doc):
+    lib = zotero_double_doc
+    zmerge = SimpleZDocMerger(lib)
+    assert len(zmerge._buckets) == 5
+    for tup, proposed in zmerge.interactive_merge():
+        pass
+    assert lib.duplicate_index.examined and not lib.duplicate_index.pending
+    assert len(SimpleZDocMerger(lib)._buckets) == 0
+    doc, other = [d for d in lib.documents if d.title][:2]
+    other.title = doc.title
+    zmerge = SimpleZDocMerger(lib)
+    assert list(zmerge._buckets.values()) == [{d for d in lib.documents if d.title == doc.title}]
+
+
+def test_merge_policy(zotero_double_doc):
+    doc = next(d for d in zotero_double_doc.documents if d.title)
+    policy = MergePolicy(accept=[["DOI"], ["title", "year"]])
+    assert policy.normalized(doc, "title") == SimpleZDocMerger.build_name_key(doc.title)
+    doc["DOI"] = "https://doi.org/10.1000/ABC"
+    assert policy.normalized(doc, "DOI") == "10.1000/abc"
+    with pytest.raises(ValueError):
+        MergePolicy(otherwise="maybe")
+
+
+def test_merge_policy_load(tmp_path):
+    path = tmp_path.joinpath('policy.json')
+    path.write_text('{"accept": [["ISBN"], ["title", "year"]], "otherwise": "accept"}')
+    policy = MergePolicy.load(path)
+    assert policy.accept == [["ISBN"], ["title", "year"]] and policy.otherwise == "accept"
+    for bad in ('[["DOI"]]', '{"accept": ["DOI"]}', '{"accept": "DOI"}', '{"accept": [["DOI"]], "otherwise": 1}'):
+        path.write_text(bad)
+        with pytest.raises(ValueError):
+            MergePolicy.load(path)
+
+
+def test_batch_merge(zotero_double_doc):
+    lib = zotero_double_doc
+    num_docs = lib.num_docs
+    report = SimpleZDocMerger(lib).batch_merge(MergePolicy(accept=[]))
+    assert len(report) == 5
+    assert all(entry["action"] == "skipped" for entry in report)
+    assert lib.num_docs == num_docs
+    report = SimpleZDocMerger(lib).batch_merge(MergePolicy(accept=[["DOI"], ["title"]]))
+    assert len(report) == 5
+    assert all(entry["action"] == "merged" and entry["target"] in entry["documents"] for entry in report)
+    assert lib.num_docs == num_docs - 5
+
+
+def test_parallel_proposals(zotero_double_doc):
+    dup_sets = [tuple(sorted(d, key=lambda x: x.key)) for d in SimpleZDocMerger(zotero_double_doc).duplicates()]
+    serial = list(SimpleZDocMerger(zotero_double_doc).proposals(dup_sets))
+    parallel = list(SimpleZDocMerger(zotero_double_doc, processes=2).proposals(dup_sets))
+    assert [tup for tup, merge in parallel] == dup_sets
+    for (tup, merge), (ptup, pmerge) in zip(serial, parallel):
+        assert merge.keys() == pmerge.keys()
+        for field in merge:
+            if (field == "creators"):
+                assert [c.to_dict() for c in merge[field]] == [c.to_dict() for c in pmerge[field]]
+            else:
+                assert merge[field] == pmerge[field]
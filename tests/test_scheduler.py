@@ -0,0 +1,65 @@
+import json
+from zoterosync.scheduler import SyncScheduler
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Store(object):
+    """What SyncScheduler uses of a ZoteroLibraryStore"""
+
+    def __init__(self, library):
+        self.library = library
+        self.writes = 0
+
+    def pull(self, threads=1):
+        self.library.pull()
+
+    def push(self):
+        self.library.push()
+
+    def write_library(self):
+        self.writes += 1
+
+
+def test_scheduler_backoff(mock_small, zoteromock_small, tmp_path):
+    lib = zoteromock_small
+    clock = Clock()
+    store = Store(lib)
+    metrics_path = tmp_path.joinpath('metrics.json')
+    sched = SyncScheduler(store, interval=10, max_interval=40, metrics_path=metrics_path, clock=clock)
+    assert sched.due()
+    assert sched.step()
+    assert sched.metrics["pulls"] == 1 and store.writes == 1
+    assert lib.num_items == 5
+    waits = []
+    for i in range(4):
+        clock.now = sched.next_step()
+        assert not sched.step()
+        waits.append(sched.wait)
+    assert waits == [20, 40, 40, 40]
+    assert sched.metrics["pulls"] == 1 and sched.metrics["unchanged"] == 4
+    mock_small.version = 5050
+    clock.now = sched.next_step()
+    assert sched.step()
+    assert sched.metrics["pulls"] == 2 and sched.wait == 10
+    assert lib.num_items == 3
+    assert json.loads(metrics_path.read_text())["pulls"] == 2
+
+    clock.now = sched.next_step()
+    sched.step()
+    assert sched.wait == 20
+    lib.mark_dirty(next(iter(lib.documents)))
+    assert sched.next_step() == clock.now + 10  # local changes don't wait for the backed off poll
+    clock.now += 10
+    assert sched.due()
+    assert not sched.step()  # the mock server can't take the push
+    assert sched.metrics["errors"] == 1 and sched.metrics["queue_depth"] == 1
+    assert sched.metrics["last_error"].startswith("AttributeError")
+    assert sched.next_step() == clock.now + 40  # failing pushes back off too
@@ -2,6 +2,13 @@ import pytest
 import zoterosync
 import datetime
 import copy
+import sys
+import hashlib
+import re
+import time
+import threading
+from zoterosync.query import field_matches
+from tests.conftest import MockPyzotero, item_data, collection_data
 
 
 @pytest.fixture
@@ -496,6 +503,25 @@ def test_mock_small(zoteromock_small):
     assert lib._version == 4030
 
 
+def test_mock_small_batched_collections(zoteromock_small):
+    lib = zoteromock_small
+    lib.pull()
+    assert lib.num_collections == 20
+    assert lib._pull_stats["collection_requests"] == 1
+    assert lib._pull_stats["collections_received"] == 20
+    assert lib._pull_stats["item_requests"] == 1
+    assert lib._pull_stats["items_received"] == 5
+
+
+def test_mock_small_concurrent_collections(zoteromock_small):
+    lib = zoteromock_small
+    lib.fetch_threads = 3
+    lib.pull()
+    assert lib.num_collections == 20
+    assert len(lib._collkeys_for_refresh) == 0
+    assert lib._version == 4030
+
+
 def test_mock_delete(mock_small, zoteromock_small):
     lib = zoteromock_small
     lib.pull()
@@ -515,5 +541,342 @@ def test_mock_delete(mock_small, zoteromock_small):
     assert lib.get_obj_by_key('C776Z4WN').dirty is False
 
 
+def test_server_changed(mock_small, zoteromock_small):
+    lib = zoteromock_small
+    assert lib.server_changed()
+    lib.pull()
+    assert not lib.server_changed()
+    mock_small.version = 5050
+    assert lib.server_changed()
+
+
 def test_mock_large(zoteromock):
     lib = zoteromock
+
+
+def test_key_batches(zoterolocal):
+    lib = zoterolocal
+    batches = list(lib._key_batches([str(i) for i in range(120)]))
+    assert len(batches) == 3
+    assert [len(b.split(',')) for b in batches] == [50, 50, 20]
+
+
+def test_mock_large_concurrent(zoteromock):
+    lib = zoteromock
+    serial = zoterosync.library.ZoteroLibrary(lib._server)
+    serial.pull()
+    lib.fetch_threads = 4
+    lib.FetchBatchSize = 10
+    lib._queue_pull()
+    assert len(lib._itemkeys_for_refresh) == 50
+    lib._process_pull()
+    assert len(lib._itemkeys_for_refresh) == 0
+    assert lib.num_items == serial.num_items
+    assert set(lib._objects_by_key) == set(serial._objects_by_key)
+    assert lib._version == serial._version
+
+
+def concurrent_fetch_recorder(lib):
+    """Wraps lib._fetch_items so earlier requests answer last, recording the batches in the order they are
+    requested, the keys applied and the most requests in flight at once"""
+    record = dict(batches=[], requested=[], applied=[], in_flight=0, max_in_flight=0)
+    lock = threading.Lock()
+    key_batches = lib._key_batches
+
+    def batches(keys, size):
+        for batch in key_batches(keys, size):
+            record["batches"].append(batch)
+            yield batch
+    lib._key_batches = batches
+
+    def fetch(keys):
+        with lock:
+            record["requested"].append(keys)
+            record["in_flight"] += 1
+            record["max_in_flight"] = max(record["max_in_flight"], record["in_flight"])
+            delay = 0.05 / len(record["requested"])
+        time.sleep(delay)
+        items = lib._fetch_items(keys)
+        with lock:
+            record["in_flight"] -= 1
+        return sorted(items, key=lambda i: keys.split(",").index(i["data"]["key"]))
+
+    def recieve(item):
+        record["applied"].append(item["data"]["key"])
+        lib._recieve_item(item)
+    return record, fetch, recieve
+
+
+def test_concurrent_batches_in_order(zoteromock):
+    lib = zoteromock
+    lib.fetch_threads = 4
+    lib.FetchBatchSize = 5
+    lib._queue_pull()
+    assert len(lib._itemkeys_for_refresh) == 50
+    record, fetch, recieve = concurrent_fetch_recorder(lib)
+    lib._refresh_queued_concurrent(lib._itemkeys_for_refresh, fetch, recieve, "item")
+    assert len(record["requested"]) == 10
+    assert record["max_in_flight"] > 1
+    assert record["applied"] == [k for keys in record["batches"] for k in keys.split(",")]
+    assert len(lib._itemkeys_for_refresh) == 0
+    assert lib._pull_stats["item_requests"] == 10
+
+
+def test_concurrent_batches_abort(zoteromock):
+    lib = zoteromock
+    lib.fetch_threads = 4
+    lib.FetchBatchSize = 5
+    lib._queue_pull()
+    record, fetch, recieve = concurrent_fetch_recorder(lib)
+
+    def abort_after_two(item):
+        recieve(item)
+        lib.abort = len(record["applied"]) == 10
+    with pytest.raises(zoterosync.library.EarlyExit):
+        lib._refresh_queued_concurrent(lib._itemkeys_for_refresh, fetch, abort_after_two, "item")
+    applied = set(record["applied"])
+    assert len(applied) == 10
+    assert len(lib._itemkeys_for_refresh) == 40
+    assert applied.isdisjoint(lib._itemkeys_for_refresh)
+    lib._refresh_queued_items()  # the rest is fetched by the next pull
+    assert len(lib._itemkeys_for_refresh) == 0
+
+
+def test_concurrent_batches_error(zoteromock):
+    lib = zoteromock
+    lib.fetch_threads = 4
+    lib.FetchBatchSize = 5
+    lib._queue_pull()
+    record, fetch, recieve = concurrent_fetch_recorder(lib)
+    calls = []
+    lock = threading.Lock()
+
+    def failing_fetch(keys):
+        with lock:
+            calls.append(keys)
+            fail = len(calls) == 4
+        if (fail):
+            record["failed"] = keys
+            raise RuntimeError("connection reset")
+        return fetch(keys)
+    with pytest.raises(RuntimeError):
+        lib._refresh_queued_concurrent(lib._itemkeys_for_refresh, failing_fetch, recieve, "item")
+    applied = set(record["applied"])
+    assert len(applied) <= 15  # only batches requested before the failed one
+    assert applied.isdisjoint(lib._itemkeys_for_refresh)
+    assert set(record["failed"].split(",")) <= lib._itemkeys_for_refresh
+    assert len(applied) + len(lib._itemkeys_for_refresh) == 50
+
+
+class RacyPyzotero(MockPyzotero):
+    """Keeps the parameters of a request on the instance between building and sending it, like pyzotero"""
+
+    def items(self, limit=50, itemKey=None, **kwargs):
+        self.url_params = itemKey
+        time.sleep(0.005)
+        return super().items(limit=limit, itemKey=self.url_params, **kwargs)
+
+
+def test_concurrent_fetch_server_connection():
+    conn = zoterosync.library.ServerConnection(57867, "user", "")
+    conn._zotero = RacyPyzotero(item_data, collection_data)  # as created by the first request of a pull
+    lib = zoterosync.library.ZoteroLibrary(conn)
+    assert copy.copy(conn)._zotero is not conn._zotero
+    lib.fetch_threads = 4
+    lib.FetchBatchSize = 5
+    lib._queue_pull()
+    queued = set(lib._itemkeys_for_refresh)
+    lib._process_pull()
+    assert len(lib._itemkeys_for_refresh) == 0
+    assert queued <= set(lib._objects_by_key)
+
+
+def test_fetch_batch_size_capped(zoteromock):
+    lib = zoteromock
+    lib.FetchBatchSize = 60  # the mock, like the API, refuses more than 50 keys per request
+    lib._queue_pull()
+    lib._itemkeys_for_refresh.update("GONE{}".format(i) for i in range(10))  # deleted on the server meanwhile
+    sizes = []
+    fetch = lib._fetch_items
+    lib._fetch_items = lambda keys: (sizes.append(len(keys.split(","))), fetch(keys))[1]
+    lib._refresh_queued_items()
+    assert sorted(sizes) == [10, 50]
+    assert lib._itemkeys_for_refresh == {"GONE{}".format(i) for i in range(10)}
+
+
+def test_bootstrap_pull_resume(zoteromock):
+    lib = zoteromock
+    serial = zoterosync.library.ZoteroLibrary(lib._server)
+    serial._queue_pull()
+    serial._process_pull()
+    lib.BootstrapPageSize = 20
+    assert lib.bootstrapping
+    lib.abort = True
+    with pytest.raises(zoterosync.library.EarlyExit):
+        lib.pull()
+    assert lib._bootstrap_start == 20
+    assert lib.bootstrapping
+    lib.pull()
+    assert not lib.bootstrapping
+    assert lib._bootstrap_start is None
+    assert len(lib._itemkeys_for_refresh) == 0
+    assert set(lib._objects_by_key) == set(serial._objects_by_key)
+    assert lib._version == serial._version
+
+
+def test_pull_journal_resume(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.journal_path = tmp_path.joinpath('library.journal')
+    lib.BootstrapPageSize = 20
+    lib.abort = True
+    with pytest.raises(zoterosync.library.EarlyExit):
+        lib.pull()
+    assert lib.journal_path.exists()
+    # crash: nothing was saved so start again from an empty library and the journal
+    resumed = zoterosync.library.ZoteroLibrary(lib._server)
+    resumed.journal_path = lib.journal_path
+    resumed.BootstrapPageSize = 20
+
+    def no_requeue(**kwargs):
+        raise AssertionError("pull should resume from the journal")
+    resumed._server = copy.copy(lib._server)
+    resumed._server.collection_versions = no_requeue
+    resumed._server.item_versions = no_requeue
+    assert resumed._replay_journal()
+    assert resumed._bootstrap_start == 20
+    assert len(resumed._collkeys_for_refresh) == 20
+    assert resumed.num_items >= 20
+    resumed.pull()
+    assert resumed._version == lib._server.version
+    assert len(resumed._itemkeys_for_refresh) == 0
+    assert len(resumed._collkeys_for_refresh) == 0
+    resumed.truncate_journal()
+    assert not resumed.journal_path.exists()
+
+
+def test_compact_objects(zoteromock):
+    lib = zoteromock
+    lib.pull()
+    for obj in lib._objects_by_key.values():
+        assert not hasattr(obj, "__dict__")
+    leaf = next(a for a in lib.attachments if not a.children and not a.collections)
+    assert leaf._children is zoterosync.library.NoObjects
+    assert leaf._collections is zoterosync.library.NoObjects
+    assert leaf._changed_from is zoterosync.library.NoChanges
+    leaf.title = "Changed Locally"
+    assert leaf._changed_from is not zoterosync.library.NoChanges
+    assert "title" in leaf._changed_from
+    doc = next(d for d in lib.documents if d.children)
+    keys = [k for d in lib.documents for k in d._data]
+    assert all(k is sys.intern(k) for k in keys)
+    child = next(iter(doc.children))
+    del child.parent
+    assert child not in doc.children
+
+
+def test_field_columns(zoteromock):
+    lib = zoteromock
+    lib.enable_columns()
+    lib.pull()
+    columns = lib.columns
+    rows = columns.rows(zoterosync.library.ZoteroDocument)
+    assert {o.key for o in columns.objects_at(rows, lib)} == {d.key for d in lib.documents}
+    for obj in lib.attachments:
+        assert columns.value(obj, "title") == obj["title"]
+        assert columns.value(obj, "itemType") == "attachment"
+    doc = next(d for d in lib.documents if d.version > 0)
+    doc.title = "Columnar Title"
+    columns = lib.columns
+    assert columns.value(doc, "title") == "Columnar Title"
+    assert columns.value(doc, "dirty")
+    matched = columns.filter(rows, "title", lambda t: t == "Columnar Title")
+    assert list(columns.objects_at(matched, lib)) == [doc]
+    doc.delete()
+    assert doc not in set(lib.columns.objects_at(lib.columns.rows(zoterosync.library.ZoteroItem), lib))
+
+
+def test_prefetch_hashes(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    linked = [a for a in lib.attachments if isinstance(a, zoterosync.library.ZoteroLinkedFile)][:3]
+    for i, attach in enumerate(linked):
+        f = tmp_path.joinpath('file{}.pdf'.format(i))
+        f.write_bytes(b"same contents" if i < 2 else b"other contents")
+        attach._data['path'] = str(f)
+    assert lib.prefetch_hashes(linked, threads=2) == 3
+    same = hashlib.md5(b"same contents").hexdigest()
+    assert [a._md5 for a in linked[:2]] == [same, same]
+    assert lib._attachments_by_md5s[same] == set(linked[:2])
+    assert lib._attachments_by_md5s[linked[2]._md5] == {linked[2]}
+    assert lib.prefetch_hashes(linked) == 0
+
+
+def test_remove_dup_child_files(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    doc = next(d for d in lib.documents if d.children)
+    children = []
+    for i in range(3):
+        f = tmp_path.joinpath('file{}.pdf'.format(i))
+        f.write_bytes(b"same contents" if i < 2 else b"different contents")
+        data = copy.deepcopy(linked_file_simp)
+        data['data'].update(key='DUPFILE{}'.format(i), parentItem=doc.key, path=str(f))
+        children.append(zoterosync.library.ZoteroObject.factory(lib, data))
+    groups = lib.file_groups(children)
+    assert sorted(len(g) for g in groups) == [1, 2]
+    doc.remove_dup_child_files()
+    assert sum(a.deleted for a in children[:2]) == 1
+    assert not children[2].deleted
+
+
+def test_duplicate_attachments(zoteromock, tmp_path):
+    lib = zoteromock
+    lib.pull()
+    doc, other = [d for d in lib.documents if d.children][:2]
+    attachments = []
+    for i, parent in enumerate([doc, doc, other, False]):
+        f = tmp_path.joinpath('file{}.pdf'.format(i))
+        f.write_bytes(b"same contents")
+        data = copy.deepcopy(linked_file_simp)
+        data['data'].update(key='DUPFILE{}'.format(i), parentItem=parent and parent.key, path=str(f))
+        attachments.append(zoterosync.library.ZoteroObject.factory(lib, data))
+    assert any(set(attachments) <= g for g in lib.duplicate_attachments())
+    removed = set().union(*(r for kept, r in lib.duplicate_attachment_removals() if kept in attachments))
+    assert attachments[3] in removed
+    assert len(removed & set(attachments[:2])) == 1
+    assert attachments[2] not in removed
+
+
+def test_query_index(zoteromock):
+    lib = zoteromock
+    lib.pull()
+    items = set(lib.documents) | set(lib.attachments)
+    doc = next(d for d in lib.documents if d.tags and d.collections and d.creators and len(d.title) > 8)
+    creator = doc.creators[0]
+    queries = [dict(tags=re.escape(sorted(doc.tags)[0])), dict(itemType=doc["itemType"]), dict(key=doc.key[:3]),
+               dict(creators=re.escape(creator.type + "\n" + creator.firstname)),
+               dict(collections=re.escape(next(iter(doc.collections)).name)),
+               dict(title=".*" + re.escape(doc.title[1:7])), dict(title="(?i)" + re.escape(doc.title.upper())),
+               dict(itemType="attachment", title="[a-z].*pdf"), dict(tags=".*")]
+
+    def check():
+        for regexps in queries:
+            keys, remaining = lib.query_index.resolve(lib, regexps)
+            candidates = items if keys is None else {lib.get_obj_by_key(k) for k in keys}
+            expected = {i for i in items if all(field_matches(i, f, re.compile(p)) for f, p in regexps.items())}
+            assert {i for i in candidates if all(field_matches(i, f, re.compile(p)) for f, p in remaining.items())} == expected
+        assert lib.query_index.resolve(lib, dict(tags=".*"))[0] is None
+
+    check()
+    assert doc.key in lib.query_index.resolve(lib, queries[0])[0]
+    assert set(lib.query_index._indexes) >= {"tags", "title", "collections"}
+    doc.title = "A Freshly Indexed Title"
+    doc.tags = {"freshtag"}
+    queries.extend([dict(title="A Fresh"), dict(tags="fresh")])
+    check()
+    assert lib.query_index.resolve(lib, dict(tags="fresh"))[0] == {doc.key}
+    assert lib.query_index.resolve(lib, dict(title="A Fresh")) == ({doc.key}, dict(title="A Fresh"))
+    doc.delete()
+    items = set(lib.documents) | set(lib.attachments)
+    check()
+    assert not lib.query_index.resolve(lib, dict(tags="fresh"))[0]
@@ -0,0 +1,115 @@
+import array
+import logging
+
+logger = logging.getLogger('zoterosync.columns')
+
+
+def subclasses(cls):
+    yield cls
+    for sub in cls.__subclasses__():
+        yield from subclasses(sub)
+
+
+class FieldColumns(object):
+    """Columnar copy of the hot fields of every item in a library, one row per item ordinal.
+
+       Library wide scans (filtering, sorting, bucketing by title) read these per field arrays instead of going
+       through each object's __getitem__.  Rows of a lazily loaded library are filled straight from the
+       database so scanning never hydrates an item that doesn't match.  Rows are refreshed lazily: the library
+       reports every touched object through invalidate and sync re-reads just those before a scan.
+    """
+
+    Fields = ("key", "version", "itemType", "title", "date", "dirty")
+
+    def __init__(self):
+        self._ordinals = dict()
+        self._stale = set()
+        self.objects = []  # the resident object for each row or None
+        self.kinds = []
+        self.live = bytearray()  # cleared once the item is removed from the library
+        self.columns = dict(key=[], version=array.array('q'), itemType=[], title=[], date=[], dirty=bytearray())
+
+    def __len__(self):
+        return len(self.objects)
+
+    def _append(self, key, kind):
+        ordinal = len(self.objects)
+        self._ordinals[key] = ordinal
+        self.objects.append(None)
+        self.kinds.append(kind)
+        self.live.append(1)
+        self.columns["key"].append(key)
+        self.columns["version"].append(-1)
+        self.columns["itemType"].append(None)
+        self.columns["title"].append('')
+        self.columns["date"].append(None)
+        self.columns["dirty"].append(0)
+        return ordinal
+
+    def add(self, obj):
+        """Called when an item is constructed (or hydrated again) and takes over the row for its key"""
+        ordinal = self._ordinals.get(obj.key)
+        if (ordinal is None):
+            ordinal = self._append(obj.key, type(obj))
+        self.objects[ordinal] = obj
+        self.kinds[ordinal] = type(obj)
+        self._stale.add(obj)
+
+    def add_row(self, key, kind, version, item_type, title, date):
+        """A clean item that is not resident"""
+        ordinal = self._append(key, kind)
+        self.columns["version"][ordinal] = version
+        self.columns["itemType"][ordinal] = item_type
+        self.columns["title"][ordinal] = title
+        self.columns["date"][ordinal] = date
+
+    def invalidate(self, obj):
+        self._stale.add(obj)
+
+    def release(self, obj):
+        """obj was evicted; its row stays valid as only clean objects are evicted"""
+        ordinal = self._ordinals.get(obj.key)
+        if (ordinal is not None and self.objects[ordinal] is obj):
+            self.objects[ordinal] = None
+            self._stale.discard(obj)
+
+    def sync(self, library):
+        for obj in self._stale:
+            ordinal = self._ordinals.get(obj.key)
+            if (ordinal is None or self.objects[ordinal] is not obj):
+                continue
+            self.columns["version"][ordinal] = obj.version
+            self.columns["itemType"][ordinal] = obj["itemType"]
+            self.columns["title"][ordinal] = obj["title"]
+            self.columns["date"][ordinal] = obj["date"]
+            self.columns["dirty"][ordinal] = obj.dirty
+            self.live[ordinal] = library._holds(obj)
+        self._stale = set()
+
+    def rows(self, kind):
+        """Ordinals of the live items that are instances of kind"""
+        kinds = set(subclasses(kind))
+        return [i for i, k in enumerate(self.kinds) if self.live[i] and k in kinds]
+
+    def rows_of(self, keys, kind):
+        """Ordinals of the live items with keys that are instances of kind"""
+        kinds = set(subclasses(kind))
+        rows = (self._ordinals.get(key) for key in keys)
+        return [i for i in rows if i is not None and self.live[i] and self.kinds[i] in kinds]
+
+    def filter(self, rows, field, predicate):
+        column = self.columns[field]
+        return [i for i in rows if predicate(column[i])]
+
+    def sort(self, rows, field, reverse=False):
+        column = self.columns[field]
+        return sorted(rows, key=lambda i: column[i], reverse=reverse)
+
+    def value(self, obj, field):
+        return self.columns[field][self._ordinals[obj.key]]
+
+    def objects_at(self, rows, library):
+        """The items at rows, hydrating the ones that aren't resident"""
+        for i in rows:
+            obj = self.objects[i]
+            yield obj if obj is not None else library.get_obj_by_key(self.columns["key"][i])
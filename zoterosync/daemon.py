@@ -0,0 +1,223 @@
+import io
+import os
+import json
+import base64
+import time
+import socket
+import logging
+import traceback
+import contextlib
+import click
+
+logger = logging.getLogger('zoterosync.daemon')
+
+
+IdleFlush = 30.0  # seconds without a request after which deferred writes are flushed
+
+
+def socket_path(conf_path):
+    """The Unix domain socket of the daemon serving the library of the config at conf_path"""
+    return conf_path.with_name(conf_path.name + ".sock")
+
+
+def connect(path):
+    """A socket connected to the daemon listening on path, None if no daemon is running there"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def running(path):
+    sock = connect(path)
+    if (sock is None):
+        return False
+    sock.close()
+    return True
+
+
+def request(path, message, stdout, stderr):
+    """Sends message to the daemon listening on path and copies the output of the command to stdout and stderr as
+       it arrives.  Returns the exit status of the command or None if no daemon is running."""
+    sock = connect(path)
+    if (sock is None):
+        return None
+    with sock, sock.makefile("rw", encoding="utf8") as conn:
+        conn.write(json.dumps(message) + "\n")
+        conn.flush()
+        for line in conn:
+            reply = json.loads(line)
+            if ("out" in reply):
+                stdout.write(reply["out"])
+                stdout.flush()
+            elif ("bytes" in reply):
+                stdout.flush()
+                stdout.buffer.write(base64.b64decode(reply["bytes"]))
+                stdout.buffer.flush()
+            elif ("err" in reply):
+                stderr.write(reply["err"])
+                stderr.flush()
+            elif ("exit" in reply):
+                return reply["exit"]
+    return 1  # the daemon went away in the middle of the command
+
+
+class _BinaryChannel(io.RawIOBase):
+    """The buffer of the stdout _Channel, sending bytes (arrow and parquet exports) as base64 {"bytes": data}
+       messages"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        if (data):
+            self._conn.write(json.dumps(dict(bytes=base64.b64encode(data).decode("ascii"))) + "\n")
+            self._conn.flush()
+            self._written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._written
+
+
+class _Channel(io.TextIOBase):
+    """Text stream sending what's written to it to the client as {name: text} messages"""
+
+    def __init__(self, conn, name):
+        self._conn = conn
+        self._name = name
+        if (name == "out"):
+            self.buffer = _BinaryChannel(conn)
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if (not isinstance(text, str)):
+            raise TypeError("write() argument must be str, not " + type(text).__name__)
+        if (text):
+            self._conn.write(json.dumps({self._name: text}) + "\n")
+            self._conn.flush()
+        return len(text)
+
+
+class LibraryDaemon(object):
+    """Keeps one loaded ZoteroLibraryStore in memory and runs the CLI commands sent to its Unix domain socket
+       against it, one at a time, so a shell loop over zotero commands doesn't load the library on every call.
+
+       A request is a JSON line {"args": [...], "cwd": ..., "color": ...} and is answered with {"out": text},
+       {"bytes": base64} (binary stdout) and {"err": text} lines as the command writes and a final
+       {"exit": status}; {"stop": true} shuts the daemon down.  Writes of the library are deferred and flushed
+       once no request came in for idle_flush seconds, and on shutdown.  The steps of a SyncScheduler, if given, run in between requests.
+    """
+
+    def __init__(self, store, command, path, idle_flush=IdleFlush, scheduler=None):
+        self.store = store
+        self.command = command  # the click group of the CLI
+        self.path = path
+        self.idle_flush = idle_flush
+        self.scheduler = scheduler
+        self.running = False
+        self._last_request = time.monotonic()
+
+    def _timeout(self):
+        """Seconds to wait for a request before the next flush or sync step is due, None for no limit"""
+        timeouts = []
+        if (self.idle_flush):
+            idle = time.monotonic() - self._last_request if self.store.write_pending else 0
+            timeouts.append(self.idle_flush - idle)
+        if (self.scheduler is not None):
+            timeouts.append(self.scheduler.timeout())
+        return max(min(timeouts), 0.01) if timeouts else None
+
+    def _sync(self):
+        if (self.scheduler is not None and self.scheduler.due()):
+            self.scheduler.step()
+
+    def _idle(self):
+        self._sync()
+        if (self.idle_flush and time.monotonic() - self._last_request >= self.idle_flush):
+            self.store.flush()
+
+    def serve(self):
+        if (self.path.exists()):
+            self.path.unlink()  # left behind by a daemon that didn't shut down cleanly
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(self.path))
+        server.listen()
+        self.store.served = True
+        self.store.scheduler = self.scheduler
+        self.store.library.checkpoint_function = self.store.checkpoint
+        self.running = True
+        logger.info("Serving %s on %s", self.store.library_path, self.path)
+        try:
+            while self.running:
+                server.settimeout(self._timeout())
+                try:
+                    conn, addr = server.accept()
+                except socket.timeout:
+                    self._idle()
+                    continue
+                with conn:
+                    try:
+                        self.handle(conn)
+                    except OSError as e:
+                        logger.warning("Lost the client of a request: %s", e)
+                self._last_request = time.monotonic()
+                self._sync()  # not only when idle, a busy daemon still syncs
+        finally:
+            server.close()
+            self.path.unlink()
+            self.store.flush()
+            self.store.served = False
+            self.store.scheduler = None
+            self.store.library.checkpoint_function = self.store.write_library
+            logger.info("Stopped serving %s", self.store.library_path)
+
+    def handle(self, conn):
+        conn.settimeout(None)
+        with conn.makefile("rw", encoding="utf8") as stream:
+            line = stream.readline()
+            if (not line):  # just checking the daemon is running
+                return
+            message = json.loads(line)
+            if (message.get("stop")):
+                self.running = False
+                status = 0
+            else:
+                status = self.run(message, stream)
+            stream.write(json.dumps(dict(exit=status)) + "\n")
+
+    def run(self, message, stream):
+        """Runs the command in message with its output going to stream, returning its exit status"""
+        cwd = os.getcwd()
+        self.store.force = False
+        out, err = _Channel(stream, "out"), _Channel(stream, "err")
+        try:
+            os.chdir(message.get("cwd", cwd))
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                status = self.command.main(args=message.get("args", []), obj=self.store, standalone_mode=False,
+                                           color=message.get("color"), prog_name="zotero")
+                return status if isinstance(status, int) else 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except click.ClickException as e:
+            e.show(file=err)
+            return e.exit_code
+        except click.Abort:
+            err.write("Aborted!\n")
+            return 1
+        except Exception:
+            logger.exception("Command %s failed", message.get("args"))
+            err.write(traceback.format_exc())
+            return 1
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,164 @@
+import sqlite3
+import json
+import logging
+from zoterosync.library import ZoteroObject
+from zoterosync.library import ZoteroCollection
+
+logger = logging.getLogger('zoterosync.database')
+
+
+class LibraryDatabase(object):
+    """Stores a ZoteroLibrary in an sqlite file with one row per object so a checkpoint only rewrites the
+       objects touched since the last one rather than pickling the whole library.
+
+       Each row also records the object's family (the key of the document an attachment belongs to, otherwise
+       its own key) and whether it carries local changes, so a library can be read lazily: collections and
+       families with local changes are loaded, everything else is hydrated family by family on access.
+       The item fields kept in FieldColumns are stored in their own columns so those can be filled without
+       decoding any state.
+    """
+
+    Columns = ["key", "kind", "family", "version", "pending", "item_type", "title", "date", "state"]
+
+    Magic = b"SQLite format 3\x00"
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @classmethod
+    def is_database(cls, path):
+        try:
+            with path.open(mode='rb') as lib_file:
+                return lib_file.read(len(cls.Magic)) == cls.Magic
+        except (IOError, FileNotFoundError, PermissionError):
+            return False
+
+    def _connect(self):
+        if (self._conn is None):
+            conn = sqlite3.connect(str(self.path))
+            columns = [r[1] for r in conn.execute("PRAGMA table_info(objects)")]
+            outdated = columns and columns != self.Columns
+            with conn:
+                if (outdated):
+                    conn.execute("ALTER TABLE objects RENAME TO old_objects")
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY, state TEXT NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, kind TEXT NOT NULL, family TEXT NOT NULL, "
+                             "version INTEGER NOT NULL, pending INTEGER NOT NULL, item_type TEXT, title TEXT, date TEXT, "
+                             "state TEXT NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS objects_family ON objects (family)")
+                conn.execute("CREATE TABLE IF NOT EXISTS memberships (collection TEXT NOT NULL, key TEXT NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS memberships_collection ON memberships (collection)")
+                conn.execute("CREATE INDEX IF NOT EXISTS memberships_key ON memberships (key)")
+            if (outdated):
+                # databases written by older versions lack some of the derived columns
+                logger.info("Upgrading library database %s", self.path)
+                rows = conn.execute("SELECT key, state FROM old_objects").fetchall()
+                self._write_rows(conn, [(key, json.loads(state)) for key, state in rows])
+                with conn:
+                    conn.execute("DROP TABLE old_objects")
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if (self._conn is not None):
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def _kind_rank(cls_name):
+        if (cls_name == "ZoteroCollection"):
+            return 0
+        elif (cls_name == "ZoteroDocument"):
+            return 1
+        else:
+            return 2
+
+    @staticmethod
+    def _family(key, state):
+        parent = state["data"].get("parentItem")
+        return parent if (state["cls"] != "ZoteroCollection" and parent and parent != "false") else key
+
+    @staticmethod
+    def _pending(state):
+        return bool(state["dirty"] or state["new"] or state["deleted"] or state["removed"] or
+                    state.get("upload_queued") or state.get("download_queued"))
+
+    def _write_rows(self, conn, states, full=False, meta=None):
+        with conn:
+            if (full):
+                conn.execute("DELETE FROM objects")
+                conn.execute("DELETE FROM memberships")
+            if (meta is not None):
+                conn.execute("REPLACE INTO meta (id, state) VALUES (0, ?)", (json.dumps(meta),))
+            conn.executemany("REPLACE INTO objects (" + ", ".join(self.Columns) + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             ((key, state["cls"], self._family(key, state), state["data"]["version"],
+                               self._pending(state), state["data"].get("itemType"),
+                               state["data"].get("title", ''), state["data"].get("date"), json.dumps(state))
+                              for key, state in states))
+            conn.executemany("DELETE FROM memberships WHERE key = ?", ((key,) for key, state in states))
+            conn.executemany("INSERT INTO memberships (collection, key) VALUES (?, ?)",
+                             ((ckey, key) for key, state in states if not state["removed"]
+                              for ckey in state["data"].get("collections", [])))
+
+    def write(self, library, full=False, saved=True):
+        """Writes library meta data plus every object touched since the last write (all objects if full)
+           in a single transaction.  Returns the number of object rows written.  A copy of the library
+           (saved False) leaves its unsaved objects for the next write of its own database."""
+        if (full):
+            library.materialize()
+        objs = list(library._objects_by_key.values()) if full else list(library.unsaved_objects)
+        states = [(obj.key, obj._persistent_state()) for obj in objs]
+        self._write_rows(self._connect(), states, full=full, meta=library._persistent_meta())
+        if (saved):
+            library.mark_saved()
+        logger.debug("Wrote %s objects to %s (full=%s)", len(states), self.path, full)
+        return len(states)
+
+    def _states(self, rows):
+        states = [json.loads(r[0]) for r in rows]
+        states.sort(key=lambda s: self._kind_rank(s["cls"]))
+        return states
+
+    def read(self, library, lazy=False, cache_size=None):
+        """Restores the library state stored in the database into library (normally freshly constructed).
+           If lazy only collections and families with local changes are loaded, see ZoteroLibrary._attach_store"""
+        conn = self._connect()
+        meta = conn.execute("SELECT state FROM meta WHERE id = 0").fetchone()
+        if (meta is not None):
+            library._restore_meta(json.loads(meta[0]))
+        if (not lazy):
+            library._restore_objects(self._states(conn.execute("SELECT state FROM objects")))
+            library.mark_saved()
+            logger.debug("Read %s objects from %s", len(library._objects_by_key), self.path)
+            return library
+        eager = "kind = 'ZoteroCollection' OR family IN (SELECT family FROM objects WHERE pending)"
+        library._restore_objects(self._states(conn.execute("SELECT state FROM objects WHERE " + eager)))
+        library.mark_saved()
+        for (family,) in conn.execute("SELECT DISTINCT family FROM objects WHERE kind != 'ZoteroCollection' AND (" +
+                                      eager + ")"):
+            library._resident[family] = True
+        index = dict()
+        for key, kind, version, item_type, title, date in conn.execute(
+                "SELECT key, kind, version, item_type, title, date FROM objects WHERE NOT (" + eager + ")"):
+            kind = ZoteroObject.subclass_named(kind)
+            index[key] = (kind, version)
+            if (library._columns is not None and kind is not ZoteroCollection):
+                library._columns.add_row(key, kind, version, item_type, title, date)
+        library._attach_store(self, index, cache_size=cache_size)
+        logger.debug("Read %s objects from %s, %s left on disk", len(library._objects_by_key), self.path, len(index))
+        return library
+
+    def read_family(self, key):
+        """Returns (family, states) for the family the object with key belongs to"""
+        conn = self._connect()
+        (family,) = conn.execute("SELECT family FROM objects WHERE key = ?", (key,)).fetchone()
+        return family, self._states(conn.execute("SELECT state FROM objects WHERE family = ?", (family,)))
+
+    def read_objects(self, keys):
+        keys = set(keys)
+        rows = self._connect().execute("SELECT key, state FROM objects")
+        return self._states(r[1:] for r in rows if r[0] in keys)
+
+    def member_keys(self, ckey):
+        return [r[0] for r in self._connect().execute("SELECT key FROM memberships WHERE collection = ?", (ckey,))]
@@ -0,0 +1,100 @@
+import re
+import logging
+
+logger = logging.getLogger('zoterosync.duplicates')
+
+
+def name_key(title):
+    """A title casefolded with file extensions and everything but word characters removed"""
+    result = re.sub('\.(pdf|ps|djvu?|webarchive|html?|mobi|ebook)', '', (title or '').casefold())
+    result = re.sub('\W', '', result)
+    return result
+
+
+class DuplicateIndex(object):
+    """Documents bucketed by the name_key of their title, kept up to date as the library changes so a dedup run
+       doesn't have to rebuild the buckets from every document.
+
+       The library reports every touched document through invalidate and sync brings the index up to date
+       lazily.  The name keys that gained a document since the last dedup run are collected in pending, which is
+       saved with the library meta data, so the next run only examines those buckets.  The buckets themselves
+       are rebuilt from the FieldColumns titles (or the documents) the first time they're needed after a load.
+    """
+
+    MinKeyLength = 4
+
+    def __init__(self, kind):
+        self.kind = kind  # the class of the objects indexed
+        self._buckets = None  # name key -> set of document keys
+        self._names = dict()  # document key -> name key
+        self._stale = set()
+        self.pending = set()
+        self.examined = False  # whether a dedup run has gone over every bucket
+
+    def invalidate(self, doc):
+        self._stale.add(doc)
+
+    def forget(self, objs):
+        """objs were restored from a checkpoint rather than changed"""
+        self._stale.difference_update(objs)
+
+    def _add(self, key, name):
+        self._names[key] = name
+        self._buckets.setdefault(name, set()).add(key)
+
+    def _discard(self, key):
+        name = self._names.pop(key, None)
+        if (name is not None):
+            bucket = self._buckets[name]
+            bucket.discard(key)
+            if (not bucket):
+                del self._buckets[name]
+
+    def _build(self, library):
+        self._buckets = dict()
+        self._names = dict()
+        columns = library.columns
+        if (columns is not None):
+            titled = ((columns.columns["key"][r], columns.columns["title"][r]) for r in columns.rows(self.kind))
+        else:
+            titled = ((d.key, d.title) for d in library.documents if isinstance(d, self.kind))
+        for key, title in titled:
+            name = name_key(title)
+            if (len(name) >= self.MinKeyLength):
+                self._add(key, name)
+        logger.debug("Built duplicate index with %s buckets", len(self._buckets))
+
+    def sync(self, library, build=True):
+        """Applies the documents touched since the last sync.  The buckets are only built if build"""
+        if (build and self._buckets is None):
+            self._build(library)
+        for doc in self._stale:
+            if (self._buckets is not None):
+                self._discard(doc.key)
+            name = name_key(doc.title)
+            if (library._holds(doc) and len(name) >= self.MinKeyLength):
+                self.pending.add(name)
+                if (self._buckets is not None):
+                    self._add(doc.key, name)
+        self._stale = set()
+
+    def candidates(self, library):
+        """(names, buckets): the name keys a dedup run has to examine, everything if no run has been completed,
+           and the buckets among those holding more than one document"""
+        self.sync(library)
+        names = set(self.pending) if self.examined else set(self._buckets)
+        return names, {name: set(self._buckets[name]) for name in names if len(self._buckets.get(name, ())) > 1}
+
+    def mark_examined(self, names):
+        self.pending.difference_update(names)
+        self.examined = True
+
+    def persistent_state(self, library):
+        self.sync(library, build=False)
+        return dict(pending=sorted(self.pending), examined=self.examined)
+
+    def restore_state(self, state):
+        self._buckets = None
+        self._names = dict()
+        self.pending = set(state.get("pending", []))
+        self.examined = state.get("examined", False)
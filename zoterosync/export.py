@@ -0,0 +1,114 @@
+import csv
+import json
+import logging
+from zoterosync.lazy import lazy_import
+from zoterosync.library import ZoteroCollection
+try:
+    pyarrow = lazy_import("pyarrow")
+except ImportError:  # only needed for the arrow and parquet formats
+    pyarrow = None
+
+logger = logging.getLogger('zoterosync.export')
+
+
+Formats = ("jsonl", "csv", "arrow", "parquet")
+Binary = ("arrow", "parquet")
+BatchSize = 10000
+
+ItemFields = ["key", "version", "itemType", "parentItem", "linkMode", "dateAdded", "dateModified"]
+AttachmentFields = ["contentType", "charset", "filename", "path", "md5", "mtime", "note"]
+CollectionFields = ["key", "version", "name", "parentCollection", "relations"]
+
+
+def export_fields(library, kind):
+    """The columns of a csv, arrow or parquet export of objects of kind, fields of the Zotero data outside of
+       these are only kept by jsonl"""
+    if (issubclass(kind, ZoteroCollection)):
+        return list(CollectionFields)
+    stored = [f for f in library.special_fields if f != "children"]
+    return list(dict.fromkeys(ItemFields + list(library.all_item_fields) + AttachmentFields + stored))
+
+
+def cell(value):
+    """A field value as a single string, lists and dicts (creators, tags, ...) as JSON"""
+    if (value is None or isinstance(value, str)):
+        return value
+    elif (isinstance(value, (list, dict))):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def _batches(objs, size=BatchSize):
+    batch = []
+    for obj in objs:
+        batch.append(obj._export_data())
+        if (len(batch) == size):
+            yield batch
+            batch = []
+    if (batch):
+        yield batch
+
+
+def write_jsonl(objs, stream, fields=None):
+    count = 0
+    for batch in _batches(objs):
+        stream.writelines(json.dumps(data, ensure_ascii=False) + "\n" for data in batch)
+        count += len(batch)
+    return count
+
+
+def write_csv(objs, stream, fields):
+    writer = csv.writer(stream, lineterminator="\n")
+    writer.writerow(fields)
+    count = 0
+    for batch in _batches(objs):
+        writer.writerows([cell(data.get(f)) for f in fields] for data in batch)
+        count += len(batch)
+    return count
+
+
+def _arrow_schema(fields):
+    return pyarrow.schema([(f, pyarrow.int64() if f == "version" else pyarrow.string()) for f in fields])
+
+
+def _record_batches(objs, schema):
+    for batch in _batches(objs):
+        arrays = [pyarrow.array([data.get(f.name) if f.name == "version" else cell(data.get(f.name)) for data in batch],
+                                type=f.type) for f in schema]
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def write_arrow(objs, stream, fields):
+    schema = _arrow_schema(fields)
+    count = 0
+    with lazy_import("pyarrow.ipc").new_file(stream, schema) as writer:
+        for batch in _record_batches(objs, schema):
+            writer.write_batch(batch)
+            count += batch.num_rows
+    return count
+
+
+def write_parquet(objs, stream, fields):
+    schema = _arrow_schema(fields)
+    count = 0
+    with lazy_import("pyarrow.parquet").ParquetWriter(stream, schema) as writer:
+        for batch in _record_batches(objs, schema):
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+            count += batch.num_rows
+    return count
+
+
+Writers = dict(jsonl=write_jsonl, csv=write_csv, arrow=write_arrow, parquet=write_parquet)
+
+
+def available(fmt):
+    """Whether the libraries fmt needs are installed"""
+    return fmt not in Binary or pyarrow is not None
+
+
+def export_objects(objs, fmt, stream, fields):
+    """Streams the Zotero data of objs to stream (binary for the formats in Binary) in batches, returning the
+       number of objects written"""
+    count = Writers[fmt](objs, stream, fields)
+    logger.debug("Exported %s objects as %s", count, fmt)
+    return count
@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+from zoterosync.lazy import lazy_import
+
+filecmp = lazy_import("filecmp")
+
+logger = logging.getLogger('zoterosync.hashcache')
+
+
+BufferSize = 1 << 20
+BlockSize = 1 << 16
+
+
+def hash_file(path):
+    hash_md5 = hashlib.md5()
+    with path.open(mode="rb", buffering=0) as f:
+        for chunk in iter(lambda: f.read(BufferSize), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def partial_hash(path, size):
+    """md5 of the first and last BlockSize bytes of a file of the given size"""
+    hash_md5 = hashlib.md5()
+    with open(str(path), mode="rb", buffering=0) as f:
+        hash_md5.update(f.read(BlockSize))
+        if (size > 2 * BlockSize):
+            f.seek(size - BlockSize)
+            hash_md5.update(f.read(BlockSize))
+        elif (size > BlockSize):
+            hash_md5.update(f.read())
+    return hash_md5.hexdigest()
+
+
+def _split(groups, keyfunc):
+    """Regroups every group of more than one path by keyfunc, returning the groups still sharing a key"""
+    result = []
+    for group in groups:
+        buckets = dict()
+        for path in group:
+            buckets.setdefault(keyfunc(path), []).append(path)
+        result.extend(b for b in buckets.values() if len(b) > 1)
+    return result
+
+
+def file_digests(paths, full_hash, known=None, hash_all=False):
+    """Tiered duplicate detection.  Maps each of paths (existing regular files) to its full_hash, or to None
+       once it is proven that no other file in paths has the same contents.  Files are grouped by size, then
+       by partial_hash, and only files still sharing both are hashed in full, so a file with a unique size is
+       never read.  known maps paths to digests computed earlier, which are returned as is.  hash_all hashes
+       every file not in known, for callers that also compare against digests of files not available locally.
+    """
+    known = known if known is not None else dict()
+    digests = dict.fromkeys(paths)
+    if (hash_all):
+        pending = [p for p in digests if p not in known]
+    else:
+        sizes = dict()
+        for path in digests:
+            sizes[path] = os.stat(str(path)).st_size
+        groups = _split([list(digests)], sizes.get)
+        groups = _split(groups, lambda p: partial_hash(p, sizes[p]))
+        pending = [p for group in groups for p in group if p not in known]
+    for path in digests:
+        if (path in known):
+            digests[path] = known[path]
+    for path in pending:
+        digests[path] = full_hash(path)
+    return digests
+
+
+def same_contents(path, other):
+    """Whether two files have identical contents, reading them only if size and partial_hash match"""
+    size = os.stat(str(path)).st_size
+    if (size != os.stat(str(other)).st_size or partial_hash(path, size) != partial_hash(other, size)):
+        return False
+    return filecmp.cmp(str(path), str(other), shallow=False)
+
+
+class HashCache(object):
+    """md5 digests of files keyed by absolute path.  An entry is only used while the file's size, mtime and
+       inode match those recorded when it was hashed.  Entries live in memory unless open() is given an sqlite
+       file to keep them in across runs.  Safe to share between threads.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._memory = dict()
+        self._conn = None
+        self.path = None
+        self.hits = 0
+        self.misses = 0
+        if (path is not None):
+            self.open(path)
+
+    def open(self, path):
+        self.close()
+        conn = sqlite3.connect(str(path), check_same_thread=False)
+        conn.execute("PRAGMA synchronous = OFF")  # only a cache, losing recent entries just costs a rehash
+        conn.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                     "mtime INTEGER NOT NULL, inode INTEGER NOT NULL, md5 TEXT NOT NULL)")
+        self._conn = conn
+        self.path = path
+
+    def close(self):
+        if (self.hits or self.misses):
+            logger.info("md5 cache: %s hits, %s misses", self.hits, self.misses)
+        if (self._conn is not None):
+            self._conn.close()
+            self._conn = None
+            self.path = None
+
+    @staticmethod
+    def signature(stat):
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def _lookup(self, key, sig):
+        """The cached md5 if still current or None, counting the hit or miss (md5 runs on worker threads)"""
+        with self._lock:
+            if (self._conn is None):
+                entry = self._memory.get(key)
+            else:
+                row = self._conn.execute("SELECT size, mtime, inode, md5 FROM hashes WHERE path = ?", (key,)).fetchone()
+                entry = (tuple(row[:3]), row[3]) if row else None
+            if (entry is not None and entry[0] == sig):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def _store(self, key, sig, digest):
+        with self._lock:
+            if (self._conn is None):
+                self._memory[key] = (sig, digest)
+            else:
+                with self._conn:
+                    self._conn.execute("REPLACE INTO hashes (path, size, mtime, inode, md5) VALUES (?, ?, ?, ?, ?)",
+                                       (key,) + sig + (digest,))
+
+    def md5(self, path):
+        """md5 hexdigest of the file at path, hashing it only if the cached entry is missing or stale"""
+        key = os.path.abspath(str(path))
+        sig = self.signature(os.stat(key))
+        digest = self._lookup(key, sig)
+        if (digest is not None):
+            return digest
+        logger.debug("md5 cache miss for %s", key)
+        digest = hash_file(path)
+        self._store(key, sig, digest)
+        return digest
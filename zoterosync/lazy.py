@@ -0,0 +1,23 @@
+import sys
+import importlib.util
+
+
+def lazy_import(name):
+    """The module name, only executed once one of its attributes is first used, so the zotero command doesn't
+       import dependencies (pyzotero and its HTTP stack above all) for subcommands that never touch them.
+       Raises ImportError right away if name isn't installed.  Importing a submodule still imports its parent
+       package, which is cheap for everything loaded this way."""
+    module = sys.modules.get(name)
+    if (module is not None):
+        return module
+    spec = importlib.util.find_spec(name)
+    if (spec is None):
+        raise ModuleNotFoundError("No module named {!r}".format(name), name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    parent, _, child = name.rpartition(".")
+    if (parent):
+        setattr(sys.modules[parent], child, module)
+    return module
@@ -1,22 +1,36 @@
-from pyzotero import zotero
-from pyzotero.zotero_errors import PreConditionFailed
-from pyzotero.zotero_errors import PyZoteroError
+import os
 import re
+import json
 import random
 import copy
 import logging
 import datetime
-import dateutil.parser
 from functools import wraps
 import functools
 import itertools
-import editdistance
 from pathlib import Path
-from nameparser import HumanName
-import filecmp
-import hashlib
-import tempfile
 import shutil
+import sys
+import tempfile
+import types
+import weakref
+import collections
+import collections.abc
+import concurrent.futures
+from zoterosync.lazy import lazy_import
+from zoterosync.columns import FieldColumns
+from zoterosync.duplicates import DuplicateIndex
+from zoterosync.query import QueryIndex
+from zoterosync.hashcache import HashCache
+from zoterosync.hashcache import file_digests
+from zoterosync.hashcache import same_contents
+
+zotero = lazy_import("pyzotero.zotero")
+zotero_errors = lazy_import("pyzotero.zotero_errors")
+dateutil_parser = lazy_import("dateutil.parser")
+nameparser = lazy_import("nameparser")
+editdistance = lazy_import("editdistance")
+bsdiff4 = lazy_import("bsdiff4")
 
 # create logger
 logger = logging.getLogger('zoterosync.library')
@@ -31,12 +45,11 @@ logger = logging.getLogger('zoterosync.library')
 # for item in items:
 # print('Item: {0} | Key: {1}'.format(item['data']['itemType'], item['data']['key']))
 
+hash_cache = HashCache()
+
+
 def md5(path):
-    hash_md5 = hashlib.md5()
-    with path.open(mode="rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hash_cache.md5(path)
 
 
 def subclassfactory(fact_method):
@@ -130,21 +143,39 @@ class EarlyExit(Exception):
 
 
 class Person(object):
+    """A creator name.  People are immutable so the normalized forms comparisons need are computed on first use
+       and kept, and intern shares one Person per distinct name so that happens once per name."""
+
+    __slots__ = ("_lastname", "_firstname", "_last_key", "_first_token", "_initials_only", "_clean", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
 
     def __init__(self, last, first):
         self._lastname = last
         self._firstname = first
+        self._last_key = None
+        self._first_token = None
+        self._initials_only = None
+        self._clean = None
+
+    @classmethod
+    def intern(cls, last, first):
+        person = cls._interned.get((last, first))
+        if (person is None):
+            person = cls(last, first)
+            cls._interned[(last, first)] = person
+        return person
 
     @staticmethod
     def parsename(name):
-        parsed = HumanName(name)
+        parsed = nameparser.HumanName(name)
         parsed.capitalize()
         first = "{title} {first} {middle}".format(**parsed.as_dict()).strip()
         last = "{last} {suffix}".format(**parsed.as_dict()).strip()
         if (last == ""):
             last = first
             first = ""
-        return Person(last=last, first=first)
+        return Person.intern(last, first)
 
     @property
     def first(self):
@@ -162,41 +193,39 @@ class Person(object):
     def lastname(self):
         return self._lastname
 
+    @property
+    def last_key(self):
+        """The last name casefolded and without punctuation"""
+        if (self._last_key is None):
+            self._last_key = re.sub('[^\w\s]', '', self.lastname.strip().casefold())
+        return self._last_key
+
+    @property
+    def first_token(self):
+        """The first word of the cleaned first name, casefolded"""
+        if (self._first_token is None):
+            self._first_token = re.split('[\s.]', self.clean().firstname.casefold())[0]
+        return self._first_token
+
     def same(self, other):
-        norm_self_last = re.sub('[^\w\s]', '', self.lastname.strip().casefold())
-        norm_other_last = re.sub('[^\w\s]', '', other.lastname.strip().casefold())
-        if (norm_self_last == norm_other_last):
-            self_first = re.sub('[^\w\s.]', '', self.firstname.strip().casefold())
-            other_first = re.sub('[^\w\s.]', '', self.firstname.strip().casefold())
-            if (len(self_first) == 0 or len(other_first) == 0):
-                return True
-            self_first_start = re.split('[.\s]', self_first)[0]
-            other_first_start = re.split('[\.s]', other_first)[0]
-            if (len(self_first) == len(self_first_start) == 2 and self_first_start.isupper()):  # heuristic for initials e.g. PG Odifreddi
-                self_first_start = self_first_start[0]  # Skip 3 initials like WVO b/c too many names are 3 letters
-            if (len(other_first_start) == len(other_first) == 2 and other_first_start.isupper()):
-                other_first_start = other_first_start[0]
-            s = self_first_start.casefold()
-            o = other_first_start.casefold()
-            if (s.startswith(o) or o.startswith(s)):
-                return True
-        return False
+        # only the last names decide, differing first names are reconciled by merge
+        return self.last_key == other.last_key
 
     def first_initials_only(self):
         """Returns true if the firstname is only initials"""
-        if (re.match('\A(\s*\w([ .]|\Z)\s*\.?){1,3}\s*\Z', self.firstname.strip()) or re.match('\A\s*[A-Z]\s*[A-Z]\s*\.?\s*\Z', self.firstname.strip())):
-            return True
-        else:
-            return False
+        if (self._initials_only is None):
+            self._initials_only = bool(re.match('\A(\s*\w([ .]|\Z)\s*\.?){1,3}\s*\Z', self.firstname.strip()) or
+                                       re.match('\A\s*[A-Z]\s*[A-Z]\s*\.?\s*\Z', self.firstname.strip()))
+        return self._initials_only
 
     def distance(self, other):
         if (self.firstname == '' or other.firstname == ''):
             first_dis = 0
-        elif (self.first_initial_only() or other.first_initial_only()):
+        elif (self.first_initials_only() or other.first_initials_only()):
             first_dis = 0 if self.first_initial == other.first_initial else 1
         else:
-            self_clean_first = re.split('[\s.]', self.clean().firstname.casefold())[0]
-            other_clean_first = re.split('[\s.]', other.clean().firstname.casefold())[0]
+            self_clean_first = self.first_token
+            other_clean_first = other.first_token
             first_dis = editdistance.eval(self_clean_first, other_clean_first)/(min(len(self_clean_first), len(other_clean_first)))
         self_clean_last = self.clean().lastname.casefold()
         other_clean_last = other.clean().lastname.casefold()
@@ -204,6 +233,8 @@ class Person(object):
         return last_dis + first_dis
 
     def clean(self):
+        if (self._clean is not None):
+            return self._clean
         firstname = self.firstname
         lastname = self.lastname
         firstname = re.sub('[^\w.\s]', '', firstname.strip())
@@ -218,7 +249,8 @@ class Person(object):
         firstname = firstname.replace('..', '.')
         lastname = re.sub('[^\w\s]', '', lastname.strip())
         lastname = lastname.replace('  ', ' ')
-        return Person(last=lastname, first=firstname)
+        self._clean = Person.intern(lastname, firstname)
+        return self._clean
 
     @staticmethod
     def merge(*people):
@@ -299,11 +331,15 @@ class Creator(object):
             logger.debug("Creator built with name property")
             self._creator = Person.parsename(d["name"])
         else:
-            self._creator = Person(d.get('lastName', ""), d.get('firstName', ""))
+            self._creator = Person.intern(d.get('lastName', ""), d.get('firstName', ""))
 
     def __str__(self):
         return "<" + self._type + ": " + str(self._creator) + ">"
 
+    def filter_labels(self):
+        """The strings a filter on the creators of an item is tried on, see query.field_matches"""
+        return (self.type + "\n" + self.firstname + " " + self.lastname,)
+
     def __repr__(self):
         return repr(self.to_dict())
 
@@ -358,14 +394,44 @@ class Creator(object):
         return self.creator.first_initial_only()
 
 
+class ServerConnection(object):
+    """Stands in for the pyzotero Zotero server object of a library and only creates it (importing pyzotero and
+    its HTTP stack) on first use, so commands working on the local copy never load them.
+    """
+
+    def __init__(self, *args):
+        self._args = args
+        self._zotero = None
+
+    def __getattr__(self, name):
+        if (name.startswith("_")):  # also keeps pickle from creating the server
+            raise AttributeError(name)
+        if (self._zotero is None):
+            self._zotero = zotero.Zotero(*self._args)
+        return getattr(self._zotero, name)
+
+    def __copy__(self):
+        """A connection with its own copy of the server object, pyzotero keeps per request state on it (see
+        ZoteroLibrary._fetch_items)"""
+        conn = ServerConnection(*self._args)
+        if (self._zotero is not None):
+            conn._zotero = copy.copy(self._zotero)
+        return conn
+
+
 class ZoteroLibrary(object):
     """ Captures the cached library
     """
     AllowedKeyChars = "23456789ABCDEFGHIJKLMNPQRSTUVWXYZ"
+    BootstrapPageSize = 100
+    BootstrapCheckpointPages = 10
+    FetchBatchSize = 50  # keys per request for queued items and collections, capped at ApiKeyLimit
+    ApiKeyLimit = 50  # the most keys (and results) one itemKey or collectionKey request takes
+    DefaultCacheSize = 2000
 
     @staticmethod
     def factory(userid, apikey):
-        return ZoteroLibrary(zotero.Zotero(userid, "user", apikey))
+        return ZoteroLibrary(ServerConnection(userid, "user", apikey))
 
     def __init__(self, src):
         self._server = src
@@ -478,8 +544,13 @@ class ZoteroLibrary(object):
         self._collkeys_for_refresh = set()
         self._itemkeys_for_refresh = set()
         self._next_version = 0
+        self._bootstrap_start = None
+        self._bootstrap_version = None
+        self.journal_path = None
         self.abort = False
         self.force_update = False
+        self.fetch_threads = 1
+        self._pull_stats = self._empty_pull_stats()
         self.checkpoint_function = None
         self._revert = False
         self.datadir = None
@@ -487,8 +558,232 @@ class ZoteroLibrary(object):
         self.use_relative_paths = False
         self._downloads = set()
         self._uploads = set()
+        self._unsaved_objects = set()
+        self._store = None
+        self._lazy_index = dict()
+        self._lazy_counts = collections.Counter()  # class -> objects of it in _lazy_index
+        self._resident = collections.OrderedDict()
+        self.cache_size = None
+        self._columns = None
+        self._duplicates = DuplicateIndex(ZoteroDocument)
+        self._query = QueryIndex(ZoteroItem)
         logger.debug("Initialize ZoteroLibrary")
 
+    def __setstate__(self, state):
+        """Libraries pickled by older versions lack attributes added since so start from the defaults"""
+        self.__dict__.update(ZoteroLibrary(state["_server"]).__dict__)
+        self.__dict__.update(state)
+
+    def _touch(self, obj):
+        """Records that obj has state not yet written by the last checkpoint"""
+        self._unsaved_objects.add(obj)
+        if (self._columns is not None):
+            self._columns.invalidate(obj)
+        if (isinstance(obj, ZoteroDocument)):
+            self._duplicates.invalidate(obj)
+        if (isinstance(obj, ZoteroItem)):
+            self._query.invalidate(obj)
+
+    def enable_columns(self):
+        """Keeps a FieldColumns copy of the hot item fields for library wide scans (see the columns property)"""
+        if (self._columns is None):
+            self._columns = FieldColumns()
+            for obj in self._objects_by_key.values():
+                if (isinstance(obj, ZoteroItem)):
+                    self._columns.add(obj)
+
+    @property
+    def columns(self):
+        """The FieldColumns of the library, brought up to date, or None if not enabled"""
+        if (self._columns is not None):
+            self._columns.sync(self)
+        return self._columns
+
+    @property
+    def duplicate_index(self):
+        """The DuplicateIndex of the documents, see SimpleZDocMerger"""
+        return self._duplicates
+
+    @property
+    def query_index(self):
+        """The QueryIndex of the items, resolving the filters of lsdoc and lsattach"""
+        return self._query
+
+    @property
+    def unsaved_objects(self):
+        return self._unsaved_objects
+
+    def mark_saved(self):
+        self._unsaved_objects = set()
+
+    _persistent_attrs = ["_version", "_next_version", "_bootstrap_start", "_bootstrap_version", "item_types",
+                         "all_item_fields", "special_fields", "item_fields", "item_creator_types", "force_update",
+                         "fetch_threads", "use_relative_paths"]
+
+    def _persistent_meta(self):
+        """Library wide state (everything except the objects) as a JSON serializable dict"""
+        meta = {attr: getattr(self, attr) for attr in self._persistent_attrs}
+        meta["itemkeys_for_refresh"] = sorted(self._itemkeys_for_refresh)
+        meta["collkeys_for_refresh"] = sorted(self._collkeys_for_refresh)
+        meta["duplicates"] = self._duplicates.persistent_state(self)
+        return meta
+
+    def _restore_meta(self, meta):
+        for attr in self._persistent_attrs:
+            if (attr in meta):
+                setattr(self, attr, meta[attr])
+        self._itemkeys_for_refresh = set(meta.get("itemkeys_for_refresh", []))
+        self._collkeys_for_refresh = set(meta.get("collkeys_for_refresh", []))
+        self._duplicates.restore_state(meta.get("duplicates", {}))
+
+    def _holds(self, obj):
+        """True unless obj has been removed from the library (deleted locally or on the server)"""
+        if (isinstance(obj, ZoteroCollection)):
+            return obj in self._collections
+        elif (isinstance(obj, ZoteroDocument)):
+            return obj in self._documents
+        else:
+            return obj in self._attachments
+
+    def _restore_objects(self, states):
+        """Rebuilds the objects and all indexes from the dicts produced by ZoteroObject._persistent_state.
+        Relations are registered by constructing the objects as on a pull, then local state is laid on top.
+        Returns the restored objects.
+        """
+        restored = []
+        for state in states:
+            data = state["data"]
+            obj = self._objects_by_key.get(data["key"])
+            if (obj is None):
+                obj = ZoteroObject.subclass_named(state["cls"])(self, dict(data=data))
+            else:  # placeholder made while registering a relation of an object restored earlier
+                obj._data["version"] = data["version"]
+                for k in (q for q in data if (q != "key" and q != "version")):
+                    obj._register_property(k, data[k])
+            restored.append((obj, state))
+        for obj, state in restored:
+            obj._restore_state(state)
+        for obj, state in restored:
+            if (state["removed"]):
+                obj._remove(refresh=not state["deleted"])
+            if (state["deleted"]):
+                obj._deleted = True
+                self._deleted_objects.add(obj)
+        objs = [obj for obj, state in restored]
+        self._unsaved_objects.difference_update(objs)
+        self._duplicates.forget(objs)
+        return objs
+
+    @property
+    def lazy(self):
+        return self._store is not None
+
+    def _attach_store(self, store, index, cache_size=None):
+        """Lazy mode: index maps the key of every object left in store to (class, version).  Those objects are
+        hydrated (with the rest of their document's family) on first access through get_obj_by_key or the
+        documents/attachments views and at most cache_size clean families are kept resident.
+        """
+        self._store = store
+        self._lazy_index = index
+        self._lazy_counts = collections.Counter(cls for cls, version in index.values())
+        self.cache_size = cache_size
+
+    def _unindex_lazy(self, key):
+        entry = self._lazy_index.pop(key, None)
+        if (entry is not None):
+            self._lazy_counts[entry[0]] -= 1
+
+    def num_lazy(self, kind):
+        """Number of objects of kind (a class) left in the store, not yet hydrated"""
+        return sum(n for cls, n in self._lazy_counts.items() if issubclass(cls, kind))
+
+    @staticmethod
+    def _family_of(obj):
+        """Attachments are loaded and evicted together with their parent document"""
+        return obj.parent.key if (isinstance(obj, ZoteroAttachment) and obj.parent) else obj.key
+
+    def _mark_used(self, obj):
+        family = self._family_of(obj)
+        if (family in self._resident):
+            self._resident.move_to_end(family)
+
+    def _hydrate(self, key, evict=True):
+        if (key not in self._lazy_index):
+            return
+        family, states = self._store.read_family(key)
+        for state in states:
+            self._unindex_lazy(state["data"]["key"])
+        self._restore_objects(states)
+        self._resident[family] = True
+        self._resident.move_to_end(family)
+        if (evict):
+            self._evict()
+
+    def _hydrate_members(self, col):
+        """Collection sizes are only right with all members resident so these are not evicted straight away"""
+        for key in self._store.member_keys(col.key):
+            self._hydrate(key, evict=False)
+
+    def _family_objs(self, family):
+        root = self._objects_by_key.get(family)
+        if (root is None):
+            return []
+        return [root] + [c for c in root.children if c.key in self._objects_by_key]
+
+    def _evictable(self, obj):
+        return not (obj in self._unsaved_objects or obj in self._dirty_objects or obj in self._new_objects or
+                    obj in self._deleted_objects or obj in self._uploads or obj in self._downloads)
+
+    def _evict(self):
+        """Drops least recently used families with no unsaved state until at most cache_size are resident"""
+        if (self.cache_size is None):
+            return
+        excess = len(self._resident) - self.cache_size
+        for family in list(self._resident):
+            if (excess <= 0):
+                break
+            objs = self._family_objs(family)
+            if (all(self._evictable(o) for o in objs)):
+                for obj in objs:
+                    self._unload(obj)
+                del self._resident[family]
+                excess -= 1
+
+    def _unload(self, obj):
+        """Takes a clean object out of every index without changing it so it can be hydrated again later"""
+        if (isinstance(obj, ZoteroItem)):
+            self._query.release(obj)
+            for c in obj.collections:
+                c._discard_member(obj)
+            for t in obj.tags:
+                self._register_outof_tag(obj, t)
+        if (isinstance(obj, ZoteroDocument)):
+            self._documents.discard(obj)
+        elif (isinstance(obj, ZoteroAttachment)):
+            self._attachments.discard(obj)
+            if (obj.md5 in self._attachments_by_md5s):
+                self._attachments_by_md5s[obj.md5].discard(obj)
+                if (len(self._attachments_by_md5s[obj.md5]) == 0):
+                    del self._attachments_by_md5s[obj.md5]
+        del self._objects_by_key[obj.key]
+        self._lazy_index[obj.key] = (type(obj), obj.version)
+        self._lazy_counts[type(obj)] += 1
+        if (self._columns is not None):
+            self._columns.release(obj)
+
+    def materialize(self):
+        """Makes every object resident and leaves lazy mode.  Syncing needs the whole library in memory."""
+        if (self._store is None):
+            return
+        logger.info("Loading %s objects not yet resident", len(self._lazy_index))
+        store, keys = self._store, set(self._lazy_index)
+        self._lazy_index = dict()
+        self._lazy_counts = collections.Counter()
+        self._resident = collections.OrderedDict()
+        self._store = None
+        self.cache_size = None
+        self._restore_objects(store.read_objects(keys))
+
     def request_download(self, attach):
         self._downloads.add(attach)
 
@@ -504,6 +799,8 @@ class ZoteroLibrary(object):
 
     @property
     def documents(self):
+        if (self._lazy_index):
+            return LazyObjectView(self, self._documents, ZoteroDocument)
         return self._documents
 
     @property
@@ -524,6 +821,8 @@ class ZoteroLibrary(object):
 
     @property
     def attachments(self):
+        if (self._lazy_index):
+            return LazyObjectView(self, self._attachments, ZoteroAttachment)
         return self._attachments
 
     @property
@@ -545,29 +844,181 @@ class ZoteroLibrary(object):
             self.abort = False
             raise EarlyExit(self._revert)
 
-    def _queue_pull(self):  # fix to use functions I added to pyzotero when out
+    def _queue_pull(self, items=True):  # fix to use functions I added to pyzotero when out
         params = dict()
         if (self._version is not None):
             params['since'] = self._version
             deleted = self._server.deleted(**params)
             logger.info("%s Collections Deleted On Server", len(deleted["collections"]))
             logger.info("%s Items Deleted On Server", len(deleted["items"]))
-            for key in (i for k in deleted if (k == "items" or k == "collections") for i in deleted[k]):
-                logger.debug("Object with key %s is deleted on server", key)
-                if (key in self._objects_by_key):
-                    obj = self._objects_by_key[key]
-                    obj._remove(refresh=True)
-                    self._deleted_objects.discard(obj)
-        item_vers = self._server.item_versions(**params)
-        self._next_version = max(self._next_version, int(self._server.request.headers.get('last-modified-version', 0)))
-        for key in item_vers:
-            if (key not in self._objects_by_key or self._objects_by_key[key].version < item_vers[key]):
-                self._itemkeys_for_refresh.add(key)
+            deleted = [i for k in deleted if (k == "items" or k == "collections") for i in deleted[k]]
+            self._remove_deleted_on_server(deleted)
+        else:
+            deleted = []
+        if (items):
+            item_vers = self._server.item_versions(**params)
+            self._next_version = max(self._next_version, int(self._server.request.headers.get('last-modified-version', 0)))
+            for key in item_vers:
+                if (key not in self._objects_by_key or self._objects_by_key[key].version < item_vers[key]):
+                    self._itemkeys_for_refresh.add(key)
         coll_vers = self._server.collection_versions(**params)
         self._next_version = max(self._next_version, int(self._server.request.headers.get('last-modified-version', 0)))
         for key in coll_vers:
             if (key not in self._objects_by_key or self._objects_by_key[key].version < coll_vers[key]):
                 self._collkeys_for_refresh.add(key)
+        self._journal("state", deleted=deleted, **self._pull_state())
+
+    def _remove_deleted_on_server(self, keys):
+        for key in keys:
+            logger.debug("Object with key %s is deleted on server", key)
+            if (key in self._objects_by_key):
+                obj = self._objects_by_key[key]
+                obj._remove(refresh=True)
+                self._deleted_objects.discard(obj)
+
+    def _pull_state(self):
+        """Snapshot of the in progress pull recorded in the journal so a later pull can pick up from it"""
+        return dict(from_version=self._version, version=self._next_version,
+                    items=sorted(self._itemkeys_for_refresh), collections=sorted(self._collkeys_for_refresh),
+                    bootstrap_start=self._bootstrap_start, bootstrap_version=self._bootstrap_version)
+
+    def _journal(self, op, **record):
+        """Appends a record to the pull journal at journal_path (if set).  The journal is a file of JSON lines
+        starting with a 'state' record, followed by one record per batch of objects applied.  It is removed
+        by truncate_journal once the library has been saved.
+        """
+        if (self.journal_path is None):
+            return
+        lines = ""
+        if (op != "state" and not self.journal_path.exists()):  # first record since the last save
+            lines += json.dumps(dict(op="state", deleted=[], **self._pull_state())) + "\n"
+        record["op"] = op
+        lines += json.dumps(record) + "\n"
+        with self.journal_path.open(mode='a', encoding='utf8') as journal:
+            journal.write(lines)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def truncate_journal(self):
+        """Called once the library has been saved as the journaled batches are then part of the saved state"""
+        if (self.journal_path is not None and self.journal_path.exists()):
+            self.journal_path.unlink()
+
+    def _read_journal(self):
+        records = []
+        try:
+            with self.journal_path.open(mode='r', encoding='utf8') as journal:
+                for line in journal:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:  # torn final write from a crash
+                        logger.warning("Ignoring incomplete record at end of pull journal")
+                        break
+        except (IOError, FileNotFoundError, PermissionError):
+            return []
+        return records
+
+    def _have_version(self, dict):
+        """True if we already hold dict's object at its version or newer"""
+        obj = self._objects_by_key.get(dict['data']['key'])
+        return (obj is not None and obj.version >= dict['data']['version'])
+
+    def _replay_journal(self):
+        """Reapplies the batches recorded by an interrupted pull and restores its queues so the pull can
+        continue without asking the server what changed.  Returns True if a pull was resumed.
+        """
+        if (self.journal_path is None):
+            return False
+        records = self._read_journal()
+        if (len(records) == 0 or records[0]["op"] != "state" or records[0]["from_version"] != self._version):
+            if (len(records) > 0):
+                logger.warning("Discarding pull journal that doesn't match the saved library")
+            self.truncate_journal()
+            return False
+        logger.info("-- Replaying %s Pull Journal Records --", len(records))
+        for rec in records:
+            if (rec["op"] == "state"):
+                self._remove_deleted_on_server(rec["deleted"])
+                self._next_version = max(self._next_version, rec["version"])
+                self._itemkeys_for_refresh.update(rec["items"])
+                self._collkeys_for_refresh.update(rec["collections"])
+                self._bootstrap_start = rec["bootstrap_start"]
+                self._bootstrap_version = rec["bootstrap_version"]
+            else:
+                if (rec["op"] == "items"):
+                    recieve, queue = self._recieve_item, self._itemkeys_for_refresh
+                else:
+                    recieve, queue = self._recieve_collection, self._collkeys_for_refresh
+                for obj in rec["data"]:
+                    if (self._have_version(obj)):
+                        queue.discard(obj['data']['key'])
+                    else:
+                        recieve(obj)
+                if ("bootstrap_start" in rec):
+                    self._bootstrap_start = rec["bootstrap_start"]
+        return True
+
+    @property
+    def bootstrapping(self):
+        """True if the next pull should stream the whole library rather than queue keys, i.e., the library
+        has never been pulled or a previous streaming pull was interrupted"""
+        return (self._version is None and (self._bootstrap_start is not None or len(self._objects_by_key) == 0))
+
+    def server_changed(self):
+        """Whether a pull has anything to do: keys are still queued by an interrupted pull or the library version
+        on the server moved past ours.  The version is read off a request for at most one item changed since
+        ours, so polling an unchanged library costs a single small request."""
+        if (self._version is None or self._itemkeys_for_refresh or self._collkeys_for_refresh):
+            return True
+        try:
+            self._server.items(since=self._version, limit=1)
+        except zotero_errors.PyZoteroError as e:
+            raise SyncError from e
+        return int(self._server.request.headers.get('last-modified-version', 0)) != self._version
+
+    def _bootstrap_pages(self):
+        """Generator yielding (page, server version) for each page of the full item listing starting at
+        self._bootstrap_start.  Sorted by dateAdded so pages line up across interrupted runs"""
+        start = self._bootstrap_start
+        while True:
+            page = self._server.items(start=start, limit=self.BootstrapPageSize, sort="dateAdded", direction="asc")
+            yield (page, int(self._server.request.headers.get('last-modified-version', 0)))
+            if (len(page) < self.BootstrapPageSize):
+                return
+            start += len(page)
+
+    def _bootstrap_pull(self):
+        """Pulls every item by streaming pages of the full listing straight into _recieve_item instead of
+        queueing all keys with item_versions and refetching them.  self._bootstrap_start counts the items
+        applied so an interrupted bootstrap resumes after the last completed page.
+        Returns True if the library changed on the server while streaming.  Page offsets may then have
+        shifted so the caller must reconcile keys with _queue_pull.
+        """
+        if (self._bootstrap_start is None):
+            self._bootstrap_start = 0
+            self._bootstrap_version = self._next_version
+            self._journal("state", deleted=[], **self._pull_state())
+        else:
+            logger.info("-- Resuming Bootstrap Pull After %s Items --", self._bootstrap_start)
+        changed = False
+        for num, (page, version) in enumerate(self._bootstrap_pages(), 1):
+            for i in page:
+                if (self._have_version(i)):
+                    continue  # page overlap after a server side deletion shifted the offsets
+                logger.debug("Recieving item: %s", i['data']['key'])
+                self._recieve_item(i)
+            self._bootstrap_start += len(page)
+            self._journal("items", data=page, bootstrap_start=self._bootstrap_start)
+            self._record_batch("item", page)
+            changed = changed or (version != self._bootstrap_version)
+            if (num % self.BootstrapCheckpointPages == 0):
+                self._checkpoint()
+            self._early_abort()
+        logger.info("-- Bootstrap Pull Streamed %s Items --", self._bootstrap_start)
+        self._bootstrap_start = None
+        self._bootstrap_version = None
+        self._journal("state", deleted=[], **self._pull_state())
+        return changed
 
     def _process_pull(self):
         self._refresh_queued_collections()
@@ -578,10 +1029,22 @@ class ZoteroLibrary(object):
                 self._next_version = 0
 
     def pull(self):
+        self.materialize()
+        self._pull_stats = self._empty_pull_stats()
         logger.info("---- Initiating Pull Request ----\n\tFrom Version: %s", self._version)
         logger.info("Library Contains:\n\tCollections: %s\n\tDocuments: %s\n\tAttachments: %s\n\tTotal Objects: %s",
                     len(self._collections), len(self._documents), len(self._attachments), len(self._objects_by_key))
-        self._queue_pull()
+        resumed = self._replay_journal()
+        if (self.bootstrapping):
+            if (self._bootstrap_start is None):
+                self._queue_pull(items=False)
+            if (self._bootstrap_pull()):
+                logger.info("-- Library Changed During Bootstrap Reconciling Item Keys --")
+                self._queue_pull()
+        elif (resumed):
+            logger.info("-- Resuming Interrupted Pull From Journal --")
+        else:
+            self._queue_pull()
         logger.info("-- Pull Request Queued --")
         logger.info("\tItems Queued For Refresh: %s\n\tCollections Queued For Refresh: %s",
                     len(self._itemkeys_for_refresh), len(self._collkeys_for_refresh))
@@ -591,8 +1054,12 @@ class ZoteroLibrary(object):
                     len(self._collections), len(self._documents), len(self._attachments), len(self._objects_by_key))
         logger.info("\tItems Remaining For Refresh: %s\n\tCollections Remaining For Refresh: %s",
                     len(self._itemkeys_for_refresh), len(self._collkeys_for_refresh))
+        logger.info("\tItem Requests Issued: %s Items Received: %s\n\tCollection Requests Issued: %s Collections Received: %s",
+                    self._pull_stats["item_requests"], self._pull_stats["items_received"],
+                    self._pull_stats["collection_requests"], self._pull_stats["collections_received"])
 
     def push(self, nested=0):
+        self.materialize()
         try:
             try:
                 logger.info("---- Initiating Push Request ----\n\tFrom Version: %s", self._version)
@@ -601,7 +1068,7 @@ class ZoteroLibrary(object):
                 self._push_updates()
                 self._push_deleted()
                 logger.info("---- Finished Push ----\n\tAt Version: %s", self._version)
-            except (PreConditionFailed, StaleLocalData) as e:
+            except (zotero_errors.PreConditionFailed, StaleLocalData) as e:
                 if (nested < 4):
                     logger.info("-- Local Data Stale Initiating Pull --")
                     self.pull()
@@ -613,7 +1080,7 @@ class ZoteroLibrary(object):
                 else:
                     self.force_update = False
                     raise SyncError from e
-        except PyZoteroError as e:
+        except zotero_errors.PyZoteroError as e:
             raise SyncError from e
         self._checkpoint()
         logger.info("---- Finished Push Request ----\n\tAt Version: %s", self._version)
@@ -817,22 +1284,82 @@ class ZoteroLibrary(object):
                 idstring = idstring + ","
         return idstring[:-1]  # kill final ,
 
+    @staticmethod
+    def _key_batches(keys, size=50):
+        """Splits keys into comma separated strings of at most size keys each"""
+        keys = list(keys)
+        for start in range(0, len(keys), size):
+            yield ",".join(keys[start:start + size])
+
+    def _fetch_items(self, ikeys):
+        """Requests the items with the comma separated keys ikeys.  Safe to call from worker threads as each
+        call uses its own shallow copy of self._server (pyzotero keeps per request state on the instance)"""
+        logger.debug("Asking server for the following item string: %s", ikeys)
+        return copy.copy(self._server).items(itemKey=ikeys, limit=self.ApiKeyLimit)
+
+    def _fetch_collections(self, ckeys):
+        """Requests the collections with the comma separated keys ckeys.  Thread safe like _fetch_items"""
+        logger.debug("Asking server for the following collection string: %s", ckeys)
+        return copy.copy(self._server).collections(collectionKey=ckeys, limit=self.ApiKeyLimit)
+
     def _refresh_queued_items(self):
-        while(len(self._itemkeys_for_refresh) > 0):
-            ikeys = self._fifty_keys_from_set(self._itemkeys_for_refresh)
-            logger.debug("Asking server for the following item string: %s", ikeys)
-            newitems = self._server.items(itemKey=ikeys)
-            for i in newitems:
-                logger.debug("Recieving item: %s", i['data']['key'])
-                self._recieve_item(i)
-            self._early_abort()
+        self._refresh_queued(self._itemkeys_for_refresh, self._fetch_items, self._recieve_item, "item")
 
     def _refresh_queued_collections(self):
-        keys = self._collkeys_for_refresh.copy()
-        for key in keys:
-                logger.debug("Recieving Collection: %s", key)
-                self._recieve_collection(self._server.collection(key))
-                self._early_abort()
+        self._refresh_queued(self._collkeys_for_refresh, self._fetch_collections, self._recieve_collection,
+                             "collection")
+
+    @staticmethod
+    def _empty_pull_stats():
+        return dict(item_requests=0, items_received=0, collection_requests=0, collections_received=0)
+
+    def _record_batch(self, kind, objs):
+        self._pull_stats[kind + "_requests"] += 1
+        self._pull_stats[kind + "s_received"] += len(objs)
+
+    def _fetch_batch_size(self):
+        return max(1, min(self.FetchBatchSize, self.ApiKeyLimit))
+
+    def _refresh_queued(self, queue, fetch, recieve, kind):
+        """Fetches the keys in queue from the server in batches of FetchBatchSize and passes each object to
+        recieve (which removes it from queue).  kind is 'item' or 'collection' and is only used for the pull stats"""
+        if (self.fetch_threads > 1):
+            return self._refresh_queued_concurrent(queue, fetch, recieve, kind)
+        for keys in self._key_batches(queue.copy(), self._fetch_batch_size()):
+            newobjs = fetch(keys)
+            self._record_batch(kind, newobjs)
+            for o in newobjs:
+                logger.debug("Recieving %s: %s", kind, o['data']['key'])
+                recieve(o)
+            self._journal(kind + "s", data=newobjs)
+            self._early_abort()
+
+    def _refresh_queued_concurrent(self, queue, fetch, recieve, kind):
+        """Like _refresh_queued but keeps up to fetch_threads batch requests in flight.  Batches are
+        applied in the order they were requested and only on the calling thread so recieve never runs
+        concurrently.  Keys from batches that never get applied (abort/error) stay queued for the next pull.
+        """
+        batches = self._key_batches(queue.copy(), self._fetch_batch_size())
+        logger.info("Fetching queued %ss with %s concurrent requests", kind, self.fetch_threads)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_threads) as pool:
+            in_flight = collections.deque()
+            try:
+                for keys in itertools.islice(batches, self.fetch_threads):
+                    in_flight.append(pool.submit(fetch, keys))
+                while (len(in_flight) > 0):
+                    newobjs = in_flight.popleft().result()
+                    keys = next(batches, None)
+                    if (keys is not None):
+                        in_flight.append(pool.submit(fetch, keys))
+                    self._record_batch(kind, newobjs)
+                    for o in newobjs:
+                        logger.debug("Recieving %s: %s", kind, o['data']['key'])
+                        recieve(o)
+                    self._journal(kind + "s", data=newobjs)
+                    self._early_abort()
+            finally:
+                for future in in_flight:
+                    future.cancel()
 
     def _update_template_data(self):
         self.item_types = [d["itemType"] for d in self._server.item_types()]
@@ -868,15 +1395,20 @@ class ZoteroLibrary(object):
 
     def new_key(self):
         newkey = ""
-        while(newkey == "" or newkey in self._objects_by_key):
+        while(newkey == "" or newkey in self._objects_by_key or newkey in self._lazy_index):
             newkey = ""
             for i in range(8):
                 newkey += random.choice(ZoteroLibrary.AllowedKeyChars)
         return newkey
 
     def get_obj_by_key(self, key):
+        if (key in self._lazy_index):
+            self._hydrate(key)
         if (key in self._objects_by_key):
-            return self._objects_by_key[key]
+            obj = self._objects_by_key[key]
+            if (self._resident):
+                self._mark_used(obj)
+            return obj
         else:
             return None
 
@@ -933,6 +1465,8 @@ class ZoteroLibrary(object):
 
     def _register_obj(self, obj):
         self._objects_by_key[obj.key] = obj
+        if (self._columns is not None and isinstance(obj, ZoteroItem)):
+            self._columns.add(obj)
 
     def _register_collection(self, obj):
         self._collections.add(obj)
@@ -959,12 +1493,124 @@ class ZoteroLibrary(object):
             else:
                 self._attachments_by_md5s[obj.md5] = {obj}
 
+    @staticmethod
+    def _hash_path(path):
+        try:
+            if (path and path.is_file()):
+                return md5(path)
+        except (OSError, PermissionError, FileNotFoundError):
+            pass
+        return None
+
+    def prefetch_hashes(self, attachments=None, threads=None):
+        """Computes the md5 of every attachment (default all) whose file exists but hasn't been hashed yet using
+        a pool of threads (default one per cpu).  hashlib releases the GIL so files are read and hashed in
+        parallel; results are applied on the calling thread in one pass.  Returns the number of files hashed.
+        """
+        if (attachments is None):
+            attachments = self.attachments
+        todo = [(a, a.path) for a in attachments if not a._md5]
+        threads = threads or os.cpu_count() or 1
+        logger.info("Hashing up to %s attachment files with %s threads", len(todo), threads)
+        hashed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            digests = pool.map(self._hash_path, (path for a, path in todo))
+            for (attach, path), digest in zip(todo, digests):
+                if (digest is not None and self._record_hash(attach, digest)):
+                    hashed += 1
+        return hashed
+
+    def _record_hash(self, attach, digest):
+        if (attach._md5):
+            return False
+        attach._md5 = digest
+        self._register_hash_change(attach, None)
+        self._touch(attach)
+        return True
+
+    def file_groups(self, attachments, remote=True):
+        """Partitions attachments into sets of attachments holding the same file as ZoteroAttachment.identical_file
+        sees it: the same local md5, a local md5 equal to the remote md5 of an attachment whose file isn't
+        available locally (unless remote is False), or the same path.  Local files go through file_digests so
+        only files whose size and partial hash collide get hashed; the digests computed are kept as by
+        prefetch_hashes.
+        """
+        attachments = list(attachments)
+        local = dict()
+        for attach in attachments:
+            try:
+                if (attach.path and attach.path.is_file()):
+                    local[attach] = attach.path
+            except (OSError, PermissionError, FileNotFoundError):
+                pass
+        known = {path: a._md5 for a, path in local.items() if a._md5}
+        remote_md5s = {a.remote_md5 for a in attachments if a not in local and a.remote_md5} if remote else set()
+        digests = file_digests(set(local.values()), md5, known=known,
+                               hash_all=bool(remote_md5s - set(known.values())))
+        groups = dict()
+        for attach in attachments:
+            if (attach in local):
+                key = digests[local[attach]]
+                if (key is None):
+                    key = local[attach]
+                else:
+                    self._record_hash(attach, key)
+            elif (remote and attach.remote_md5):
+                key = attach.remote_md5
+            elif (attach.path):
+                key = attach.path
+            else:
+                key = attach
+            groups.setdefault(key, set()).add(attach)
+        return list(groups.values())
+
+    def duplicate_attachments(self, remote=True):
+        """Sets of two or more attachments anywhere in the library holding the same file.  Files that might have
+        a twin are hashed first (see file_groups), then the groups are read off _attachments_by_md5s plus the
+        remote md5s of attachments whose file isn't available locally, in one pass over the attachments.
+        """
+        self.materialize()
+        attachments = set(self.attachments)
+        self.file_groups(attachments, remote=remote)
+        groups = {digest: attachs & attachments for digest, attachs in self._attachments_by_md5s.items()}
+        if (remote):
+            for attach in attachments:
+                if (not attach._md5 and attach.remote_md5):
+                    groups.setdefault(attach.remote_md5, set()).add(attach)
+        return [g for g in groups.values() if len(g) > 1]
+
+    def duplicate_attachment_removals(self, remote=True):
+        """Plans the cleanup of duplicate_attachments as a list of (kept, removed) pairs.  Copies under the same
+        parent collapse onto the best of them (ZoteroAttachment.best_of) and top level copies are dropped in
+        favour of a copy with a parent.  Copies under different parents are all kept as they belong to
+        different documents.
+        """
+        plan = []
+        for group in self.duplicate_attachments(remote=remote):
+            by_parent = dict()
+            for attach in group:
+                by_parent.setdefault(attach.parent, set()).add(attach)
+            top = by_parent.pop(None, set())
+            kept = set()
+            for equiv in by_parent.values():
+                best = ZoteroAttachment.best_of(equiv)
+                kept.add(best)
+                if (len(equiv) > 1):
+                    plan.append((best, equiv - {best}))
+            if (top):
+                best = ZoteroAttachment.best_of(kept if kept else top)
+                if (top - {best}):
+                    plan.append((best, top - {best}))
+        return plan
+
     def _register_parent(self, obj, pkey):
         if (obj.parent is not None):
-            obj.parent.children.discard(obj)
+            obj.parent._discard_child(obj)
         if (pkey and pkey != "false"):
             if (isinstance(pkey, ZoteroObject)):
                 pkey = pkey.key
+            if (pkey in self._lazy_index):
+                self._hydrate(pkey)
             if (pkey not in self._objects_by_key):
                 if (isinstance(obj, ZoteroItem)):
                     parent = ZoteroDocument(self, pkey)
@@ -972,7 +1618,7 @@ class ZoteroLibrary(object):
                     parent = ZoteroCollection(self, pkey)
             else:
                 parent = self._objects_by_key[pkey]
-            parent.children.add(obj)
+            parent._add_child(obj)
             return parent
         else:
             return None
@@ -986,7 +1632,7 @@ class ZoteroLibrary(object):
             col = ZoteroCollection(self, ckey)
         else:
             col = self._objects_by_key[ckey]
-        col.members.add(obj)
+        col._add_member(obj)
         return col
 
     def _register_outof_collection(self, obj, ckey):
@@ -994,7 +1640,7 @@ class ZoteroLibrary(object):
             col = ckey
         else:
             col = self._objects_by_key[ckey]
-        col.members.discard(obj)
+        col._discard_member(obj)
         return col
 
     def _register_into_tag(self, obj, tag):
@@ -1011,7 +1657,7 @@ class ZoteroLibrary(object):
 
     @property
     def num_docs(self):
-        return len(self._documents)
+        return len(self.documents)
 
     @property
     def num_collections(self):
@@ -1019,17 +1665,68 @@ class ZoteroLibrary(object):
 
     @property
     def num_attachments(self):
-        return len(self._attachments)
+        return len(self.attachments)
 
     @property
     def num_items(self):
         return self.num_docs + self.num_attachments
 
+    @property
+    def num_unpushed(self):
+        """Number of new, changed and deleted objects waiting for the next push"""
+        return len(self._new_objects) + len(self._dirty_objects) + len(self._deleted_objects)
+
+
+class LazyObjectView(collections.abc.Set):
+    """Read only set of the documents or attachments of a lazily loaded library.  Iterating hydrates the objects
+    not yet resident one family at a time, so earlier ones may be evicted again while the caller holds them.
+    """
+
+    def __init__(self, library, resident, kind):
+        self._library = library
+        self._resident = resident
+        self._kind = kind
+
+    def _pending(self):
+        return [k for k, (cls, version) in self._library._lazy_index.items() if issubclass(cls, self._kind)]
+
+    def __iter__(self):
+        resident = list(self._resident)
+        pending = self._pending()
+        yield from resident
+        for key in pending:
+            obj = self._library.get_obj_by_key(key)
+            if (obj is not None and obj in self._resident):
+                yield obj
+
+    def __len__(self):
+        return len(self._resident) + self._library.num_lazy(self._kind)
+
+    def __contains__(self, obj):
+        return obj in self._resident
+
+
+# Shared stand ins for the empty containers most objects never fill (leaf items have no children, clean objects
+# no changes).  They are immutable so a real container is allocated on first write, see ZoteroObject._changes
+NoObjects = frozenset()
+NoChanges = types.MappingProxyType(dict())
+
 
 class ZoteroObject(object):
 
+    __slots__ = ("_library", "_dirty", "new", "_deleted", "_parent", "_children", "_changed_from", "_data")
     _parent_key = None   # override in inherited classes
 
+    @classmethod
+    def subclass_named(cls, name):
+        if (cls.__name__ == name):
+            return cls
+        for sub in cls.__subclasses__():
+            found = sub.subclass_named(name)
+            if (found is not None):
+                return found
+        return None
+
     @subclassfactory
     def factory(cls, library, dict):
         try:
@@ -1049,8 +1746,8 @@ class ZoteroObject(object):
         self.new = False
         self._deleted = False
         self._parent = None
-        self._children = set()
-        self._changed_from = dict()
+        self._children = NoObjects
+        self._changed_from = NoChanges
         if (isinstance(arg, dict)):
             try:
                 data = arg["data"]
@@ -1065,6 +1762,47 @@ class ZoteroObject(object):
             if (isinstance(self, ZoteroAttachment)):
                 raise ConsistencyError("Attachments shouldn't get created empty", arg)
         self._library._register_obj(self)
+        self._library._touch(self)
+
+    def __setstate__(self, state):
+        """Objects pickled before __slots__ carry a plain attribute dict"""
+        if (isinstance(state, tuple)):
+            state = dict(state[0] or {}, **state[1])
+        for attr, val in state.items():
+            setattr(self, attr, val)
+
+    def _changes(self):
+        """self._changed_from for writing, allocated on first use"""
+        if (self._changed_from is NoChanges):
+            self._changed_from = dict()
+        return self._changed_from
+
+    def _add_child(self, obj):
+        if (self._children is NoObjects):
+            self._children = set()
+        self._children.add(obj)
+
+    def _discard_child(self, obj):
+        if (obj in self._children):
+            self._children.discard(obj)
+
+    def _persistent_state(self):
+        """JSON serializable dict of everything needed to restore this object with ZoteroLibrary._restore_objects"""
+        return dict(cls=self.__class__.__name__, data=self._data, dirty=self._dirty, new=self.new,
+                    deleted=self._deleted, removed=not self._library._holds(self), changed_from=dict(self._changed_from))
+
+    def _export_data(self):
+        """The Zotero data of this object without copying it, for serializing straight out.  Not to be modified"""
+        return self._data
+
+    def _restore_state(self, state):
+        self._dirty = state["dirty"]
+        self.new = state["new"]
+        self._changed_from = state["changed_from"] or NoChanges
+        if (self._dirty):
+            self._library.mark_dirty(self)
+        if (self.new):
+            self._library._new_objects.add(self)
 
     def __repr__(self):
         return self.__class__.__name__ + "(" + self._library.__repr__() + ", " + self._data.__repr__() + ")"
@@ -1072,12 +1810,17 @@ class ZoteroObject(object):
     def __str__(self):
         return self.name if (len(self.name) > 0) else "Untitled #" + self.key
 
+    def filter_labels(self):
+        """The strings a filter on a list or set field holding this object is tried on"""
+        return (str(self),)
+
     def refresh(self, dict):
         try:
             if (self.version >= dict["data"]["version"]):
                 raise ConsistencyError("Tried to update an item with version: " +
                                        "{} with data versioned at: {}".format(self.version,  dict["data"]["version"]))
             self._data["version"] = dict["data"]["version"]
+            self._library._touch(self)
             for k in (q for q in dict["data"] if (q != "key" and q != "version")):
                 self._refresh_property(k, dict["data"][k])
             if (self._parent_key in self._data and self._parent_key not in dict["data"]):
@@ -1086,6 +1829,7 @@ class ZoteroObject(object):
             raise InvalidData(dict) from e
 
     def _refresh_property(self, k, val):
+        self._library._touch(self)
         if (k not in self._changed_from):
             self._register_property(k, val)
         else:
@@ -1093,13 +1837,14 @@ class ZoteroObject(object):
                 ((not self._data.get(k, False)) and (not val))): 
                 del self._changed_from[k]
             else:
-                self._changed_from[k] = val
+                self._changes()[k] = val
 
     def _register_property(self, pkey, pval):
         # logger.debug("called _register_property in ZoteroObject with pkey=%s and pval=%s", pkey, pval)
         if (isinstance(pval, ZoteroObject)):
             pval = pval.key
-        self._data[pkey] = pval
+        self._data[sys.intern(pkey)] = pval
+        self._library._touch(self)
         if (pkey == self._parent_key):
             self._register_parent(pval)
             if (pval is None):
@@ -1125,7 +1870,7 @@ class ZoteroObject(object):
                 fromval = None
             self._register_property(pkey, pval)
             if (pkey not in self._changed_from):
-                self._changed_from[pkey] = fromval
+                self._changes()[pkey] = fromval
 
     def __setitem__(self, pkey, pval):
         if (pkey == "parent"):
@@ -1152,15 +1897,16 @@ class ZoteroObject(object):
             del self.children
         else:
             self.dirty = True
+            self._library._touch(self)
             if (pkey not in self._changed_from):
                 if (pkey in self._data):
-                    self._changed_from[pkey] = self._data[pkey]
+                    self._changes()[pkey] = self._data[pkey]
                 elif (pkey == 'creators'):
-                    self._changed_from[pkey] = list()
+                    self._changes()[pkey] = list()
                 elif (pkey == 'relations'):
-                    self._changed_from[pkey] = dict()
+                    self._changes()[pkey] = dict()
                 else:
-                    self._changed_from[pkey] = None
+                    self._changes()[pkey] = None
             if (pkey in self._data):
                 if (pkey == 'relations'):
                     self._data[pkey] = dict()
@@ -1192,12 +1938,14 @@ class ZoteroObject(object):
         self._library._mark_for_deletion(self)
         self._remove()
         self._deleted = True
+        self._library._touch(self)
 
     def _remove(self, refresh=False):
         """removes object from the library.  Responsible for taking out of all containers and relations.
         """
         if self.deleted:
             return
+        self._library._touch(self)
         self._library._remove(self)
         self._library._register_parent(self, None)  # remove from any children collections
         if (refresh):
@@ -1230,13 +1978,14 @@ class ZoteroObject(object):
     @dirty.setter
     def dirty(self, val):
         # logger.debug("called dirty setter in ZoteroObject")
+        self._library._touch(self)
         if (val):
             self._dirty = True
             self._library.mark_dirty(self)
         else:
             self._dirty = False
             self.new = False
-            self._changed_from = dict()
+            self._changed_from = NoChanges
             self._library.mark_clean(self)
 
     @property
@@ -1267,13 +2016,13 @@ class ZoteroObject(object):
             child.parent = None
         for child in pval.difference(self._children):
             child.parent = self
-        self._children = pval.copy()
+        self._children = set(pval) if pval else NoObjects
 
     @children.deleter
     def children(self):
         for child in self._children:
             child.parent = None
-        self._children = set()
+        self._children = NoObjects
 
     @property
     def key(self):
@@ -1310,8 +2059,10 @@ class ZoteroObject(object):
 class ZoteroItem(ZoteroObject):
     """Common subclass for Documents and attachments"""
 
+    __slots__ = ("_collections",)
+
     def __init__(self, library, arg):
-        self._collections = set()
+        self._collections = NoObjects
         super().__init__(library, arg)
 
     def _register_property(self, pkey, pval):
@@ -1320,7 +2071,7 @@ class ZoteroItem(ZoteroObject):
             for c in self._collections:
                 self._library._register_outof_collection(self, c)
             self._collections = {self._library._register_into_collection(self, ckey)
-                                 for ckey in pval}
+                                 for ckey in pval} or NoObjects
         if (pkey == "tags"):
             for tag in self.tags:
                 self._library._register_outof_tag(self, tag)
@@ -1339,7 +2090,7 @@ class ZoteroItem(ZoteroObject):
                     cur_cols = set()
                 cols = cur_cols.difference(orig_keys.difference(update_keys)).union(
                                             update_keys.difference(orig_keys))
-                self._changed_from["collections"] = [c for c in update_keys]
+                self._changes()["collections"] = [c for c in update_keys]
             else:
                 cols = update_keys
             self._register_property("collections", [c for c in cols])
@@ -1353,16 +2104,17 @@ class ZoteroItem(ZoteroObject):
                     cur_tags = set()
                 tags = cur_tags.difference(orig_tags.difference(update_tags)).union(
                             update_tags.difference(orig_tags))
-                self._changed_from["tags"] = [dict(tag=t) for t in update_tags]
+                self._changes()["tags"] = [dict(tag=t) for t in update_tags]
             else:
                 tags = update_tags
             self._register_property("tags", [dict(tag=t) for t in tags])
         elif (pkey == "dateModified"):
+            self._library._touch(self)
             cur_mod = self.date_modified
             if (cur_mod is None):
                 self._data["dateModified"] = pval
             else:
-                self._data["dateModified"] = max(cur_mod, dateutil.parser.parse(pval)
+                self._data["dateModified"] = max(cur_mod, dateutil_parser.parse(pval)
                                                  ).replace(tzinfo=None).isoformat("T") + "Z"
         else:
             super()._refresh_property(pkey, pval)
@@ -1445,6 +2197,7 @@ class ZoteroItem(ZoteroObject):
     @dirty.setter
     def dirty(self, val):
         # logger.debug("called dirty setter in ZoteroItem")
+        self._library._touch(self)
         if (val):
             self._dirty = True
             self._library.mark_dirty(self)
@@ -1544,14 +2297,14 @@ class ZoteroItem(ZoteroObject):
     @property
     def date_modified(self):
         if ("dateModified" in self._data):
-            return dateutil.parser.parse(self._data["dateModified"])
+            return dateutil_parser.parse(self._data["dateModified"])
         else:
             return None
 
     @property
     def date_added(self):
         if ("dateAdded" in self._data):
-            return dateutil.parser.parse(self._data["dateAdded"])
+            return dateutil_parser.parse(self._data["dateAdded"])
         else:
             return None
 
@@ -1566,7 +2319,7 @@ class ZoteroItem(ZoteroObject):
         # if (isinstance(val, datetime.datetime)):
         #     dt = val
         # else:
-        #     dt = dateutil.parser.parse(val)
+        #     dt = dateutil_parser.parse(val)
         # self._set_property("dateAdded", dt.replace(tzinfo=None).isoformat("T") + "Z")
         # return dt
 
@@ -1619,6 +2372,8 @@ class ZoteroItem(ZoteroObject):
 class ZoteroDocument(ZoteroItem):
     """Represents a top level document in a zotero library"""
 
+    __slots__ = ()
+
     def __init__(self, library, arg):
         super().__init__(library, arg)
         self._library._register_document(self)
@@ -1640,68 +2395,24 @@ class ZoteroDocument(ZoteroItem):
     def __str__(self):
         return self.type + ": " + self.name
 
+    def filter_labels(self):
+        return (self.title, "#" + self.key)
+
     def remove_dup_linked_file_children(self):
         dups = set()
-        for link in (o for o in self.children if o.link_mode == "linked_file" and not o.missing):
-            if link in dups:
-                continue
-            for olink in (o for o in self.children if o.link_mode == "linked_file" and not o.missing and o not in dups and not o == link):
-                if link.identical_file(olink):
-                    dups.add(olink)
-                    logger.debug("Linked File %s has duplicate %s adding %s to dups", link.key, olink.key, olink.key)
+        links = [o for o in self.children if o.link_mode == "linked_file" and not o.missing]
+        for equiv in self._library.file_groups(links):
+            link, *others = sorted(equiv, key=links.index)
+            for olink in others:
+                dups.add(olink)
+                logger.debug("Linked File %s has duplicate %s adding %s to dups", link.key, olink.key, olink.key)
         for link in dups:
             logger.debug("Marking linked file %s for deletion", link.key)
             link.delete()
 
     def remove_dup_child_files(self):
-        used = set()
-        dup_map = dict()
-        for attach in self.children:
-            if attach in used:
-                continue
-            else:
-                dup_map[attach] = {attach}
-                used.add(attach)
-            for oattach in (o for o in self.children if o not in used):
-                if attach.identical_file(oattach):
-                    used.add(oattach)
-                    dup_map[attach].add(oattach)
-        for equiv in dup_map.values():
-            best = None
-            rank = 5
-            for attach in equiv:
-                if (rank == 0):
-                    break
-                if (best is None):
-                    best = attach
-                    continue
-                if (isinstance(attach, ZoteroImportedFile) and not attach.missing and not attach.dirty_file):
-                    if (isinstance(best, ZoteroLinkedUrl) or isinstance(best, ZoteroImportedUrl) or
-                            not attach.local_missing or best.local_missing or best.missing or best.dirty_file or not isinstance(best, ZoteroImportedFile)):
-                        best = attach
-                        rank = 0
-                    continue
-                if (rank == 1):
-                    continue
-                if (isinstance(attach, ZoteroLinkedFile) and not attach.missing):
-                    if (isinstance(best, ZoteroLinkedUrl) or isinstance(best, ZoteroImportedUrl) or
-                            best.missing or (isinstance(best, ZoteroImportedFile) and best.dirty_file)):
-                        best = attach
-                        rank = 1
-                    continue
-                if (rank == 2):
-                    continue
-                if (isinstance(attach, ZoteroImportedFile) and not attach.local_missing):
-                    if (isinstance(best, ZoteroLinkedUrl) or isinstance(best, ZoteroImportedUrl) or (best.local_missing and best.missing )):
-                        best = attach
-                        rank = 2
-                    continue
-                if (rank == 3):
-                    continue
-                if (isinstance(attach, ZoteroImportedUrl) and not attach.local_missing):
-                    if (isinstance(best, ZoteroLinkedUrl) or (best.local_missing and best.missing)):
-                        best = attach
-                        rank = 3
+        for equiv in self._library.file_groups(self.children):
+            best = ZoteroAttachment.best_of(equiv)
             if (len(equiv) > 1):
                 for attach in equiv:
                     logger.debug("Keeping child %s of class %s missing: %s, local_missing: %s, dirty_file %s", best.key, str(best.__class__.__name__), str(best.missing), str(best.local_missing), str(isinstance(best, ZoteroImported) and best.dirty_file))
@@ -1712,6 +2423,7 @@ class ZoteroDocument(ZoteroItem):
 
 class ZoteroAttachment(ZoteroItem):
 
+    __slots__ = ("_md5", "_fulltext")
     _parent_key = "parentItem"   # override in inherited classes
 
     @subclassfactory
@@ -1739,8 +2451,18 @@ class ZoteroAttachment(ZoteroItem):
         self._library._register_attachment(self)
 
 
+    def _persistent_state(self):
+        state = super()._persistent_state()
+        state["md5"] = self._md5
+        return state
+
+    def _restore_state(self, state):
+        super()._restore_state(state)
+        self._md5 = state["md5"]
+
     def _file_change(self, old=None, new=None, oldmd5=None):
         """Make any changes required when the attachment data changes"""
+        self._library._touch(self)
         newmd5 = None
         try:
             if (not new or not new.is_file()):
@@ -1749,7 +2471,7 @@ class ZoteroAttachment(ZoteroItem):
                     return False
             else:
                 if(old and old.is_file()):                
-                    if filecmp.cmp(str(old), str(new), shallow=False):
+                    if same_contents(old, new):
                         return False
                 newmd5 = md5(new)
                 if (self._md5 and newmd5 == self._md5):
@@ -1817,6 +2539,9 @@ class ZoteroAttachment(ZoteroItem):
     def __str__(self):
         return self.link_mode + ": " + self.name
 
+    def filter_labels(self):
+        return (self.link_mode + "\n" + self.name, "#" + self.key)
+
     @property
     def local_missing(self):
         if (not self.path or not self.path.is_file()):
@@ -1828,6 +2553,46 @@ class ZoteroAttachment(ZoteroItem):
     def remote_md5(self):
         return None 
 
+    @staticmethod
+    def best_of(equiv):
+        """The attachment to keep out of a set of attachments holding the same file"""
+        best = None
+        rank = 5
+        for attach in equiv:
+            if (rank == 0):
+                break
+            if (best is None):
+                best = attach
+                continue
+            if (isinstance(attach, ZoteroImportedFile) and not attach.missing and not attach.dirty_file):
+                if (isinstance(best, ZoteroLinkedUrl) or isinstance(best, ZoteroImportedUrl) or
+                        not attach.local_missing or best.local_missing or best.missing or best.dirty_file or not isinstance(best, ZoteroImportedFile)):
+                    best = attach
+                    rank = 0
+                continue
+            if (rank == 1):
+                continue
+            if (isinstance(attach, ZoteroLinkedFile) and not attach.missing):
+                if (isinstance(best, ZoteroLinkedUrl) or isinstance(best, ZoteroImportedUrl) or
+                        best.missing or (isinstance(best, ZoteroImportedFile) and best.dirty_file)):
+                    best = attach
+                    rank = 1
+                continue
+            if (rank == 2):
+                continue
+            if (isinstance(attach, ZoteroImportedFile) and not attach.local_missing):
+                if (isinstance(best, ZoteroLinkedUrl) or isinstance(best, ZoteroImportedUrl) or (best.local_missing and best.missing )):
+                    best = attach
+                    rank = 2
+                continue
+            if (rank == 3):
+                continue
+            if (isinstance(attach, ZoteroImportedUrl) and not attach.local_missing):
+                if (isinstance(best, ZoteroLinkedUrl) or (best.local_missing and best.missing)):
+                    best = attach
+                    rank = 3
+        return best
+
     def identical_file(self, other):
         if (self.md5 and other.md5 and self.md5 == other.md5):
             return True
@@ -1859,7 +2624,7 @@ class ZoteroAttachment(ZoteroItem):
                 stem = Path(stem.stem)
             newpath_stem = str(stem)
             while(newpath.exists()):
-                if (filecmp.cmp(str(self.path), str(newpath), shallow=False)):
+                if (same_contents(self.path, newpath)):
                     logger.info("Identical file exists at destination")
                     self.path = newpath
                     return True
@@ -1906,6 +2671,8 @@ class ZoteroAttachment(ZoteroItem):
 
 class ZoteroLinkedFile(ZoteroAttachment):
 
+    __slots__ = ()
+
     def __getitem__(self, pkey):
         if (pkey == 'path'):
             return self.path
@@ -1992,6 +2759,8 @@ class ZoteroLinkedFile(ZoteroAttachment):
 class ZoteroImported(ZoteroAttachment):
     """Parent class for ImportedFile and ImportedUrl"""
 
+    __slots__ = ("_local_file", "bdiff_file", "_dirty_file", "_download", "_remote_file")
+
     def __init__(self, library, arg):
         self._local_file = None
         super().__init__(library, arg)
@@ -2005,6 +2774,26 @@ class ZoteroImported(ZoteroAttachment):
         self._download = False
         self._remote_file = self.path if self.md5 == self['md5'] else None
 
+    def _persistent_state(self):
+        state = super()._persistent_state()
+        for attr in ("_local_file", "_remote_file", "bdiff_file"):
+            val = getattr(self, attr)
+            state[attr] = str(val) if val else None
+        state["dirty_file"] = self._dirty_file
+        state["download"] = self._download
+        state["upload_queued"] = self in self._library._uploads
+        state["download_queued"] = self in self._library._downloads
+        return state
+
+    def _restore_state(self, state):
+        super()._restore_state(state)
+        for attr in ("_local_file", "_remote_file", "bdiff_file"):
+            setattr(self, attr, Path(state[attr]) if state[attr] else None)
+        self._dirty_file = state["dirty_file"]
+        self._download = state["download"]
+        self._library._mark_file_dirty(self) if state["upload_queued"] else self._library._mark_file_clean(self)
+        self._library.request_download(self) if state["download_queued"] else self._library._downloads.discard(self)
+
     @property
     def dirty_file(self):
         return self._dirty_file
@@ -2015,6 +2804,7 @@ class ZoteroImported(ZoteroAttachment):
 
     @dirty_file.setter
     def dirty_file(self, val):
+        self._library._touch(self)
         self._dirty_file = val
         if (val):
             self._library._mark_file_dirty(self)
@@ -2028,6 +2818,7 @@ class ZoteroImported(ZoteroAttachment):
 
     @download.setter
     def dirty_file(self, val):
+        self._library._touch(self)
         self._download = val
         if (val):
             self._library.request_download(self)
@@ -2064,6 +2855,7 @@ class ZoteroImported(ZoteroAttachment):
         self._file_change(old=self.local_file, new=self.path, oldmd5=oldmd5)
 
     def _file_change(self, old=None, new=None, oldmd5=None):
+        self._library._touch(self)
         if (not new or not new.is_file()):
             self.dirty_file = False
             self._download = False
@@ -2136,6 +2928,8 @@ class ZoteroImported(ZoteroAttachment):
 
 class ZoteroImportedFile(ZoteroImported):
 
+    __slots__ = ()
+
 
     def _set_property(self, pkey, pval):
         # logger.debug("called _set_property in ZoteroImportedFile")
@@ -2150,6 +2944,8 @@ class ZoteroImportedFile(ZoteroImported):
 
 class ZoteroImportedUrl(ZoteroImported):
 
+    __slots__ = ()
+
     def _set_property(self, pkey, pval):
         # logger.debug("called _set_property in ZoteroImportedFile")
         if (pkey == "linkMode"):
@@ -2163,6 +2959,8 @@ class ZoteroImportedUrl(ZoteroImported):
 
 class ZoteroLinkedUrl(ZoteroAttachment):
 
+    __slots__ = ()
+
     def _set_property(self, pkey, pval):
         # logger.debug("called _set_property in ZoteroImportedFile")
         if (pkey == "linkMode"):
@@ -2216,13 +3014,35 @@ class ZoteroLinkedUrl(ZoteroAttachment):
 
 class ZoteroCollection(ZoteroObject):
 
+    __slots__ = ("_members",)
     _parent_key = "parentCollection"   # override in inherited classes
 
     def __init__(self, library, arg):
-        self.members = set()
+        self._members = NoObjects
         super().__init__(library, arg)
         self._library._register_collection(self)
 
+    def __setstate__(self, state):
+        if (isinstance(state, dict) and "members" in state):  # pickled while members was a plain attribute
+            state = dict(state, _members=state["members"])
+            del state["members"]
+        super().__setstate__(state)
+
+    def _add_member(self, obj):
+        if (self._members is NoObjects):
+            self._members = set()
+        self._members.add(obj)
+
+    def _discard_member(self, obj):
+        if (obj in self._members):
+            self._members.discard(obj)
+
+    @property
+    def members(self):
+        if (self._library._lazy_index):
+            self._library._hydrate_members(self)
+        return self._members
+
     def _remove(self, refresh=False):
         if self.deleted:
             return
@@ -2255,3 +3075,6 @@ class ZoteroCollection(ZoteroObject):
 
     def __str__(self):
         return "<" + (self.name if self.name else ("#" + self.key)) + ">"
+
+    def filter_labels(self):
+        return (self.name, "#" + self.key)
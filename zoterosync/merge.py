@@ -1,59 +1,282 @@
 import functools
 import itertools
+import json
+import types
+import concurrent.futures
+import hashlib
+import random
+from zoterosync.lazy import lazy_import
 from zoterosync.library import Person
 from zoterosync.library import Creator
+from zoterosync.duplicates import name_key
 import re
 import logging
 
+editdistance = lazy_import("editdistance")
+
 logger = logging.getLogger('zoterosync.merge')
 
 
+def title_words(title):
+    """The words of a title, casefolded and without file extensions"""
+    return re.findall('\w+', re.sub('\.(pdf|ps|djvu?|webarchive|html?|mobi|ebook)', '', (title or '').casefold()))
+
+
+def block_keys(doc):
+    """Cheap blocking keys for a document: each pair of consecutive words of its title (the only word if there is
+       just one) and the first creator's last name together with the year"""
+    words = title_words(doc.title)
+    keys = {('title',) + tuple(words[i:i + 2]) for i in range(max(len(words) - 1, 1))} if words else set()
+    creators = doc.creators
+    if (creators):
+        year = re.search('\d{4}', doc.date or '')
+        keys.add(('creator', creators[0].creator.last_key, year.group(0) if year else None))
+    return keys
+
+
 class DuplicateFinder(object):
     """Given a distance function on a list of items finds duplicates using the rule that dist(x,y) < thres
-       Makes x, y duplicates then takes transitive closure.  Works on assumption that duplicates occur in clusters
-       and don't stretch out over whole space.  dist must satisfy triangle inequality.
+       makes x, y duplicates then takes the transitive closure with a union-find.  Only items sharing one of the
+       blocking keys returned by keys(item) are compared, so the work grows with the sizes of the blocks rather
+       than quadratically in the number of items.  A block stops taking members once it holds max_block items
+       so a key shared by most of the library costs at most max_block comparisons per item.  Without keys every
+       item is compared against every other.  More items can be added with process at any time.
     """
-    def __init__(self, items, dist, thres):
-        self.clusters = dict()
-        self.cluster_size = dict()
+
+    MaxBlock = 200
+
+    def __init__(self, items, dist, thres, keys=None, max_block=None):
         self.dist = dist
         self.thres = thres
+        self.keys = keys if keys is not None else (lambda item: (None,))
+        self.max_block = max_block if max_block is not None else self.MaxBlock
+        self.comparisons = 0
+        self._blocks = dict()
+        self._parent = dict()
+        self._size = dict()
         self.process(items)
 
-    def in_cluster(self, item, cluster):
-        if (self.dist(item, cluster) - self.cluster_size[cluster] >= self.thres):
-            return False
-        else:
-            for i in self.clusters[cluster]:
-                if self.dist(item, i) < self.thres:
-                    return True
-            return False
+    def find(self, item):
+        root = item
+        while (self._parent[root] is not root):
+            root = self._parent[root]
+        while (self._parent[item] is not root):  # path compression
+            self._parent[item], item = root, self._parent[item]
+        return root
+
+    def union(self, item, other):
+        item = self.find(item)
+        other = self.find(other)
+        if (item is other):
+            return item
+        if (self._size[item] < self._size[other]):
+            item, other = other, item
+        self._parent[other] = item
+        self._size[item] += self._size.pop(other)
+        return item
 
     def process(self, items):
         for i in items:
-            clust_iter = filter(lambda x: self.in_cluster(i, x), self.clusters.copy())
-            cluster = next(clust_iter, None)
-            if (cluster is not None):
-                self.clusters[cluster].append(i)
-                self.cluster_size[cluster] = max(self.cluster_size[cluster], self.dist(cluster, i))
-                clust_merge = next(clust_iter, None)
-                while(clust_merge is not None):
-                    self.clusters[cluster] = self.clusters[cluster].union(self.clusters[clust_merge])
-                    self.cluster_size[cluster] = functools.reduce(lambda x, y: max(x, self.dist(cluster, y), self.clusters[clust_merge], self.cluster_size[cluster]))
-                    del self.clusters[clust_merge]
-                    del self.cluster_size[clust_merge]
-                    clust_merge = next(clust_iter, None)
-            else:
-                self.clusters[i] = {i}
-                self.cluster_size[i] = 0
+            if (i in self._parent):
+                continue
+            self._parent[i] = i
+            self._size[i] = 1
+            for key in set(self.keys(i)):
+                block = self._blocks.setdefault(key, [])
+                for other in block:
+                    if (self.find(other) is not self.find(i)):
+                        self.comparisons += 1
+                        if (self.dist(i, other) < self.thres):
+                            self.union(i, other)
+                if (len(block) < self.max_block):
+                    block.append(i)
+
+    @property
+    def clusters(self):
+        """dict from the representative of each cluster to the set of items in it"""
+        clusters = dict()
+        for i in self._parent:
+            clusters.setdefault(self.find(i), set()).add(i)
+        return clusters
+
+    def duplicates(self):
+        return (c for c in self.clusters.values() if len(c) > 1)
+
+
+class TitleMinHash(object):
+    """MinHash signatures of the character shingles of titles plus the locality sensitive hashing band keys cut
+       from them.  Two titles whose shingle sets have Jaccard similarity s share a band key with probability
+       1 - (1 - s**rows)**bands, and bands and rows are picked so that curve rises at threshold.
+    """
+
+    def __init__(self, threshold=0.7, num_perm=64, shingle=4):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.bands, self.rows = self.lsh_bands(num_perm, threshold)
+        self._probes = None
+
+    @staticmethod
+    def lsh_bands(num_perm, threshold):
+        """(bands, rows) with bands * rows <= num_perm whose threshold (1/bands)**(1/rows) is closest to threshold"""
+        return min(((b, num_perm // b) for b in range(1, num_perm + 1)),
+                   key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+    def shingles(self, title):
+        text = ' '.join(title_words(title))
+        return frozenset(text[i:i + self.shingle] for i in range(len(text) - self.shingle + 1))
+
+    def _probe_order(self, lane):
+        rand = random.Random(lane)
+        return [rand.randrange(self.num_perm) for i in range(4 * self.num_perm)]
+
+    def signature(self, shingles):
+        """One permutation MinHash: a single 64 bit hash per shingle picks a lane and a value, each lane keeps its
+           minimum, and empty lanes are filled from other lanes in a fixed pseudo random order (optimal
+           densification) so that two signatures still agree in a lane with probability equal to the Jaccard
+           similarity.  Costs one hash per shingle rather than num_perm."""
+        lanes = [None] * self.num_perm
+        for sh in shingles:
+            value, lane = divmod(int.from_bytes(hashlib.blake2b(sh.encode('utf8'), digest_size=8).digest(), 'little'),
+                                 self.num_perm)
+            if (lanes[lane] is None or value < lanes[lane]):
+                lanes[lane] = value
+        if (None not in lanes):
+            return tuple(lanes)
+        if (self._probes is None):
+            self._probes = [self._probe_order(lane) for lane in range(self.num_perm)]
+        signature = []
+        for lane, value in enumerate(lanes):
+            if (value is None):
+                value = next((lanes[p] for p in self._probes[lane] if lanes[p] is not None), 0)
+            signature.append(value)
+        return tuple(signature)
+
+    def band_keys(self, signature):
+        return [(b,) + signature[b * self.rows:(b + 1) * self.rows] for b in range(self.bands)]
+
+    @staticmethod
+    def similarity(shingles, other):
+        return len(shingles & other) / len(shingles | other)
+
+
+class MergePolicy(object):
+    """Decides without asking whether a set of duplicates gets merged.  A policy holds accept, a list of rules
+       that are each a list of fields, and a set is accepted by the first rule whose fields all have the same non
+       empty normalized value in every document of the set (see normalized).  Sets no rule accepts are merged
+       only if otherwise is "accept".  Loaded from a JSON object like
+       {"accept": [["DOI"], ["ISBN"], ["title", "year"]], "otherwise": "skip"}, both keys optional.
+    """
+
+    Default = dict(accept=[["DOI"], ["ISBN"], ["title", "year"]], otherwise="skip")
+
+    def __init__(self, accept=None, otherwise="skip"):
+        if (otherwise not in ("skip", "accept")):
+            raise ValueError("otherwise must be skip or accept not " + repr(otherwise))
+        if (accept is not None and not (isinstance(accept, list) and all(
+                isinstance(rule, list) and all(isinstance(field, str) for field in rule) for rule in accept))):
+            raise ValueError("accept must be a list of rules, each a list of field names, not " + repr(accept))
+        self.accept = [list(rule) for rule in (accept if accept is not None else self.Default["accept"])]
+        self.otherwise = otherwise
+
+    @classmethod
+    def load(cls, path):
+        with open(str(path), encoding='utf8') as policy_file:
+            policy = json.load(policy_file)
+        if (not isinstance(policy, dict)):
+            raise ValueError("a merge policy is a JSON object with accept and otherwise, not " + type(policy).__name__)
+        return cls(accept=policy.get("accept"), otherwise=policy.get("otherwise", "skip"))
+
+    @staticmethod
+    def normalized(doc, field):
+        if (field == "title"):
+            return name_key(doc.title)
+        if (field == "year"):
+            year = re.search('\d{4}', doc.date or '')
+            return year.group(0) if year else None
+        val = doc[field]
+        if (not isinstance(val, str)):
+            return val
+        if (field == "DOI"):
+            return re.sub('\A(https?://(dx\.)?doi\.org/|doi:)', '', val.strip().casefold())
+        if (field == "ISBN"):
+            return re.sub('[^0-9x]', '', val.casefold())
+        return val.strip().casefold()
+
+    def decide(self, docs):
+        """The rule accepting docs joined with + ("otherwise" if accepted by default) or None to skip"""
+        for rule in self.accept:
+            values = [tuple(self.normalized(d, field) for field in rule) for d in docs]
+            if (all(values[0]) and all(v == values[0] for v in values)):
+                return "+".join(rule)
+        return "otherwise" if self.otherwise == "accept" else None
+
+
+class DocumentSnapshot(dict):
+    """The fields of a document a merge is built from, with related objects replaced by their keys and creators
+       by their dicts so it can be sent to another process"""
+
+    ObjectFields = ("children", "collections")
+
+    @classmethod
+    def of(cls, doc, fields):
+        snapshot = cls(key=doc.key, itemType=doc["itemType"])
+        for field in fields:
+            val = doc[field]
+            if (field in cls.ObjectFields and val is not None):
+                val = {o.key for o in val}
+            elif (field == "creators"):
+                val = [c.to_dict() for c in val]
+            snapshot[field] = val
+        return snapshot
+
+    def __missing__(self, field):
+        return None
+
+    def __getitem__(self, field):
+        val = super().__getitem__(field)
+        if (field == "creators" and val is not None):
+            return [Creator(d) for d in val]
+        return val
+
+    def __hash__(self):
+        return hash(self["key"])
+
+    def __eq__(self, other):
+        return self is other
+
+
+def _propose_merge(merger_cls, fields, snapshots):
+    """Builds a merge from DocumentSnapshots in a worker process, with creators returned as dicts"""
+    merger = merger_cls.__new__(merger_cls)
+    ZoteroDocumentMerger._detach(merger, fields)
+    merge = merger.propose_merge(snapshots)
+    if (merge.get("creators") is not None):
+        merge["creators"] = [c.to_dict() for c in merge["creators"]]
+    return merge
 
 
 class ZoteroDocumentMerger(object):
     """Base class to handle document merging.  Consumers should iterate over interactive_merge.
-       Implementors must override duplicates() to iterate over sets of duplicate documents"""
+       Implementors must override duplicates() to iterate over sets of duplicate documents.
+
+       If processes is more than one proposals are built by that many worker processes from DocumentSnapshots
+       of the duplicates, so merge_* methods overridden by subclasses must only depend on their vals and the
+       library's field tables.
+    """
 
-    def __init__(self, library):
+    def __init__(self, library, processes=None):
+        library.materialize()  # merges rewrite relations so stale copies of evicted objects must not exist
         self._library = library
+        self.processes = processes
+        self._merges = dict()
+        self._to_merge = None
+        self._cur_attr = None
+        self._cur_item_type = None
+
+    def _detach(self, fields):
+        self._library = fields
+        self.processes = None
         self._merges = dict()
         self._to_merge = None
         self._cur_attr = None
@@ -118,58 +341,113 @@ class ZoteroDocumentMerger(object):
             i.delete()
         for pkey in result:
             target[pkey] = result[pkey]
+        return target
 
     def interactive_merge(self):
         """Generator yields a tuple (tuple_of_docs_to_merge, proposed_merge) and expects either False or a dict
             specifying the result of the merger to be passed back."""
-        self.build_merges()
-        for tup in self._merges:
-            result = yield (tup, self._merges[tup])
+        for tup, merge in self.proposals(self.duplicates()):
+            result = yield (tup, merge)
             if (result):
                 self.apply_merge(tup, result)
         self._merges = dict()
+        self.merges_done()
+
+    def merges_done(self, undecided=()):
+        """Called once every proposed merge has been answered, bar the sets of duplicates in undecided"""
+        pass
 
     def duplicates(self):
         pass
 
     def build_merges(self):
         for dups in self.duplicates():
-            self._to_merge = tuple(dups)
-            keylist = functools.reduce(lambda x, y: x + y['key'] + ',', self._to_merge, "")
-            keylist = keylist[:-1]
-            logger.debug("Building merge for docs: %s", keylist)
-            merge = dict()
-            self._cur_item_type = self.merge_itemType([i['itemType'] for i in self._to_merge])
-            merge["itemType"] = self._cur_item_type
-            for field in set(itertools.chain(self._library.item_fields[self._cur_item_type], self._library.special_fields)):
-                merge[field] = self.attr_merge(field)
-            self._merges[self._to_merge] = merge
+            self.build_merge(dups)
+
+    def build_merge(self, dups):
+        merge = self.propose_merge(dups)
+        self._merges[self._to_merge] = merge
+        return merge
+
+    def propose_merge(self, dups):
+        self._to_merge = tuple(dups)
+        keylist = functools.reduce(lambda x, y: x + y['key'] + ',', self._to_merge, "")
+        keylist = keylist[:-1]
+        logger.debug("Building merge for docs: %s", keylist)
+        merge = dict()
+        self._cur_item_type = self.merge_itemType([i['itemType'] for i in self._to_merge])
+        merge["itemType"] = self._cur_item_type
+        for field in set(itertools.chain(self._library.item_fields[self._cur_item_type], self._library.special_fields)):
+            merge[field] = self.attr_merge(field)
+        return merge
+
+    def proposals(self, dup_sets):
+        """Yields (tuple_of_docs, proposed_merge) for each set of duplicates in order, each as soon as it's built.
+           With processes the sets are snapshotted up front and built in a process pool."""
+        dup_sets = [tuple(dups) for dups in dup_sets]
+        if (not self.processes or self.processes < 2 or len(dup_sets) < 2):
+            for tup in dup_sets:
+                yield tup, self.build_merge(tup)
+            return
+        lib = self._library
+        fields = types.SimpleNamespace(item_fields=lib.item_fields, special_fields=lib.special_fields,
+                                       item_creator_types=lib.item_creator_types)
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+        futures = []
+        try:
+            for tup in dup_sets:
+                snap_fields = set(itertools.chain(lib.special_fields, *(lib.item_fields.get(d["itemType"], ()) for d in tup)))
+                snapshots = tuple(DocumentSnapshot.of(d, snap_fields) for d in tup)
+                futures.append(pool.submit(_propose_merge, type(self), fields, snapshots))
+            for tup, future in zip(dup_sets, futures):
+                merge = future.result()
+                for field in DocumentSnapshot.ObjectFields:
+                    if (merge.get(field) is not None):
+                        merge[field] = {lib.get_obj_by_key(k) for k in merge[field]}
+                if (merge.get("creators") is not None):
+                    merge["creators"] = [Creator(d) for d in merge["creators"]]
+                self._merges[tup] = merge
+                yield tup, merge
+        finally:
+            for future in futures:
+                future.cancel()
+            pool.shutdown()
+
+    def batch_merge(self, policy):
+        """Non interactive counterpart of interactive_merge.  Each set of duplicates is decided by policy (a
+           MergePolicy), then the accepted merges are built and applied in one pass.  Returns a report with one
+           JSON serializable dict per set of duplicates."""
+        report = []
+        accepted = []
+        skipped = []
+        for dups in self.duplicates():
+            docs = tuple(sorted(dups, key=lambda d: d.key))
+            rule = policy.decide(docs)
+            entry = dict(documents=[d.key for d in docs], action="skipped" if rule is None else "merged", rule=rule)
+            if (rule is not None):
+                accepted.append((docs, entry))
+            else:
+                skipped.append(docs)
+            report.append(entry)
+        entries = dict(accepted)
+        for docs, merge in list(self.proposals(docs for docs, entry in accepted)):
+            entries[docs]["target"] = self.apply_merge(docs, merge).key
+        self._merges = dict()
+        self.merges_done(undecided=skipped)
+        logger.info("Batch merge merged %s of %s sets of duplicates", len(accepted), len(report))
+        return report
 
     def merge_creators(self, vals):
         logger.debug("Merge creators called with %s", str(vals))
         creators = [c.clean() for list in vals for c in list if c.type in self._library.item_creator_types[self._cur_item_type]]
         creators = [c for c in creators if c.creator]
-        grouping = dict()
-
-        def in_group(per, key):
-            return next(filter(lambda x: per.same(x), grouping[key]), False)
-
-        for p in (p.creator for p in creators):
-            match_iter = filter(lambda y: in_group(p, y), grouping.copy())
-            group = next(match_iter, False)
-            if (group):
-                grouping[group].add(p)
-                merge_group = next(match_iter, False)
-                while (merge_group):
-                    grouping[group].update(grouping[merge_group])
-                    del grouping[merge_group]
-                    merge_group = next(match_iter, False)
-            else:
-                grouping[p] = {p}
+        # people can only be the same if their normalized last names match so those key the blocks
+        finder = DuplicateFinder((c.creator for c in creators), lambda p, o: 0 if p.same(o) else 1, 1,
+                                 keys=lambda p: (p.last_key,), max_block=len(creators))
         mapping = dict()
-        for key in grouping:
-            merge_person = Person.merge(*(grouping[key]))
-            for i in grouping[key]:
+        for group in finder.clusters.values():
+            merge_person = Person.merge(*group)
+            for i in group:
                 mapping[i] = merge_person
         used = set()
         result = []
@@ -186,24 +464,72 @@ class ZoteroDocumentMerger(object):
 class SimpleZDocMerger(ZoteroDocumentMerger):
     """Merges documents based on having the same title string ignoring case and punctuation"""
 
-    def __init__(self, library):
-        super().__init__(library)
+    def __init__(self, library, processes=None):
+        super().__init__(library, processes=processes)
         self._buckets = dict()
+        self._examining = set()
         self.find_duplicates()
 
     @staticmethod
     def build_name_key(string):
-        result = re.sub('\.(pdf|ps|djvu?|webarchive|html?|mobi|ebook)', '', string.casefold())
-        result = re.sub('\W', '', result)
-        return result
+        return name_key(string)
 
     def find_duplicates(self):
-        for i in self._library.documents:
-            namekey = self.build_name_key(i.title)
-            if (len(namekey) > 3):
-                if namekey not in self._buckets:
-                    self._buckets[namekey] = set()
-                self._buckets[namekey].add(i)
+        # the library keeps the buckets up to date, only the ones changed since the last run need a look
+        self._examining, buckets = self._library.duplicate_index.candidates(self._library)
+        for namekey, keys in buckets.items():
+            self._buckets[namekey] = {self._library.get_obj_by_key(k) for k in keys}
+
+    def merges_done(self, undecided=()):
+        # sets left undecided stay pending for the next run
+        names = {self.build_name_key(next(iter(dups)).title) for dups in undecided}
+        self._library.duplicate_index.mark_examined(self._examining - names)
 
     def duplicates(self):
         yield from self._buckets.values()
+
+
+class FuzzyZDocMerger(ZoteroDocumentMerger):
+    """Merges documents whose titles (ignoring case and punctuation) are within a relative edit distance of thres,
+       using DuplicateFinder with block_keys so only documents sharing a title word pair or first creator and
+       year are compared"""
+
+    def __init__(self, library, thres=0.1, processes=None):
+        super().__init__(library, processes=processes)
+        self._name_keys = {d: SimpleZDocMerger.build_name_key(d.title) for d in self._library.documents}
+        docs = (d for d, namekey in self._name_keys.items() if len(namekey) > 3)
+        self._finder = DuplicateFinder(docs, self.title_distance, thres, keys=block_keys)
+
+    def title_distance(self, doc, other):
+        key = self._name_keys[doc]
+        okey = self._name_keys[other]
+        return editdistance.eval(key, okey) / max(len(key), len(okey))
+
+    def duplicates(self):
+        yield from self._finder.duplicates()
+
+
+class MinHashZDocMerger(ZoteroDocumentMerger):
+    """Merges documents whose title shingle sets have Jaccard similarity above threshold.  Candidates are the
+       documents sharing a MinHash LSH band (see TitleMinHash) which DuplicateFinder then checks exactly, so
+       titles differing by a typo, a subtitle or a leading article are found without comparing every pair."""
+
+    def __init__(self, library, threshold=0.7, processes=None):
+        super().__init__(library, processes=processes)
+        self.minhash = TitleMinHash(threshold=threshold)
+        self._shingles = dict()
+        signatures = dict()
+        for doc in self._library.documents:
+            shingles = self.minhash.shingles(doc.title)
+            if (shingles):
+                self._shingles[doc] = shingles
+                if (shingles not in signatures):
+                    signatures[shingles] = self.minhash.signature(shingles)
+        self._finder = DuplicateFinder(self._shingles, self.title_distance, 1 - threshold,
+                                       keys=lambda d: self.minhash.band_keys(signatures[self._shingles[d]]))
+
+    def title_distance(self, doc, other):
+        return 1 - self.minhash.similarity(self._shingles[doc], self._shingles[other])
+
+    def duplicates(self):
+        yield from self._finder.duplicates()
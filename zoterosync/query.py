@@ -0,0 +1,198 @@
+import re
+import logging
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+logger = logging.getLogger('zoterosync.query')
+
+
+def element_labels(x):
+    """The strings a filter regex is tried on for an element of a list or set field"""
+    labels = getattr(x, "filter_labels", None)
+    return labels() if labels is not None else (str(x),)
+
+
+def field_matches(obj, field, rex):
+    """The filter of lsdoc, lsattach and lscol: rex matches the field's string form or, for a list or set
+       field, a label of one of its elements"""
+    val = obj[field]
+    if (isinstance(val, (list, set)) and any(rex.match(label) for x in val for label in element_labels(x))):
+        return True
+    return bool(rex.match(str(val)))
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _parse(pattern):
+    try:
+        return sre_parse.parse(pattern)
+    except re.error:
+        return None
+
+
+def required_literals(pattern):
+    """Runs of literal characters (casefolded) found in every string pattern matches.  Only the top level of
+       the pattern is looked at, anything else just ends a run, which is enough to pick trigram candidates."""
+    parsed = _parse(pattern)
+    if (parsed is None):
+        return []
+    runs, run = [], ""
+    for op, arg in parsed:
+        if (op is sre_parse.LITERAL):
+            run += chr(arg)
+        else:
+            runs.append(run)
+            run = ""
+    runs.append(run)
+    return [r.casefold() for r in runs if r]
+
+
+def starts_with_literal(pattern, excluded):
+    """Whether every match of pattern starts with a literal character, casefolded not in excluded"""
+    parsed = _parse(pattern)
+    if (not parsed):
+        return False
+    op, arg = parsed[0]
+    return op is sre_parse.LITERAL and chr(arg).casefold() not in excluded
+
+
+class QueryIndex(object):
+    """Secondary indexes over the items of a library answering the field filters of lsdoc and lsattach without
+       visiting every item.
+
+       Each index maps labels to the keys of the items filed under them:
+
+       - tags, itemType and key: the strings field_matches tries the filter regex on, so a filter resolves by
+         matching the (far fewer) labels and joining their items,
+       - creators: the "type\\nfirst last" label of each creator (field_matches again),
+       - collections: collection key -> member keys, the filter is matched against the collections themselves,
+       - title: trigrams of the casefolded title.  A filter only narrows down candidates through the literals
+         it requires (see required_literals) and is then checked on each candidate.
+
+       An index is built on the first filter on its field and from then on kept up to date like FieldColumns:
+       the library reports every touched item through invalidate and sync refiles just those.
+    """
+
+    Labelled = ("tags", "itemType", "key", "creators", "collections")
+    Containers = ("tags", "creators", "collections")
+    ContainerStarts = ("{", "[", "s")  # how str() of a set or list (or "set()") starts
+    Columns = ("itemType", "key", "title")  # can be built from FieldColumns without hydrating items
+
+    def __init__(self, kind):
+        self.kind = kind  # the class of the objects indexed
+        self._indexes = dict()  # field -> label -> set of item keys
+        self._filed = dict()  # field -> item key -> labels
+        self._stale = set()
+
+    def invalidate(self, item):
+        if (self._indexes):
+            self._stale.add(item)
+
+    def release(self, item):
+        """item is about to be evicted, its entries have to be current as it won't be touched again"""
+        if (item in self._stale):
+            self._stale.discard(item)
+            self._file(item)
+
+    @staticmethod
+    def labels(item, field):
+        if (field == "collections"):
+            return {c.key for c in item.collections}
+        elif (field == "title"):
+            return trigrams(str(item["title"]).casefold())
+        elif (field in QueryIndex.Containers):
+            return {label for x in item[field] for label in element_labels(x)}
+        return {str(item[field])}
+
+    def _add(self, field, key, labels):
+        index = self._indexes[field]
+        self._filed[field][key] = labels
+        for label in labels:
+            index.setdefault(label, set()).add(key)
+
+    def _discard(self, field, key):
+        index = self._indexes[field]
+        for label in self._filed[field].pop(key, ()):
+            keys = index[label]
+            keys.discard(key)
+            if (not keys):
+                del index[label]
+
+    def _file(self, item, held=True):
+        for field in self._indexes:
+            self._discard(field, item.key)
+            if (held):
+                self._add(field, item.key, self.labels(item, field))
+
+    def _build(self, library, field):
+        from_columns = (field in self.Columns and library.columns is not None)
+        self.sync(library)
+        self._indexes[field] = dict()
+        self._filed[field] = dict()
+        if (from_columns):
+            columns = library.columns
+            column = columns.columns[field]
+            for r in columns.rows(self.kind):
+                value = column[r]
+                labels = trigrams(str(value).casefold()) if (field == "title") else {str(value)}
+                self._add(field, columns.columns["key"][r], labels)
+        else:
+            for items in (library.documents, library.attachments):
+                for item in items:
+                    self._add(field, item.key, self.labels(item, field))
+        logger.debug("Built %s query index with %s labels", field, len(self._indexes[field]))
+
+    def sync(self, library):
+        for item in self._stale:
+            self._file(item, held=library._holds(item))
+        self._stale = set()
+
+    def index(self, library, field):
+        """The label -> item keys index of field, brought up to date"""
+        if (field not in self._indexes):
+            self._build(library, field)
+        self.sync(library)
+        return self._indexes[field]
+
+    def lookup(self, library, field, pattern):
+        """(keys, exact): the keys of the items a filter of pattern on field can match and whether all of those
+           do match, or (None, False) when the filter has to be checked on every item"""
+        if (field in self.Containers and not starts_with_literal(pattern, self.ContainerStarts)):
+            return None, False  # the regex might match the str() of the whole container
+        if (field in self.Labelled):
+            rex = re.compile(pattern)
+            index = self.index(library, field)
+            if (field == "collections"):
+                labels = [c.key for c in library.collections if any(rex.match(s) for s in c.filter_labels())]
+            else:
+                labels = [label for label in index if rex.match(label)]
+            keys = set()
+            for label in labels:
+                keys.update(index.get(label, ()))
+            return keys, True
+        elif (field == "title"):
+            grams = set()
+            for literal in required_literals(pattern):
+                grams.update(trigrams(literal))
+            if (not grams):
+                return None, False
+            index = self.index(library, field)
+            postings = sorted((index.get(g, set()) for g in grams), key=len)
+            return set(postings[0]).intersection(*postings[1:]), False
+        return None, False
+
+    def resolve(self, library, regexps):
+        """Resolves the filters in regexps (field -> pattern) through the indexes.  Returns (keys, remaining): the keys of the candidate items, None if no filter could be resolved,
+           and the filters still to be checked on each candidate."""
+        keys, remaining = None, dict()
+        for field, pattern in regexps.items():
+            found, exact = self.lookup(library, field, pattern)
+            if (found is not None):
+                keys = found if keys is None else keys & found
+            if (not exact):
+                remaining[field] = pattern
+        return keys, remaining
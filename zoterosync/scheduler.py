@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger('zoterosync.scheduler')
+
+
+Interval = 60.0  # seconds between syncs while the library changes
+MaxInterval = 900.0  # polls of an unchanged library back off up to this
+
+
+class SyncScheduler(object):
+    """Keeps the library of a loaded ZoteroLibraryStore in sync with the server from a long running process
+       (zotero serve --sync) instead of a pull and push reloading the library on every cron run.
+
+       Each step pushes the local changes waiting, if any, then asks the server for its library version
+       (see ZoteroLibrary.server_changed) and only pulls when it moved.  The wait before the next step doubles
+       from interval up to max_interval while neither side changes or the server can't be reached, and goes
+       back to interval on any change.  Local changes don't wait for a backed off poll: they are pushed at
+       most interval seconds after the last step, unless it failed.
+
+       metrics holds the counts of steps, polls, pulls, pushes and errors, the time (last_sync) and duration
+       (last_sync_latency) of the last successful step and queue_depth, the objects still waiting for a
+       push.  They are written to metrics_path as JSON after each step if given.
+    """
+
+    def __init__(self, store, interval=Interval, max_interval=MaxInterval, metrics_path=None, clock=time.monotonic):
+        self.store = store
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.metrics_path = metrics_path
+        self.clock = clock
+        self.wait = interval
+        self._last_step = None
+        self._failed = False
+        self.metrics = dict(steps=0, polls=0, pulls=0, pushes=0, unchanged=0, errors=0, last_sync=None,
+                            last_sync_latency=None, last_error=None, queue_depth=0, interval=interval)
+
+    def next_step(self):
+        """The clock time of the next step, right away if there was none yet"""
+        if (self._last_step is None):
+            return self.clock()
+        wait = self.wait
+        if (self.store.library.num_unpushed and not self._failed):
+            wait = min(wait, self.interval)
+        return self._last_step + wait
+
+    def timeout(self):
+        """Seconds until the next step is due"""
+        return max(0.0, self.next_step() - self.clock())
+
+    def due(self):
+        return self.timeout() == 0
+
+    def step(self):
+        """Pushes and pulls what changed, returns whether anything did.  Errors are logged and counted, not
+           raised, so a server that can't be reached just backs the scheduler off."""
+        library = self.store.library
+        start = self.clock()
+        self._last_step = start
+        self.metrics["steps"] += 1
+        changed = False
+        self._failed = True
+        try:
+            if (library.num_unpushed):
+                logger.info("Pushing %s changed objects", library.num_unpushed)
+                self.store.push()
+                self.metrics["pushes"] += 1
+                changed = True
+            self.metrics["polls"] += 1
+            if (library.server_changed()):
+                self.store.pull(threads=library.fetch_threads)
+                self.store.write_library()
+                self.metrics["pulls"] += 1
+                changed = True
+            else:
+                self.metrics["unchanged"] += 1
+        except Exception as e:
+            logger.exception("Sync failed")
+            self.metrics["errors"] += 1
+            self.metrics["last_error"] = "{}: {}".format(type(e).__name__, e)
+            self.wait = min(self.wait * 2, self.max_interval)
+        else:
+            self._failed = False
+            self.wait = self.interval if changed else min(self.wait * 2, self.max_interval)
+            self.metrics["last_sync"] = time.time()
+            self.metrics["last_sync_latency"] = self.clock() - start
+        self.metrics["queue_depth"] = library.num_unpushed
+        self.metrics["interval"] = self.wait
+        logger.info("Sync step %s: changed %s, latency %.3fs, queue depth %s, next in %.0fs", self.metrics["steps"],
+                    changed, self.clock() - start, self.metrics["queue_depth"], self.wait)
+        self.write_metrics()
+        return changed
+
+    def write_metrics(self):
+        if (self.metrics_path is None):
+            return
+        tmp = self.metrics_path.with_name(self.metrics_path.name + ".tmp")
+        with tmp.open(mode='w') as metrics_file:
+            json.dump(self.metrics, metrics_file, indent=1)
+        os.replace(str(tmp), str(self.metrics_path))
@@ -1,5 +1,6 @@
 import os
 import click
+import zoterosync.library
 from zoterosync.library import ZoteroLibrary
 from zoterosync.library import ZoteroObject
 from zoterosync.library import ZoteroDocument
@@ -8,16 +9,31 @@ from zoterosync.library import ZoteroLinkedFile
 from zoterosync.library import ZoteroImportedFile
 from zoterosync.library import ZoteroImportedUrl
 from zoterosync.library import ZoteroCollection
-from zoterosync.library import Creator
+from zoterosync.database import LibraryDatabase
+from zoterosync.columns import FieldColumns
+from zoterosync.query import field_matches
+from zoterosync import export
+from zoterosync import daemon
+from zoterosync import scheduler
+from zoterosync.lazy import lazy_import
 from pathlib import Path
 import json
+import itertools
 import pickle
 from shutil import copyfile
 import shutil
 from zoterosync.merge import SimpleZDocMerger
+from zoterosync.merge import FuzzyZDocMerger
+from zoterosync.merge import MinHashZDocMerger
+from zoterosync.merge import MergePolicy
+import sys
+import signal
+import time
 import logging
 import re
 
+filecmp = lazy_import("filecmp")
+
 logger = logging.getLogger('zoterosync.cli')
 
 
@@ -173,14 +189,33 @@ class ZoteroLibraryStore(object):
         self.zoterodir = None
         self._conf_path = conf_path
         self._num_backups = num_backups
+        self._full_write = True
+        self._database = None
+        self.cache_size = ZoteroLibrary.DefaultCacheSize
+        self.served = False  # by zotero serve: writes wait for flush and nothing can be asked interactively
+        self.write_pending = False
+        self.scheduler = None  # the SyncScheduler of zotero serve --sync
         self.load()
 
     def load(self):
         self.load_config()
+        self.open_hash_cache()
         if self.library_path:
             self.load_library()
 
-    def pull(self):
+    def open_hash_cache(self):
+        """Keeps attachment md5s in zoterodir so unchanged files are not rehashed on every run"""
+        if (self.zoterodir and self.zoterodir.is_dir()):
+            zoterosync.library.hash_cache.open(self.zoterodir.joinpath('md5_cache'))
+
+    def close(self):
+        zoterosync.library.hash_cache.close()
+        if (self._database is not None):
+            self._database.close()
+            self._database = None
+
+    def pull(self, threads=1):
+        self.library.fetch_threads = threads
         self.library.pull()
         self.dirty = True
 
@@ -197,6 +232,7 @@ class ZoteroLibraryStore(object):
                 self.user = config['user']
                 self.apikey = config['apikey']
                 self._num_backups = config.get('backups', self._num_backups)
+                self.cache_size = config.get('cache_size', self.cache_size)
                 if ('library' in config):
                     self.library_path = Path(config['library'])
                 if ('datadir' in config):
@@ -211,7 +247,7 @@ class ZoteroLibraryStore(object):
             conf_path = self._conf_path
         if (self.user is None or self.apikey is None):
             raise Exception("")
-        config = dict(user=self.user, apikey=self.apikey, backups=self._num_backups)
+        config = dict(user=self.user, apikey=self.apikey, backups=self._num_backups, cache_size=self.cache_size)
         if (self.library_path):
             config['library'] = str(self.library_path)
         if (self.datadir):
@@ -224,9 +260,13 @@ class ZoteroLibraryStore(object):
 
     def init_library(self):
         self.library = ZoteroLibrary.factory(self.user, self.apikey)
+        self.library.enable_columns()
         self.dirty = True
         self.dangerous = True
         self.library.checkpoint_function = self.write_library
+        self._full_write = True
+        if (self.library_path):
+            self.library.journal_path = self.library_path.with_suffix('.journal')
         if (self.datadir):
             self.library.datadir = self.datadir
             self.library.use_relative_paths = False
@@ -240,26 +280,67 @@ class ZoteroLibraryStore(object):
         if (self.dangerous and not self.force):
             click.echo("Pass the --force option to enable dangerous changes!")
             raise Exception("Can't save non-existant library")
-        if (dest is None):
-            dest = self.library_path
-        with dest.open(mode='wb') as lib_file:
-            pickle.dump(self.library, lib_file)
+        if (dest is None and self.served):
+            self.write_pending = True
+            return True
+        return self._write_library(self.library_path if dest is None else dest)
+
+    def flush(self):
+        """Writes the library if a deferred write_library is pending"""
+        if (self.write_pending):
+            self._write_library(self.library_path)
+            self.write_pending = False
+            logger.info("Wrote library to %s", self.library_path)
+
+    def checkpoint(self):
+        """Writes the library right away even while writes are deferred, for the checkpoints of a pull"""
+        self.write_pending = True
+        self.flush()
+
+    def _write_library(self, dest):
+        full = dest != self.library_path or self._full_write
+        if (full):
+            self.library.materialize()
+            if (dest == self.library_path and self._database is not None):
+                self._database.close()
+                self._database = None
+            if (dest.exists()):
+                dest.unlink()  # replaces a legacy pickle or a stale copy
+        if (dest != self.library_path):
+            LibraryDatabase(dest).write(self.library, full=True, saved=False)
+            return True
+        if (self._database is None):
+            self._database = LibraryDatabase(dest)
+        self._database.write(self.library, full=full)
+        self._full_write = False
+        self.library.truncate_journal()
         return True
 
     def load_library(self):
         if (self.library_path is None):
             raise Exception("Must specify library path to load library")
         try:
-            with self.library_path.open(mode='rb') as lib_file:
-                self.library = pickle.load(lib_file)
-                self.library.checkpoint_function = self.write_library
-                if (self.datadir):
-                    self.library.datadir = self.datadir
-                    self.library.use_relative_paths = False
-                if (self.zoterodir):
-                    self.library.zoterodir = self.zoterodir
+            if (LibraryDatabase.is_database(self.library_path)):
+                self._database = LibraryDatabase(self.library_path)
+                self.library = ZoteroLibrary.factory(self.user, self.apikey)
+                self.library.enable_columns()
+                self._database.read(self.library, lazy=True, cache_size=self.cache_size)
+                self._full_write = False
+            else:
+                with self.library_path.open(mode='rb') as lib_file:
+                    self.library = pickle.load(lib_file)
+                logger.info("Loaded legacy pickled library, it will be converted on the next save")
+                self.library.enable_columns()
+                self._full_write = True
         except (IOError, FileNotFoundError, PermissionError):
             return False
+        self.library.checkpoint_function = self.write_library
+        self.library.journal_path = self.library_path.with_suffix('.journal')
+        if (self.datadir):
+            self.library.datadir = self.datadir
+            self.library.use_relative_paths = False
+        if (self.zoterodir):
+            self.library.zoterodir = self.zoterodir
         return True
 
     def backup_library(self):
@@ -336,74 +417,103 @@ class ZoteroLibraryStore(object):
             pass
         click.echo("Finished Merge!!")
 
-    def match_objects(self, object_type, modified={True, False}, deleted=False, regexps=None):
-        if (regexps is None):
-            regexps = dict()
-        objs = set()
+    def _select(self, object_type, modified, deleted, regexps):
+        """(objs, rows, regexps left): the candidates for the filters in regexps (field -> regex) and the filters
+           still to check on each of them.  With library columns (and not listing deleted objects) the candidates
+           are the rows of the columns, so they can be sorted and paged before any object is hydrated, and objs
+           is None.  Otherwise rows is None."""
+        regexps = dict(regexps) if regexps else dict()
         if deleted:
-            objs = {d for d in self.library.deleted_objects if isinstance(d, object_type)}
+            return {d for d in self.library.deleted_objects if isinstance(d, object_type)}, None, regexps
+        elif (object_type == ZoteroCollection):
+            return self.library.collections, None, regexps
+        # resolve what the query indexes can and only visit the candidates
+        keys, regexps = self.library.query_index.resolve(self.library, regexps)
+        columns = self.library.columns
+        if (columns is not None):
+            # filter on the hot fields column by column and only visit the objects that pass
+            rows = columns.rows(object_type) if (keys is None) else columns.rows_of(keys, object_type)
+            rows = columns.filter(rows, "dirty", lambda v: bool(v) in modified)
+            for pkey in [k for k in regexps if k in FieldColumns.Fields]:
+                rex = re.compile(regexps[pkey])
+                rows = columns.filter(rows, pkey, lambda v: rex.match(str(v)))
+            return None, rows, {k: v for k, v in regexps.items() if k not in FieldColumns.Fields}
+        elif (keys is not None):
+            objs = (self.library.get_obj_by_key(k) for k in keys)
+            objs = (d for d in objs if isinstance(d, object_type))
+        elif (object_type == ZoteroDocument):
+            objs = self.library.documents
         else:
-            if (object_type == ZoteroDocument):
-                objs = self.library.documents
-            elif (object_type == ZoteroAttachment):
-                objs = self.library.attachments
-            elif (object_type == ZoteroCollection):
-                objs = self.library.collections
-        objs = {d for d in objs if d.dirty in modified}
-
-        def filter_func(x):
-            if (isinstance(x, Creator)):
-                return rex.match(x.type + "\n" + x.firstname + " " + x.lastname)
-            elif (isinstance(x, ZoteroCollection)):
-                if (rex.match(x.name) or rex.match("#" + x.key)):
-                    return True
-            elif (isinstance(x, ZoteroDocument)):
-                if (rex.match(x.title) or rex.match("#" + x.key)):
-                    return True
-            elif (isinstance(x, ZoteroAttachment)):
-                if (rex.match(x.link_mode + "\n" + x.name) or rex.match("#" + x.key)):
-                    return True
-            else:
-                return rex.match(str(x))
+            objs = self.library.attachments
+        return objs, None, regexps
+
+    @staticmethod
+    def _matching(objs, modified, regexps):
+        rexes = [(pkey, re.compile(regex)) for pkey, regex in regexps.items()]
+        for d in objs:
+            if (d.dirty in modified and all(field_matches(d, pkey, rex) for pkey, rex in rexes)):
+                yield d
+
+    def iter_objects(self, object_type, modified={True, False}, deleted=False, regexps=None):
+        """Generates the objects of object_type matching regexps (field -> regex), visiting them lazily"""
+        objs, rows, regexps = self._select(object_type, modified, deleted, regexps)
+        if (rows is not None):
+            objs = self.library.columns.objects_at(rows, self.library)
+        return self._matching(objs, modified, regexps)
 
-        def match_element(container):
-            return next(filter(filter_func, container), False)
-
-        for pkey in regexps:
-            rex = re.compile(regexps[pkey])
-            objs = {d for d in objs if (((isinstance(d[pkey], list) or isinstance(d[pkey], set)) and match_element(d[pkey])) or
-                                        rex.match(str(d[pkey])))}
-        return objs
+    def match_objects(self, object_type, modified={True, False}, deleted=False, regexps=None):
+        return set(self.iter_objects(object_type, modified=modified, deleted=deleted, regexps=regexps))
 
     def list_objects(self, object_type=ZoteroDocument, long=False, modified={True, False}, deleted=False, sortby=None, reverse=False, full=False,
-                     regexps=None, missing=None):
+                     regexps=None, missing=None, limit=None, offset=0, export_format=None, output='-'):
+        """Echoes the matching objects as they are found.  A sorted listing only sorts the objects by their sort
+           key and renders them afterwards, sorting by a column of the library sorts its rows so only the
+           objects of the page shown get hydrated.  limit and offset select a page, in key order unless sorted.
+           export_format writes the Zotero data of the objects to output (a path or '-') in one of
+           export.Formats instead, and the summary goes to stderr."""
+        objs, rows, regexps = self._select(object_type, modified, deleted, regexps)
+        if (sortby is None and (limit is not None or offset)):
+            sortby = "key"  # pages have to come from the same order every time
+        if (rows is not None):
+            if (sortby in FieldColumns.Fields):
+                rows = self.library.columns.sort(rows, sortby, reverse=reverse)
+                sortby = None
+            if (sortby is None and not regexps and missing is None):  # every row is listed, page them right away
+                rows = rows[offset:None if limit is None else offset + limit]
+                offset = 0
+            objs = self.library.columns.objects_at(rows, self.library)
+        objs = self._matching(objs, modified, regexps)
+        if (missing is not None):
+            objs = (obj for obj in objs if obj.missing in missing)
+        if (sortby is not None):
+            objs = sorted(objs, key=lambda obj: obj[sortby], reverse=reverse)
+        objs = itertools.islice(objs, offset, None if limit is None else offset + limit)
         displayed = 0
-        objs = self.match_objects(object_type, modified=modified, deleted=deleted, regexps=regexps)
-        output = dict()
-        for obj in objs:
-            if (obj.dirty in modified and (missing is None or obj.missing in missing)):
+        if (export_format is not None):
+            fields = export.export_fields(self.library, object_type)
+            with click.open_file(output, "wb" if export_format in export.Binary else "w") as stream:
+                displayed = export.export_objects(objs, export_format, stream, fields)
+        else:
+            for obj in objs:
                 displayed += 1
-                order_key = obj[sortby] if sortby else displayed
-                output[order_key] = output.get(order_key, "") + style_obj_listing(obj, long=long, full=full) + "\n"
-        out = ""
-        for i in sorted(output.keys(), reverse=reverse):
-            out += output[i]
-        click.echo(out)
+                click.echo(style_obj_listing(obj, long=long, full=full))
+            click.echo()
+        err = export_format is not None
         if (object_type == ZoteroDocument):
             if deleted:
-                click.secho("Displayed {} deleted docs from library with {} non-deleted docs".format(displayed, len(self.library.documents)), bold=True)
+                click.secho("Displayed {} deleted docs from library with {} non-deleted docs".format(displayed, len(self.library.documents)), bold=True, err=err)
             else:
-                click.secho("Displayed {} docs / {} total (non-deleted) docs".format(displayed, len(self.library.documents)), bold=True)
+                click.secho("Displayed {} docs / {} total (non-deleted) docs".format(displayed, len(self.library.documents)), bold=True, err=err)
         elif (object_type == ZoteroAttachment):
             if deleted:
-                click.secho("Displayed {} deleted attachments from library with {} non-deleted attachments".format(displayed, len(self.library.attachments)), bold=True)
+                click.secho("Displayed {} deleted attachments from library with {} non-deleted attachments".format(displayed, len(self.library.attachments)), bold=True, err=err)
             else:
-                click.secho("Displayed {} attachments / {} total (non-deleted) attachments".format(displayed, len(self.library.attachments)), bold=True)
+                click.secho("Displayed {} attachments / {} total (non-deleted) attachments".format(displayed, len(self.library.attachments)), bold=True, err=err)
         elif (object_type == ZoteroCollection):
             if deleted:
-                click.secho("Displayed {} deleted collections from library with {} non-deleted collections".format(displayed, len(self.library.collections)), bold=True)
+                click.secho("Displayed {} deleted collections from library with {} non-deleted collections".format(displayed, len(self.library.collections)), bold=True, err=err)
             else:
-                click.secho("Displayed {} collections / {} total (non-deleted) collections".format(displayed, len(self.library.collections)), bold=True)
+                click.secho("Displayed {} collections / {} total (non-deleted) collections".format(displayed, len(self.library.collections)), bold=True, err=err)
 
     def find_file(self, attach, attach_path, directory):
         tail = Path('')
@@ -417,12 +527,13 @@ class ZoteroLibraryStore(object):
                 attach.path = path
                 break
 
-    def find_files(self, filetype=ZoteroLinkedFile, directory=None, relaxed=False):
+    def find_files(self, filetype=ZoteroLinkedFile, directory=None, relaxed=False, threads=None):
         if (directory is None):
             if (self.datadir):
                 directory = self.datadir
             else:
                 raise Exception("No directory specified")
+        self.library.prefetch_hashes([a for a in self.library.attachments if isinstance(a, filetype)], threads=threads)
         if (filetype == ZoteroLinkedFile):
             genexp = (l for l in self.library.attachments if (isinstance(l, ZoteroLinkedFile) and l.missing and l.path))
         elif (filetype == ZoteroImportedFile):
@@ -448,10 +559,31 @@ class ZoteroLibraryStore(object):
                     logger.info("Replacing path %s with %s in %s", str(linked.path), str(newpath), '#' + str(linked.key))
                     linked.path = newpath
 
-    def dedup_child_files(self):
+    def dedup_child_files(self, threads=None):
+        self.library.prefetch_hashes(threads=threads)
         for doc in self.library.documents:
             doc.remove_dup_child_files()
 
+    def dedup_attachments(self, dry_run=False, batch_size=50):
+        """Removes identical attachments across the whole library, see ZoteroLibrary.duplicate_attachment_removals.
+        Deletions are checkpointed every batch_size attachments"""
+        plan = self.library.duplicate_attachment_removals()
+        removals = [attach for kept, removed in plan for attach in removed]
+        for kept, removed in plan:
+            parent = kept.parent.name if kept.parent else "(top level)"
+            click.echo("{} {} in {}".format(click.style('#' + kept.key, bold=True), kept.title, parent))
+            for attach in removed:
+                click.echo("  - {} {}".format('#' + attach.key, attach.title))
+        if (dry_run):
+            click.secho("Would delete {} duplicate attachments".format(len(removals)), bold=True)
+            return
+        for start in range(0, len(removals), batch_size):
+            for attach in removals[start:start + batch_size]:
+                attach.delete()
+            logger.info("Deleted %s of %s duplicate attachments", min(start + batch_size, len(removals)), len(removals))
+            self.write_library()
+        click.secho("Deleted {} duplicate attachments".format(len(removals)), bold=True)
+
     def fix(self):
         logger.info("Fixing attachments with no real parent")
         for attach in self.library.attachments:
@@ -520,7 +652,15 @@ class ZoteroLibraryStore(object):
                 shutil.move(str(f), str(dest))
 
 
-@click.group()
+class ServedGroup(click.Group):
+    """Keeps the command line of the subcommand for handing it to a running zotero serve (see cli)"""
+
+    def invoke(self, ctx):
+        ctx.meta["zoterosync.args"] = list(ctx.protected_args) + list(ctx.args)
+        return super().invoke(ctx)
+
+
+@click.group(cls=ServedGroup)
 @click.option('--config', '-c', type=click.Path(), default=os.path.expanduser('~/.zotero/zotero_config'), envvar="ZOTERO_CONFIG",
               help="File storing zoterosync config in human readable format.\nPulled from enviornment variable ZOTEROSYNC_CONFIG or default to ~/.zotero/zotero_config\nIf passed a directory DIR defaults to DIR/zotero_config")
 @click.pass_context
@@ -531,7 +671,67 @@ def cli(ctx, config):
         zoterodir.mkdir(exist_ok=True)
     if conf_path.is_dir():
         conf_path = conf_path.joinpath('zotero_config')
+    if (ctx.obj is not None):  # run by zotero serve on the store it keeps loaded
+        return
+    path = daemon.socket_path(conf_path)
+    if (ctx.invoked_subcommand != "serve" and path.exists()):
+        if (ctx.invoked_subcommand in NotServed and daemon.running(path)):
+            raise click.UsageError("zotero serve is running for this config, stop it first with zotero serve --stop")
+        args = ["--config", str(conf_path)] + ctx.meta["zoterosync.args"]
+        status = daemon.request(path, dict(args=args, cwd=os.getcwd(), color=sys.stdout.isatty() or None),
+                                sys.stdout, sys.stderr)
+        if (status is not None):
+            ctx.exit(status)
     ctx.obj = ZoteroLibraryStore(conf_path=conf_path)
+    ctx.call_on_close(ctx.obj.close)
+
+
+# commands replacing the library file or config, which a running zotero serve would overwrite
+NotServed = ("conf", "reset", "revert", "backup")
+
+
+@cli.command()
+@click.option('--idle-flush', default=daemon.IdleFlush, type=click.FloatRange(min=0),
+              help="Seconds without a request after which changes are written to the library, 0 to only write on exit.")
+@click.option('--stop', is_flag=True, help="Stop the running daemon once it has written the library.")
+@click.option('--sync', 'sync_interval', type=click.FloatRange(min=1), default=None,
+              help="Also push and pull in the background, polling the server every this many seconds.")
+@click.option('--max-interval', type=click.FloatRange(min=1), default=scheduler.MaxInterval,
+              help="Polls of an unchanged library back off up to this many seconds.")
+@click.option('--metrics', type=click.Path(dir_okay=False), default=None,
+              help="JSON file the sync metrics are written to after each sync.")
+@click.pass_obj
+def serve(store, idle_flush, stop, sync_interval, max_interval, metrics):
+    """Keep the library loaded and answer the zotero commands run meanwhile over a Unix domain socket"""
+    path = daemon.socket_path(store._conf_path)
+    if stop:
+        if (daemon.request(path, dict(stop=True), sys.stdout, sys.stderr) is None):
+            raise click.UsageError("zotero serve is not running for this config")
+        return
+    if daemon.running(path):
+        raise click.UsageError("zotero serve is already running on " + str(path))
+    if (store.library is None):
+        raise click.UsageError("No library to serve, run zotero conf first")
+    sync = None
+    if (sync_interval is not None):
+        sync = scheduler.SyncScheduler(store, interval=sync_interval, max_interval=max_interval,
+                                       metrics_path=Path(metrics) if metrics else None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # still flushes the library
+    daemon.LibraryDaemon(store, cli, path, idle_flush=idle_flush, scheduler=sync).serve()
+
+
+@cli.command()
+@click.pass_obj
+def syncstat(store):
+    """Show the metrics of the background sync of zotero serve --sync"""
+    if (store.scheduler is None):
+        raise click.UsageError("No background sync, start it with zotero serve --sync SECONDS")
+    metrics = store.scheduler.metrics
+    for name, value in metrics.items():
+        if (name == "last_sync" and value is not None):
+            value = "{} ({:.0f}s ago)".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value)),
+                                              time.time() - value)
+        click.echo("{}: {}".format(name, value))
 
 
 @cli.command()
@@ -570,9 +770,10 @@ def conf(store, user, key, library, datadir, zoterodir):
 
 
 @cli.command()
+@click.option('--threads', '-j', default=1, type=click.IntRange(min=1), help="Number of item/collection requests kept in flight at once")
 @click.pass_obj
-def pull(store):
-    store.pull()
+def pull(store, threads):
+    store.pull(threads=threads)
     store.write_library()
 
 
@@ -609,11 +810,35 @@ def backup(store):
 
 
 @cli.command()
+@click.option('--fuzzy', '-z', is_flag=True, help="Also merge documents whose titles differ by a few characters")
+@click.option('--similarity', '-s', type=click.FloatRange(0, 1),
+              help="Merge documents whose title shingles are more similar than this (MinHash/LSH), e.g. 0.7")
+@click.option('--batch', is_flag=True, help="Decide merges by --policy instead of asking")
+@click.option('--policy', '-p', type=click.Path(exists=True, dir_okay=False),
+              help="JSON merge policy for --batch, by default merge when DOI, ISBN or title and year match")
+@click.option('--report', '-r', type=click.File('w'), default='-', help="Where --batch writes its JSON report")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help="Number of processes building merge proposals")
 @click.pass_obj
-def dedup(store):
-    store.load()
-    merger = SimpleZDocMerger(store.library)
-    store.term_merger(merger)
+def dedup(store, fuzzy, similarity, batch, policy, report, jobs):
+    if (fuzzy and similarity is not None):
+        raise click.UsageError("--fuzzy and --similarity pick different mergers, pass only one of them")
+    if (store.served and not (batch or policy)):
+        raise click.UsageError("zotero serve can't merge interactively, pass --batch or --policy or stop it first")
+    if (similarity is not None):
+        merger = MinHashZDocMerger(store.library, threshold=similarity, processes=jobs)
+    elif (fuzzy):
+        merger = FuzzyZDocMerger(store.library, processes=jobs)
+    else:
+        merger = SimpleZDocMerger(store.library, processes=jobs)
+    if (batch or policy):
+        try:
+            merge_policy = MergePolicy.load(policy) if policy else MergePolicy()
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--policy")
+        json.dump(merger.batch_merge(merge_policy), report, indent=1)
+        report.write("\n")
+    else:
+        store.term_merger(merger)
     store.write_library()
 
 
@@ -631,11 +856,17 @@ def dedup(store):
 @click.option('--deleted', '-d', is_flag=True)
 @click.option('--full', '-f', is_flag=True)
 @click.option('--long', '-l', is_flag=True)
-@click.option('--modified', '-m', 'show_modified', flag_value={True})
-@click.option('--unmodified', '-M', 'show_modified', flag_value={False})
-@click.option('--any-modified', 'show_modified', flag_value={True, False}, default=True)
+@click.option('--modified', '-m', 'show_modified', flag_value={True}, type=click.UNPROCESSED)
+@click.option('--unmodified', '-M', 'show_modified', flag_value={False}, type=click.UNPROCESSED)
+@click.option('--any-modified', 'show_modified', flag_value={True, False}, default=True, type=click.UNPROCESSED)
+@click.option('--limit', type=click.IntRange(min=0), default=None, help="Show at most this many objects.")
+@click.option('--offset', type=click.IntRange(min=0), default=0, help="Skip this many objects first, in key order unless sorted.")
+@click.option('--format', 'export_format', type=click.Choice(export.Formats), default=None,
+              help="Write the Zotero data of the listed objects as jsonl, csv, arrow or parquet instead.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False, allow_dash=True), default='-',
+              help="File to write --format output to, stdout by default.")
 @click.pass_obj
-def lsdoc(store, long, show_modified, deleted, sort, full, title, key, creator, child, itemtype, collection, tag):
+def lsdoc(store, long, show_modified, deleted, sort, full, title, key, creator, child, itemtype, collection, tag, limit, offset, export_format, output):
     sortby = None
     reverse = False
     regex = dict()
@@ -664,7 +895,9 @@ def lsdoc(store, long, show_modified, deleted, sort, full, title, key, creator,
             sortby = "clean_title"
         if (sort.isupper()):
             reverse = True
-    store.list_objects(object_type=ZoteroDocument, long=long, modified=show_modified, deleted=deleted, sortby=sortby, reverse=reverse, full=full, regexps=regex)
+    if (export_format is not None and not export.available(export_format)):
+        raise click.BadParameter("needs pyarrow installed", param_hint="--format")
+    store.list_objects(object_type=ZoteroDocument, long=long, modified=show_modified, deleted=deleted, sortby=sortby, reverse=reverse, full=full, regexps=regex, limit=limit, offset=offset, export_format=export_format, output=output)
 
 
 @cli.command()
@@ -677,16 +910,22 @@ def lsdoc(store, long, show_modified, deleted, sort, full, title, key, creator,
 @click.option('--sort', '-s', type=click.Choice(['t', 'T', 'k', 'K', 'l', 'L', 'f', 'F']),
               help="Sort by title, key, linkMode, filename by passing first letter.  Capitalize to reverse.")
 @click.option('--deleted', '-d', is_flag=True)
-@click.option('--missing', '-x', 'show_missing', flag_value={True})
-@click.option('--nomissing', '-X', 'show_missing', flag_value={False})
-@click.option('--maybemissing', 'show_missing', flag_value={True, False}, default=True)
+@click.option('--missing', '-x', 'show_missing', flag_value={True}, type=click.UNPROCESSED)
+@click.option('--nomissing', '-X', 'show_missing', flag_value={False}, type=click.UNPROCESSED)
+@click.option('--maybemissing', 'show_missing', flag_value={True, False}, default=True, type=click.UNPROCESSED)
 @click.option('--full', '-f', is_flag=True)
 @click.option('--long', '-l', is_flag=True)
-@click.option('--modified', '-m', 'show_modified', flag_value={True})
-@click.option('--unmodified', '-M', 'show_modified', flag_value={False})
-@click.option('--any-modified', 'show_modified', flag_value={True, False}, default=True)
+@click.option('--modified', '-m', 'show_modified', flag_value={True}, type=click.UNPROCESSED)
+@click.option('--unmodified', '-M', 'show_modified', flag_value={False}, type=click.UNPROCESSED)
+@click.option('--any-modified', 'show_modified', flag_value={True, False}, default=True, type=click.UNPROCESSED)
+@click.option('--limit', type=click.IntRange(min=0), default=None, help="Show at most this many objects.")
+@click.option('--offset', type=click.IntRange(min=0), default=0, help="Skip this many objects first, in key order unless sorted.")
+@click.option('--format', 'export_format', type=click.Choice(export.Formats), default=None,
+              help="Write the Zotero data of the listed objects as jsonl, csv, arrow or parquet instead.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False, allow_dash=True), default='-',
+              help="File to write --format output to, stdout by default.")
 @click.pass_obj
-def lsattach(store, long, show_modified, deleted, sort, full, title, key, filename, linkmode, parent, tag, show_missing):
+def lsattach(store, long, show_modified, deleted, sort, full, title, key, filename, linkmode, parent, tag, show_missing, limit, offset, export_format, output):
     sortby = None
     reverse = False
     regex = dict()
@@ -713,7 +952,9 @@ def lsattach(store, long, show_modified, deleted, sort, full, title, key, filena
             sortby = "filename"
         if (sort.isupper()):
             reverse = True
-    store.list_objects(object_type=ZoteroAttachment, long=long, modified=show_modified, deleted=deleted, sortby=sortby, reverse=reverse, full=full, regexps=regex, missing=show_missing)
+    if (export_format is not None and not export.available(export_format)):
+        raise click.BadParameter("needs pyarrow installed", param_hint="--format")
+    store.list_objects(object_type=ZoteroAttachment, long=long, modified=show_modified, deleted=deleted, sortby=sortby, reverse=reverse, full=full, regexps=regex, missing=show_missing, limit=limit, offset=offset, export_format=export_format, output=output)
 
 
 @cli.command()
@@ -726,11 +967,17 @@ def lsattach(store, long, show_modified, deleted, sort, full, title, key, filena
 @click.option('--deleted', '-d', is_flag=True)
 @click.option('--full', '-f', is_flag=True)
 @click.option('--long', '-l', is_flag=True)
-@click.option('--modified', '-m', 'show_modified', flag_value={True})
-@click.option('--unmodified', '-M', 'show_modified', flag_value={False})
-@click.option('--any-modified', 'show_modified', flag_value={True, False}, default=True)
+@click.option('--modified', '-m', 'show_modified', flag_value={True}, type=click.UNPROCESSED)
+@click.option('--unmodified', '-M', 'show_modified', flag_value={False}, type=click.UNPROCESSED)
+@click.option('--any-modified', 'show_modified', flag_value={True, False}, default=True, type=click.UNPROCESSED)
+@click.option('--limit', type=click.IntRange(min=0), default=None, help="Show at most this many objects.")
+@click.option('--offset', type=click.IntRange(min=0), default=0, help="Skip this many objects first, in key order unless sorted.")
+@click.option('--format', 'export_format', type=click.Choice(export.Formats), default=None,
+              help="Write the Zotero data of the listed objects as jsonl, csv, arrow or parquet instead.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False, allow_dash=True), default='-',
+              help="File to write --format output to, stdout by default.")
 @click.pass_obj
-def lscol(store, long, show_modified, deleted, sort, full, name, key, parent, child):
+def lscol(store, long, show_modified, deleted, sort, full, name, key, parent, child, limit, offset, export_format, output):
     sortby = None
     reverse = False
     regex = dict()
@@ -753,40 +1000,53 @@ def lscol(store, long, show_modified, deleted, sort, full, name, key, parent, ch
             sortby = "size"
         if (sort.isupper()):
             reverse = True
-    store.list_objects(object_type=ZoteroCollection, long=long, modified=show_modified, deleted=deleted, sortby=sortby, reverse=reverse, full=full, regexps=regex)
+    if (export_format is not None and not export.available(export_format)):
+        raise click.BadParameter("needs pyarrow installed", param_hint="--format")
+    store.list_objects(object_type=ZoteroCollection, long=long, modified=show_modified, deleted=deleted, sortby=sortby, reverse=reverse, full=full, regexps=regex, limit=limit, offset=offset, export_format=export_format, output=output)
 
 
 @cli.command()
 @click.option('--directory', '-d',  type=click.Path(), help="Directory to scan.")
 @click.option('--relaxed', '-r', is_flag=True)
+@click.option('--threads', '-j', type=click.IntRange(min=1), help="Number of files hashed at once (default one per cpu)")
 @click.pass_obj
-def find_files(store, directory, relaxed):
+def find_files(store, directory, relaxed, threads):
     if (directory):
-        store.find_files(filetype=ZoteroLinkedFile, directory=Path(directory).resolve(), relaxed=relaxed)
+        store.find_files(filetype=ZoteroLinkedFile, directory=Path(directory).resolve(), relaxed=relaxed, threads=threads)
     else:
-        store.find_files(filetype=ZoteroLinkedFile, relaxed=relaxed)
+        store.find_files(filetype=ZoteroLinkedFile, relaxed=relaxed, threads=threads)
     store.write_library()
 
 
 @cli.command()
 @click.option('--directory', '-d',  type=click.Path(), help="Directory to scan.")
 @click.option('--relaxed', '-r', is_flag=True)
+@click.option('--threads', '-j', type=click.IntRange(min=1), help="Number of files hashed at once (default one per cpu)")
 @click.pass_obj
-def find_imported(store, directory, relaxed):
+def find_imported(store, directory, relaxed, threads):
     if (directory):
-        store.find_files(filetype=ZoteroImportedFile, directory=Path(directory).resolve(), relaxed=relaxed)
+        store.find_files(filetype=ZoteroImportedFile, directory=Path(directory).resolve(), relaxed=relaxed, threads=threads)
     else:
-        store.find_files(filetype=ZoteroImportedFile, relaxed=relaxed)
+        store.find_files(filetype=ZoteroImportedFile, relaxed=relaxed, threads=threads)
     store.write_library()
 
 
 @cli.command()
+@click.option('--threads', '-j', type=click.IntRange(min=1), help="Number of files hashed at once (default one per cpu)")
 @click.pass_obj
-def dedup_files(store):
-    store.dedup_child_files()
+def dedup_files(store, threads):
+    store.dedup_child_files(threads=threads)
     store.write_library()
 
 
+@cli.command()
+@click.option('--dry-run', '-n', is_flag=True, help="Only list the duplicates that would be deleted")
+@click.option('--batch-size', '-b', default=50, type=click.IntRange(min=1), help="Deletions between checkpoints")
+@click.pass_obj
+def dedup_attachments(store, dry_run, batch_size):
+    store.dedup_attachments(dry_run=dry_run, batch_size=batch_size)
+
+
 @cli.command()
 @click.pass_obj
 def fix(store):